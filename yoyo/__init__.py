@@ -1,6 +1,12 @@
 from yoyo.exceptions import DatabaseError  # noqa
+from yoyo.helpers import (stream_rows, parallel_backfill,  # noqa
+                          clear_backfill)
+from yoyo.catalog import (table_exists, table_missing,  # noqa
+                          column_exists, column_missing,
+                          index_exists, index_missing)
 from yoyo.migrations import (read_migrations, initialize_connection,  # noqa
                              default_migration_table, logger,
-                             step, transaction)
+                             step, transaction, index_step, depends_on,
+                             resource_profile)
 
 __version__ = '4.2.5dev'
@@ -0,0 +1,152 @@
+"""
+Static analysis of migrations, flagging statements likely to lock tables or
+rewrite them before they are run against a live database.
+
+Each SQL step is matched against a list of rules. A rule gives the backends
+it applies to, the lock the statement takes, whether it rewrites or scans
+the table, and a severity: ``error`` for statements that block reads and
+writes for the duration of a table rewrite, ``warning`` for statements that
+block writes or scan a whole table, and ``info`` for anything else worth
+knowing about.
+"""
+import re
+
+from yoyo.migrations import IndexStep, step_statements
+
+#: Severities in increasing order
+severities = ['info', 'warning', 'error']
+
+
+class Rule(object):
+
+    def __init__(self, name, pattern, backends, severity, lock, message):
+        self.name = name
+        self.pattern = re.compile(pattern, re.I | re.S)
+        self.backends = backends
+        self.severity = severity
+        self.lock = lock
+        self.message = message
+
+    def matches(self, sql, backend):
+        return (self.backends is None or backend in self.backends) and \
+            self.pattern.search(sql) is not None
+
+
+#: Rules checked against every SQL statement. ``backends`` of ``None``
+#: applies the rule to all backends.
+rules = [
+    Rule('index-not-concurrent',
+         r'^\s*CREATE\s+(UNIQUE\s+)?INDEX\s+(?!.*\bCONCURRENTLY\b)',
+         ['postgresql'], 'warning', 'SHARE',
+         "CREATE INDEX blocks writes to the table while the index is "
+         "built. Use index_step to build it concurrently"),
+    Rule('alter-column-type',
+         r'^\s*ALTER\s+TABLE\s.*\bALTER\s+(COLUMN\s+)?\S+\s+'
+         r'(SET\s+DATA\s+)?TYPE\b',
+         ['postgresql'], 'error', 'ACCESS EXCLUSIVE',
+         "Changing a column type rewrites the table, blocking reads and "
+         "writes"),
+    Rule('add-column-volatile-default',
+         r'^\s*ALTER\s+TABLE\s.*\bADD\s+(COLUMN\s+)?.*\bDEFAULT\s+'
+         r'(now\(\)|clock_timestamp\(\)|random\(\)|gen_random_uuid\(\)|'
+         r'uuid_generate_v4\(\)|nextval\()',
+         ['postgresql'], 'error', 'ACCESS EXCLUSIVE',
+         "Adding a column with a volatile default rewrites the table, "
+         "blocking reads and writes"),
+    Rule('set-not-null',
+         r'^\s*ALTER\s+TABLE\s.*\bSET\s+NOT\s+NULL\b',
+         ['postgresql'], 'warning', 'ACCESS EXCLUSIVE',
+         "SET NOT NULL scans the whole table while blocking reads and "
+         "writes. Add a NOT VALID check constraint and validate it first"),
+    Rule('constraint-not-valid',
+         r'^\s*ALTER\s+TABLE\s.*\bADD\s+(CONSTRAINT\s+\S+\s+)?'
+         r'(FOREIGN\s+KEY|CHECK)\b(?!.*\bNOT\s+VALID\b)',
+         ['postgresql'], 'warning', 'SHARE ROW EXCLUSIVE',
+         "Adding a constraint scans the whole table while blocking writes. "
+         "Add it NOT VALID, then VALIDATE CONSTRAINT in a later step"),
+    Rule('table-rewrite',
+         r'^\s*(VACUUM\s+FULL|CLUSTER)\b',
+         ['postgresql'], 'error', 'ACCESS EXCLUSIVE',
+         "Rewrites the table, blocking reads and writes"),
+    Rule('modify-column',
+         r'^\s*ALTER\s+TABLE\s.*\b(MODIFY|CHANGE)\s+(COLUMN\s+)?\S+',
+         ['mysql'], 'error', 'SHARED (table copy)',
+         "Changing a column definition copies the table, blocking writes"),
+    Rule('mysql-add-column',
+         r'^\s*ALTER\s+TABLE\s.*\bADD\s+(COLUMN\s+)?(?!INDEX|KEY|UNIQUE|'
+         r'PRIMARY|CONSTRAINT|FOREIGN|FULLTEXT|SPATIAL)\S+\s'
+         r'(?!.*\bALGORITHM\s*=\s*INSTANT\b)',
+         ['mysql'], 'warning', 'NONE (table rebuild)',
+         "Adding a column rebuilds the table unless ALGORITHM=INSTANT is "
+         "used (MySQL 8.0)"),
+    Rule('lock-table',
+         r'^\s*LOCK\s+TABLES?\b',
+         None, 'error', 'EXPLICIT',
+         "Explicitly locks tables"),
+    Rule('unbatched-update',
+         r'^\s*(UPDATE|DELETE)\b(?!.*\bWHERE\b)',
+         None, 'warning', 'ROW (every row)',
+         "Updates every row in a single statement, holding row locks on the "
+         "whole table until the transaction commits. Update in batches"),
+    Rule('rename',
+         r'^\s*ALTER\s+TABLE\s.*\bRENAME\b',
+         None, 'warning', 'ACCESS EXCLUSIVE',
+         "Renaming breaks code using the old name that is still running"),
+    Rule('drop',
+         r'^\s*(DROP\s+TABLE|ALTER\s+TABLE\s.*\bDROP\s+(COLUMN\s+)?'
+         r'(?!INDEX|KEY|CONSTRAINT|PRIMARY|FOREIGN|DEFAULT|NOT)\S+)',
+         None, 'info', 'ACCESS EXCLUSIVE',
+         "Destroys data; ensure no running code still uses it"),
+]
+
+
+class Finding(object):
+    """
+    A potential problem found in a step.
+    """
+
+    def __init__(self, migration, step_id, rule, sql):
+        self.migration = migration
+        self.step_id = step_id
+        self.rule = rule
+        self.sql = sql
+
+    @property
+    def severity(self):
+        return self.rule.severity
+
+    def __str__(self):
+        return '%s: step %s: %s [%s, lock: %s]\n    %s\n    %s' % (
+            self.migration.id, self.step_id, self.severity.upper(),
+            self.rule.name, self.rule.lock, ' '.join(self.sql.split()),
+            self.rule.message)
+
+
+def analyze_migration(migration, backend):
+    """
+    Return a list of ``Finding`` objects for the steps of ``migration`` when
+    applied to ``backend``.
+    """
+    findings = []
+    for step in migration.steps:
+        if isinstance(step, IndexStep):
+            # Index steps are built online
+            continue
+        for inner, sql in step_statements(step):
+            if sql is None:
+                continue
+            for rule in rules:
+                if rule.matches(sql, backend):
+                    findings.append(Finding(migration, inner.id, rule, sql))
+    return findings
+
+
+def analyze(migrations, backend):
+    """
+    Return a list of ``Finding`` objects for each migration in
+    ``migrations``.
+    """
+    findings = []
+    for migration in migrations:
+        findings.extend(analyze_migration(migration, backend))
+    return findings
@@ -0,0 +1,302 @@
+"""
+Benchmarks for the migration engine.
+
+Synthetic migration trees are generated and run through each phase of a
+migration: reading the scripts, selecting migrations to apply, applying
+them, then selecting and rolling them back. For each phase the wall time,
+number of queries and commits issued and peak memory allocated are
+reported.
+
+Round trips are counted using the ``yoyo.fakedb`` driver, which can also
+simulate the latency of a remote database server (see
+``--query-latency`` and ``--commit-latency``).
+
+Run the benchmarks with::
+
+    python -m yoyo.benchmarks --sizes 100,1000,10000
+
+Results can be saved with ``--save results.json`` and compared against a
+previous run with ``--compare results.json``, eg to check a change for
+performance regressions::
+
+    git stash && python -m yoyo.benchmarks --save base.json
+    git stash pop && python -m yoyo.benchmarks --compare base.json
+"""
+from __future__ import print_function
+import argparse
+from functools import partial
+import gc
+import json
+import platform
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from yoyo import fakedb
+from yoyo import read_migrations
+from yoyo.benchmarks import trees
+
+phases = ['read', 'to_apply', 'apply', 'to_rollback', 'rollback']
+
+#: Connection factories for each driver benchmarked, taking the latencies
+#: to simulate. Only the ``fake`` driver counts round trips to the database.
+drivers = {
+    'sqlite': lambda **latency: (sqlite3.connect(':memory:'),
+                                 sqlite3.paramstyle),
+    'fake': lambda **latency: (fakedb.connect(':memory:', **latency),
+                               fakedb.paramstyle),
+}
+
+#: Time differences smaller than this (in seconds) are never reported as
+#: regressions
+noise_floor = 0.005
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+
+def measure(conn, func, trace_memory=True):
+    """
+    Call ``func`` and return a tuple of ``(result, metrics)``, where
+    ``metrics`` is a dict of the wall time, queries, commits and peak memory
+    used by the call.
+    """
+    trace = getattr(conn, 'trace', None)
+    since = len(trace) if trace is not None else None
+    gc.collect()
+    trace_memory = trace_memory and tracemalloc is not None
+    if trace_memory:
+        tracemalloc.start()
+    started = timer()
+    try:
+        result = func()
+        elapsed = timer() - started
+        peak_memory = tracemalloc.get_traced_memory()[1] \
+            if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    counts = conn.counts(since) if since is not None else {}
+    return result, {
+        'time': elapsed,
+        'queries': counts.get('queries'),
+        'commits': counts.get('commits'),
+        'peak_memory': peak_memory,
+    }
+
+
+def run_phases(connect, directory, trace_memory=True):
+    """
+    Run each benchmark phase once against a fresh database connection,
+    returning a dict mapping phase names to metrics.
+    """
+    conn, paramstyle = connect()
+    results = {}
+    try:
+        migrations, results['read'] = measure(
+            conn, lambda: read_migrations(conn, paramstyle, directory),
+            trace_memory)
+        pending, results['to_apply'] = measure(
+            conn, migrations.to_apply, trace_memory)
+        _, results['apply'] = measure(conn, pending.apply, trace_memory)
+        applied, results['to_rollback'] = measure(
+            conn, migrations.to_rollback, trace_memory)
+        _, results['rollback'] = measure(conn, applied.rollback, trace_memory)
+    finally:
+        conn.close()
+    return results
+
+
+def run_benchmarks(sizes, driver_names, repeat=3, trace_memory=True,
+                   latency=None, **tree_options):
+    """
+    Run the benchmarks for each tree size and driver. Return a dict mapping
+    ``driver:size:phase`` keys to the best metrics from ``repeat`` runs.
+
+    ``latency`` is a dict of ``query_latency`` and ``commit_latency``
+    values passed to the drivers. ``tree_options`` are passed to
+    ``yoyo.benchmarks.trees.make_tree``.
+    """
+    latency = latency or {}
+    results = {}
+    for size in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            trees.make_tree(directory, size, **tree_options)
+            for name in driver_names:
+                for _ in range(repeat):
+                    connect = partial(drivers[name], **latency)
+                    for phase, metrics in run_phases(
+                            connect, directory, trace_memory).items():
+                        key = '%s:%d:%s' % (name, size, phase)
+                        results[key] = best(results.get(key), metrics)
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def best(a, b):
+    """
+    Combine metrics from two runs, keeping the lowest time and memory.
+    """
+    if a is None:
+        return b
+    combined = dict(b)
+    for k in 'time', 'peak_memory':
+        if a[k] is not None and b[k] is not None:
+            combined[k] = min(a[k], b[k])
+    return combined
+
+
+def compare(baseline, results, threshold=1.2):
+    """
+    Compare ``results`` with ``baseline``. Return a list of
+    ``(key, description)`` tuples for each regression found.
+
+    A phase regresses if its time grows by more than a factor of
+    ``threshold`` (and by more than ``noise_floor`` seconds), or if it
+    issues more queries or commits than before.
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old, new = baseline[key], results[key]
+        if new['time'] > old['time'] * threshold and \
+                new['time'] - old['time'] > noise_floor:
+            regressions.append((key, 'time %.1fms -> %.1fms' % (
+                old['time'] * 1000, new['time'] * 1000)))
+        for k in 'queries', 'commits':
+            if old[k] is not None and new[k] is not None and new[k] > old[k]:
+                regressions.append((key, '%s %d -> %d' % (k, old[k], new[k])))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """
+    Return the results as a table, one line per phase.
+    """
+    def fmt(value, format):
+        return '-' if value is None else format % value
+
+    lines = ['%-8s %7s %-12s %10s %8s %8s %10s%s' % (
+        'driver', 'size', 'phase', 'time(ms)', 'queries', 'commits',
+        'peak(KiB)', '  vs baseline' if baseline else '')]
+    keys = sorted(results, key=lambda k: (k.split(':')[0],
+                                          int(k.split(':')[1]),
+                                          phases.index(k.split(':')[2])))
+    for key in keys:
+        name, size, phase = key.split(':')
+        metrics = results[key]
+        line = '%-8s %7s %-12s %10s %8s %8s %10s' % (
+            name, size, phase,
+            fmt(metrics['time'] * 1000, '%.1f'),
+            fmt(metrics['queries'], '%d'),
+            fmt(metrics['commits'], '%d'),
+            fmt(metrics['peak_memory'] and metrics['peak_memory'] / 1024.0,
+                '%.0f'))
+        if baseline and key in baseline and baseline[key]['time']:
+            line += '  %+.0f%%' % (
+                (metrics['time'] / baseline[key]['time'] - 1) * 100)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def get_revision():
+    """
+    Return the current git revision, if available.
+    """
+    try:
+        return subprocess.Popen(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE).communicate()[0].decode('ascii').strip()
+    except OSError:
+        return None
+
+
+def make_argparser():
+    argparser = argparse.ArgumentParser(prog='python -m yoyo.benchmarks')
+    argparser.add_argument("--sizes", default="100,1000",
+                           help="Comma separated list of migration counts "
+                                "(default: %(default)s)")
+    argparser.add_argument("--drivers", default=','.join(sorted(drivers)),
+                           help="Comma separated list of drivers "
+                                "(default: %(default)s)")
+    argparser.add_argument("--steps", default="1-5",
+                           help="Range of steps per migration "
+                                "(default: %(default)s)")
+    argparser.add_argument("--callable-ratio", type=float, default=0.2,
+                           help="Proportion of steps that are python "
+                                "callables (default: %(default)s)")
+    argparser.add_argument("--query-latency", type=float, default=0,
+                           help="Seconds to add to each query made by the "
+                                "fake driver (default: %(default)s)")
+    argparser.add_argument("--commit-latency", type=float, default=0,
+                           help="Seconds to add to each commit or rollback "
+                                "made by the fake driver "
+                                "(default: %(default)s)")
+    argparser.add_argument("--repeat", type=int, default=3,
+                           help="Number of runs to take the best time from "
+                                "(default: %(default)s)")
+    argparser.add_argument("--no-memory", dest="trace_memory",
+                           action="store_false", default=True,
+                           help="Don't trace memory allocations, which "
+                                "slow down the benchmarks")
+    argparser.add_argument("--save", metavar="FILE",
+                           help="Save results as JSON to FILE")
+    argparser.add_argument("--compare", metavar="FILE",
+                           help="Compare results with a previous run saved "
+                                "in FILE, exiting with an error on "
+                                "regressions")
+    argparser.add_argument("--threshold", type=float, default=1.2,
+                           help="Slowdown factor reported as a regression "
+                                "(default: %(default)s)")
+    return argparser
+
+
+def main(argv=None):
+    argparser = make_argparser()
+    args = argparser.parse_args(argv)
+    min_steps, _, max_steps = args.steps.partition('-')
+    results = run_benchmarks(
+        [int(size) for size in args.sizes.split(',')],
+        args.drivers.split(','),
+        repeat=args.repeat,
+        trace_memory=args.trace_memory,
+        latency={'query_latency': args.query_latency,
+                 'commit_latency': args.commit_latency},
+        min_steps=int(min_steps),
+        max_steps=int(max_steps or min_steps),
+        callable_ratio=args.callable_ratio)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print(format_results(results, baseline))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'revision': get_revision(),
+                       'python': platform.python_version(),
+                       'options': vars(args),
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(baseline, results, args.threshold)
+        for key, description in regressions:
+            print("REGRESSION %s: %s" % (key, description))
+        if regressions:
+            return 1
+    return 0
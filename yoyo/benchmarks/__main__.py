@@ -0,0 +1,5 @@
+import sys
+
+from yoyo.benchmarks import main
+
+sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+Generate synthetic trees of migration scripts for benchmarking.
+"""
+import os
+import random
+
+
+def make_tree(directory, count, min_steps=1, max_steps=5,
+              callable_ratio=0.2, transaction_ratio=0.2, seed=0):
+    """
+    Write ``count`` migration scripts to ``directory``.
+
+    Each migration creates its own table, then adds between ``min_steps``
+    and ``max_steps`` (inclusive) further steps inserting into it. A
+    proportion ``callable_ratio`` of these steps are python callables rather
+    than SQL, and a proportion ``transaction_ratio`` of migrations group
+    their steps in a single transaction. The same ``seed`` always produces
+    the same tree.
+    """
+    rng = random.Random(seed)
+    width = len(str(count))
+    for ix in range(count):
+        table = 't_%0*d' % (width, ix)
+        nsteps = rng.randint(min_steps, max_steps)
+        lines = ['from yoyo import step, transaction', '',
+                 'step("CREATE TABLE %s (id INT, value VARCHAR(20))", '
+                 '"DROP TABLE %s")' % (table, table)]
+        steps = []
+        for stepno in range(nsteps):
+            if rng.random() < callable_ratio:
+                lines.extend([
+                    '',
+                    'def insert_%d(conn):' % stepno,
+                    '    cursor = conn.cursor()',
+                    '    cursor.execute("INSERT INTO %s VALUES (%d, \'%s\')")'
+                    % (table, stepno, 'callable'),
+                    '',
+                    'def delete_%d(conn):' % stepno,
+                    '    cursor = conn.cursor()',
+                    '    cursor.execute("DELETE FROM %s WHERE id = %d")'
+                    % (table, stepno),
+                    '',
+                ])
+                steps.append('step(insert_%d, delete_%d)' % (stepno, stepno))
+            else:
+                steps.append(
+                    'step("INSERT INTO %s VALUES (%d, \'sql\')", '
+                    '"DELETE FROM %s WHERE id = %d")'
+                    % (table, stepno, table, stepno))
+        if len(steps) > 1 and rng.random() < transaction_ratio:
+            lines.append('transaction(\n    %s\n)' % (',\n    '.join(steps),))
+        else:
+            lines.extend(steps)
+        path = os.path.join(directory, '%0*d.migration.py' % (width, ix))
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,187 @@
+"""
+Fast creation of fresh databases.
+
+When every migration is applied to an empty database, none of the
+precautions taken for live databases are needed: no other session can be
+waiting on a lock, and if the process crashes the database can simply be
+created again. ``bootstrap`` applies all migrations in a single transaction
+with durability relaxed for the session (SQLite's ``journal_mode`` and
+``synchronous`` pragmas, PostgreSQL's ``synchronous_commit``). Indexes
+declared with ``index_step`` are built with plain ``CREATE INDEX``
+statements, and non-unique indexes are deferred until the tables have been
+populated (or until a later step alters the table or refers to the index).
+The normal settings are restored and the result verified at the
+end::
+
+    from yoyo.bootstrap import bootstrap
+
+    bootstrap(read_migrations(conn, paramstyle, 'migrations'))
+"""
+from logging import getLogger
+import re
+
+from yoyo import catalog
+from yoyo.connections import get_backend
+from yoyo.migrations import IndexStep, MigrationStep, step_statements
+from yoyo.utils import query
+
+logger = getLogger(__name__)
+
+#: Session settings relaxed while bootstrapping, for each backend, as
+#: ``(query returning the current value, statement setting a value, value
+#: used while bootstrapping)``
+bootstrap_settings = {
+    'sqlite': [
+        ('PRAGMA journal_mode', 'PRAGMA journal_mode = %s', 'MEMORY'),
+        ('PRAGMA synchronous', 'PRAGMA synchronous = %s', 'OFF'),
+    ],
+    'postgresql': [
+        ('SHOW synchronous_commit', 'SET synchronous_commit = %s', 'off'),
+    ],
+}
+
+
+class BootstrapError(Exception):
+    """
+    The database could not be bootstrapped, or failed verification
+    afterwards.
+    """
+
+
+def relax_settings(conn):
+    """
+    Relax the durability settings for the session, returning a list of
+    ``(statement, original value)`` pairs to restore them.
+    """
+    backend = get_backend(conn)
+    settings = bootstrap_settings.get(backend, [])
+    if not settings:
+        logger.info("No bootstrap settings for %s", backend)
+    conn.commit()
+    restore = []
+    for show, statement, value in settings:
+        original = query(conn, show)[0][0]
+        logger.debug("Setting %s (was %s)", statement % value, original)
+        query(conn, statement % value)
+        restore.append((statement, original))
+    conn.commit()
+    return restore
+
+
+def restore_settings(conn, restore):
+    conn.commit()
+    for statement, original in restore:
+        query(conn, statement % original)
+    conn.commit()
+
+
+#: Statements that only change the rows of a table. Building a deferred
+#: index may safely be left until after these.
+_row_statement = re.compile(r'^\s*(INSERT|UPDATE|DELETE|REPLACE|COPY)\b',
+                            re.I)
+
+
+def _name_pattern(name):
+    return re.compile(r'(?<![\w.])%s(?!\w)' % re.escape(name), re.I)
+
+
+def _needs_index(step, index):
+    """
+    Return true if ``step`` must run after ``index`` is built: if it refers
+    to the index, or refers to its table other than to change its rows (eg
+    to rename or drop it). Python steps are assumed to need every index.
+    """
+    name = _name_pattern(index.name)
+    table = _name_pattern(index.table)
+    for inner, sql in step_statements(step):
+        if isinstance(inner, IndexStep):
+            if inner.name == index.name:
+                return True
+        elif sql is None or name.search(sql) or \
+                (table.search(sql) and not _row_statement.match(sql)):
+            return True
+    return False
+
+
+def prepare_migrations(migrations):
+    """
+    Return a copy of ``migrations`` in which index steps are replaced by
+    plain ``CREATE INDEX`` steps that can run in a transaction. Non-unique
+    indexes are deferred, so that they are built after the tables are
+    populated but before the transaction commits: each is moved to just
+    before the first later step that needs it (see ``_needs_index``), or
+    to the end of the last migration. Unique indexes stay in place, as
+    later migrations may rely on them (eg for foreign keys).
+
+    Return the prepared list and the index steps replaced.
+    """
+    prepared = []
+    indexes = []
+    deferred = []
+    for m in migrations:
+        steps = []
+        for step in m.steps:
+            needed = [(index, create) for index, create in deferred
+                      if _needs_index(step, index)]
+            if needed:
+                steps.extend(create for index, create in needed)
+                deferred = [d for d in deferred if d not in needed]
+            if isinstance(step, IndexStep):
+                indexes.append(step)
+                create = MigrationStep(step.id, step._create_sql(), None)
+                create.resource_profile = step.resource_profile
+                if step.unique:
+                    steps.append(create)
+                else:
+                    deferred.append((step, create))
+            else:
+                steps.append(step)
+        prepared.append(m.__class__(m.id, steps, m.source, m.path))
+    if deferred:
+        logger.info("Deferring %d index builds", len(deferred))
+        prepared[-1]._steps.extend(create for index, create in deferred)
+    return migrations.replace(prepared), indexes
+
+
+def verify(migrations, indexes):
+    """
+    Check that every migration was recorded as applied and every index
+    built.
+    """
+    conn = migrations.conn
+    pending = migrations.to_apply()
+    if pending:
+        raise BootstrapError("Migrations not applied: %s" %
+                             ', '.join(m.id for m in pending))
+    backend = get_backend(conn)
+    if indexes and backend in catalog.catalog_queries:
+        snapshot = catalog.load_catalog(conn)
+        missing = [i.name for i in indexes if not snapshot.has_index(i.name)]
+        if missing:
+            raise BootstrapError("Indexes not built: %s" %
+                                 ', '.join(missing))
+    if backend == 'sqlite':
+        result = query(conn, "PRAGMA integrity_check")
+        if result != [('ok',)]:
+            raise BootstrapError("Integrity check failed: %s" % (result,))
+
+
+def bootstrap(migrations, force=False):
+    """
+    Apply ``migrations`` to a database with an empty migrations table, as
+    fast as the backend allows. Raise ``BootstrapError`` if migrations have
+    already been applied to the database, or if verification fails.
+    """
+    if migrations.applied_ids():
+        raise BootstrapError("Bootstrapping requires an empty migrations "
+                             "table: migrations have already been applied")
+    if not migrations:
+        return
+    prepared, indexes = prepare_migrations(migrations)
+    conn = migrations.conn
+    restore = relax_settings(conn)
+    try:
+        prepared.apply(force, batch_commit=True)
+    finally:
+        restore_settings(conn, restore)
+    verify(migrations, indexes)
@@ -0,0 +1,181 @@
+"""
+Snapshots of the database catalog, used to check step preconditions.
+
+A snapshot of the tables, columns and indexes in the database is loaded the
+first time a precondition is checked, and reused until a step changes the
+database schema (steps that only query or change table rows keep it).
+Re-running migrations over a partially migrated database then costs a couple
+of catalog queries, rather than a failed statement and a rollback for each
+object that already exists::
+
+    from yoyo import step, table_missing, column_missing
+
+    step("CREATE TABLE foo (id INT)", "DROP TABLE foo",
+         precondition=table_missing('foo'))
+    step("ALTER TABLE foo ADD COLUMN bar INT",
+         precondition=column_missing('foo', 'bar'))
+"""
+from logging import getLogger
+import re
+
+from yoyo.compat import ustr
+from yoyo.connections import get_backend
+from yoyo.utils import query
+
+logger = getLogger(__name__)
+
+#: Queries returning ``(table, column)`` rows for every column, and
+#: ``(index, table)`` rows for every index, for each backend
+catalog_queries = {
+    'sqlite': (
+        "SELECT m.name, p.name FROM sqlite_master m "
+        "JOIN pragma_table_info(m.name) p WHERE m.type = 'table'",
+        "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'",
+    ),
+    'postgresql': (
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema()",
+        "SELECT indexname, tablename FROM pg_catalog.pg_indexes "
+        "WHERE schemaname = current_schema()",
+    ),
+    'mysql': (
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = DATABASE()",
+        "SELECT DISTINCT index_name, table_name "
+        "FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE()",
+    ),
+}
+
+#: Catalog snapshots, keyed by the id of the underlying DB-API connection
+_snapshots = {}
+
+
+class Catalog(object):
+    """
+    The tables, columns and indexes present in a database. Names are
+    compared case insensitively.
+    """
+
+    def __init__(self, columns, indexes):
+        #: Map table names to the set of their column names
+        self.tables = {}
+        for table, column in columns:
+            self.tables.setdefault(table.lower(), set()).add(column.lower())
+        #: Map index names to the table they index
+        self.indexes = dict((index.lower(), table.lower())
+                            for index, table in indexes)
+
+    def has_table(self, table):
+        return table.lower() in self.tables
+
+    def has_column(self, table, column):
+        return column.lower() in self.tables.get(table.lower(), ())
+
+    def has_index(self, index):
+        return index.lower() in self.indexes
+
+
+def _key(conn):
+    # Connection wrappers (such as the batch commit connection) hold the
+    # underlying connection in ``_conn``
+    while getattr(conn, '_conn', None) is not None:
+        conn = conn._conn
+    return id(conn)
+
+
+def load_catalog(conn):
+    """
+    Query the catalog of the database ``conn`` is connected to.
+    """
+    backend = get_backend(conn)
+    try:
+        columns_sql, indexes_sql = catalog_queries[backend]
+    except KeyError:
+        raise ValueError("Preconditions are not supported for %s" %
+                         (backend,))
+    logger.debug("Loading catalog snapshot")
+    return Catalog(query(conn, columns_sql), query(conn, indexes_sql))
+
+
+def get_catalog(conn):
+    """
+    Return the catalog snapshot for ``conn``, loading it if there is no
+    current snapshot.
+    """
+    key = _key(conn)
+    catalog = _snapshots.get(key)
+    if catalog is None:
+        catalog = _snapshots[key] = load_catalog(conn)
+    return catalog
+
+
+def invalidate(conn):
+    """
+    Discard the catalog snapshot for ``conn``. This must be called whenever
+    a statement that may change the database schema is run.
+    """
+    _snapshots.pop(_key(conn), None)
+
+
+#: Statements that change only the rows of tables, never the schema
+_row_statement = re.compile(
+    r'^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|MERGE|COPY|WITH)\b', re.I)
+
+
+def changes_schema(sql):
+    """
+    Return true if ``sql`` may change the database schema: if any of its
+    statements is not a plain query or change to table rows. Python
+    callables may do anything, so are always assumed to.
+    """
+    if not isinstance(sql, (ustr, str)):
+        return True
+    return not all(_row_statement.match(statement)
+                   for statement in sql.split(';') if statement.strip())
+
+
+class Precondition(object):
+    """
+    A test of the database catalog that must be true for a step to run.
+    """
+
+    def __init__(self, description, test):
+        self.description = description
+        self.test = test
+
+    def __call__(self, conn):
+        return self.test(get_catalog(conn))
+
+    def __repr__(self):
+        return '<Precondition %s>' % (self.description,)
+
+
+def table_exists(table):
+    return Precondition('table %s exists' % table,
+                        lambda c: c.has_table(table))
+
+
+def table_missing(table):
+    return Precondition('table %s missing' % table,
+                        lambda c: not c.has_table(table))
+
+
+def column_exists(table, column):
+    return Precondition('column %s.%s exists' % (table, column),
+                        lambda c: c.has_column(table, column))
+
+
+def column_missing(table, column):
+    return Precondition('column %s.%s missing' % (table, column),
+                        lambda c: not c.has_column(table, column))
+
+
+def index_exists(index):
+    return Precondition('index %s exists' % index,
+                        lambda c: c.has_index(index))
+
+
+def index_missing(index):
+    return Precondition('index %s missing' % index,
+                        lambda c: not c.has_index(index))
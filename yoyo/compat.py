@@ -8,6 +8,16 @@ if PY2:
 else:
     ustr = str
 
+if PY2:
+    from StringIO import StringIO  # noqa
+else:
+    from io import StringIO  # noqa
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
 if PY2:
     exec('def reraise(tp, value, tb):\n raise tp, value, tb')
 else:
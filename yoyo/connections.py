@@ -1,5 +1,12 @@
+import weakref
+
 _schemes = {}
 
+#: The URI each open connection was created from, for connections that
+#: cannot hold a ``yoyo_uri`` attribute, keyed by the id of the connection,
+#: as ``(weak reference, uri)``
+_uris = {}
+
 
 class BadConnectionURI(Exception):
     """
@@ -45,6 +52,7 @@ def connect_odbc(username, password, host, port, database, db_params):
 @connection_for('mysql')
 def connect_mysql(username, password, host, port, database, db_params):
     import MySQLdb
+    from MySQLdb.constants import CLIENT
 
     kwargs = {}
     if db_params is not None:
@@ -63,6 +71,9 @@ def connect_mysql(username, password, host, port, database, db_params):
     if port is not None:
         kwargs['port'] = port
     kwargs['db'] = database
+    # Batched transaction steps are sent as a single multi-statement query
+    kwargs['client_flag'] = kwargs.get('client_flag', 0) | \
+        CLIENT.MULTI_STATEMENTS
 
     return MySQLdb.connect(**kwargs), MySQLdb.paramstyle
 
@@ -93,6 +104,42 @@ def connect_postgres(username, password, host, port, database, db_params):
     return psycopg2.connect(' '.join(connargs)), psycopg2.paramstyle
 
 
+@connection_for('fake')
+def connect_fake(username, password, host, port, database, db_params):
+    from yoyo import fakedb
+
+    kwargs = {}
+    if db_params is not None:
+        for key, val in db_params.items():
+            kwargs[key] = float(val)
+    return fakedb.connect(database, **kwargs), fakedb.paramstyle
+
+
+#: Map the top level package of each DB-API driver to a backend name
+_backend_modules = {
+    'sqlite3': 'sqlite',
+    'psycopg2': 'postgresql',
+    'MySQLdb': 'mysql',
+    'pyodbc': 'odbc',
+}
+
+
+def get_backend(conn):
+    """
+    Return the name of the database backend for DB-API connection ``conn``:
+    one of ``'sqlite'``, ``'postgresql'``, ``'mysql'`` or ``'odbc'``.
+    Return ``None`` if the driver is not recognised.
+
+    Connection wrappers may declare their backend by setting a
+    ``yoyo_backend`` attribute.
+    """
+    module = type(conn).__module__.split('.')[0]
+    try:
+        return _backend_modules[module]
+    except KeyError:
+        return getattr(conn, 'yoyo_backend', None)
+
+
 def connect(uri):
     """
     Connect to the given DB uri in the format
@@ -106,7 +153,59 @@ def connect(uri):
     except KeyError:
         raise BadConnectionURI('Unrecognised database connection scheme %r' %
                                scheme)
-    return connection_func(username, password, host, port, database, db_params)
+    conn, paramstyle = connection_func(username, password, host, port,
+                                       database, db_params)
+    _remember_uri(conn, uri)
+    return conn, paramstyle
+
+
+def _remember_uri(conn, uri):
+    try:
+        conn.yoyo_uri = uri
+        return
+    except (AttributeError, TypeError):
+        # Some drivers' connections (eg psycopg2) do not take attributes
+        pass
+    key = id(conn)
+    try:
+        ref = weakref.ref(conn, lambda ref: _uris.pop(key, None))
+    except TypeError:
+        # sqlite3 connections take neither: connection_uri asks the
+        # database for its file name instead
+        return
+    _uris[key] = (ref, uri)
+
+
+def connection_uri(conn):
+    """
+    Return the URI that ``conn`` (or the connection it wraps) was opened
+    with by ``connect``, or ``None`` if it is not known. For SQLite
+    connections, return a URI for the database file, or ``None`` for an
+    in-memory database.
+    """
+    while conn is not None:
+        uri = getattr(conn, 'yoyo_uri', None)
+        if uri is not None:
+            return uri
+        ref, uri = _uris.get(id(conn), (None, None))
+        if ref is not None and ref() is conn:
+            return uri
+        if type(conn).__module__ == 'sqlite3':
+            return _sqlite_uri(conn)
+        conn = getattr(conn, '_conn', None)
+    return None
+
+
+def _sqlite_uri(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("PRAGMA database_list")
+        for seq, name, path in cursor.fetchall():
+            if name == 'main' and path:
+                return 'sqlite:///' + path
+    finally:
+        cursor.close()
+    return None
 
 
 def parse_uri(uri):
@@ -0,0 +1,346 @@
+"""
+Estimate how long pending migrations will take to apply.
+
+Each migration is profiled by the kind of operation it performs (building
+an index, rewriting a table, updating rows, running python code) and the
+number of rows and bytes in the tables it touches, read from the database's
+table statistics. The durations recorded in the migrations table for
+applied migrations give the time taken per row (or, for index builds and
+table rewrites, per byte where sizes are known) for each kind of operation,
+which is used to estimate the duration of each pending migration::
+
+    from yoyo.estimate import estimate
+
+    for e in estimate(migrations.to_apply(), history=migrations):
+        print(e)
+
+Table sizes are read when the estimate is made, not when historical
+migrations were applied, so estimates are a guide rather than a guarantee.
+"""
+from datetime import datetime, timedelta
+from logging import getLogger
+import re
+import sys
+import threading
+import time
+
+from yoyo.connections import get_backend
+from yoyo.migrations import IndexStep, step_statements
+from yoyo.utils import query
+
+logger = getLogger(__name__)
+
+#: Queries returning ``(table, rows, bytes)`` for every table, for each
+#: backend. Row counts are the planner's estimates, so no table is scanned.
+table_statistics_queries = {
+    'postgresql': (
+        "SELECT c.relname, c.reltuples, pg_total_relation_size(c.oid) "
+        "FROM pg_catalog.pg_class c "
+        "JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relkind = 'r' AND n.nspname = current_schema()"),
+    'mysql': (
+        "SELECT table_name, table_rows, data_length + index_length "
+        "FROM information_schema.tables "
+        "WHERE table_schema = DATABASE() AND table_type = 'BASE TABLE'"),
+}
+
+#: Patterns classifying SQL statements by the kind of operation, checked in
+#: order. Statements matching none are assumed to take constant time.
+operation_patterns = [
+    ('index', re.compile(r'^\s*CREATE\s+(UNIQUE\s+)?INDEX\b', re.I)),
+    ('rewrite', re.compile(r'^\s*(ALTER\s+TABLE|VACUUM|CLUSTER|OPTIMIZE)\b',
+                           re.I)),
+    ('update', re.compile(r'^\s*(UPDATE|DELETE|INSERT)\b', re.I)),
+]
+
+#: Kinds of operation whose duration depends on the size of the tables
+#: touched rather than their number of rows
+size_operations = set(['index', 'rewrite'])
+
+
+class TableStats(object):
+
+    def __init__(self, rows, bytes=None):
+        self.rows = max(int(rows or 0), 0)
+        self.bytes = int(bytes) if bytes is not None else None
+
+
+def table_statistics(conn):
+    """
+    Return a dict mapping lower case table names to ``TableStats``.
+
+    On SQLite row counts are read from ``sqlite_stat1``, which is only
+    populated by ``ANALYZE``: tables that have not been analyzed are
+    omitted rather than counted.
+    """
+    backend = get_backend(conn)
+    if backend in table_statistics_queries:
+        return dict((name.lower(), TableStats(rows, bytes))
+                    for name, rows, bytes in
+                    query(conn, table_statistics_queries[backend]))
+    if backend == 'sqlite':
+        if not query(conn, "SELECT 1 FROM sqlite_master "
+                            "WHERE name = 'sqlite_stat1'"):
+            return {}
+        stats = {}
+        # The first number in each ``stat`` is the number of rows
+        for name, stat in query(conn, "SELECT tbl, stat FROM sqlite_stat1"):
+            rows = int(stat.split()[0])
+            stats[name.lower()] = TableStats(
+                max(rows, stats[name.lower()].rows)
+                if name.lower() in stats else rows)
+        return stats
+    logger.warning("Table statistics are not supported for %s", backend)
+    return {}
+
+
+def recorded_durations(conn, migration_table):
+    """
+    Return a dict mapping the id of each applied migration to the duration
+    recorded when it was applied, for those with a recorded duration.
+    """
+    return dict((id, duration) for id, duration in
+                query(conn, "SELECT id, duration FROM " + migration_table)
+                if duration is not None)
+
+
+def _operations(step):
+    """
+    Yield the kind of operation performed by each statement in ``step``.
+    """
+    for inner, sql in step_statements(step):
+        if isinstance(inner, IndexStep):
+            yield 'index'
+        elif sql is not None:
+            for operation, pattern in operation_patterns:
+                if pattern.search(sql):
+                    yield operation
+                    break
+        elif getattr(inner, '_apply', None):
+            yield 'python'
+
+
+class Estimate(object):
+    """
+    The estimated duration of a migration, in seconds. ``seconds`` is
+    ``None`` if there is no history to base an estimate on.
+    """
+
+    def __init__(self, migration, seconds, operation, rows, bytes=None):
+        self.migration = migration
+        self.seconds = seconds
+        #: The most expensive kind of operation in the migration
+        self.operation = operation
+        #: The number of rows in the tables touched by that operation
+        self.rows = rows
+        #: The size of those tables, or ``None`` if not known
+        self.bytes = bytes
+
+    def __str__(self):
+        if self.operation is None:
+            return '%s: %s' % (self.migration.id,
+                               format_duration(self.seconds))
+        return '%s: %s (%s, %d rows)' % (
+            self.migration.id, format_duration(self.seconds),
+            self.operation, self.rows)
+
+
+class Estimator(object):
+    """
+    Estimate migration durations from ``stats``, a dict of ``TableStats``
+    as returned by ``table_statistics``.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.patterns = dict(
+            (table, re.compile(r'\b%s\b' % re.escape(table), re.I))
+            for table in stats)
+        #: Seconds per row (or per byte, see ``size_operations``) for each
+        #: kind of operation
+        self.rates = {}
+        #: Mean duration for each kind of operation, used for migrations
+        #: touching no rows
+        self.means = {}
+        self.mean = None
+
+    def profile(self, migration):
+        """
+        Return the most expensive kind of operation in ``migration``, and
+        the number of rows and bytes (``None`` if not known) in the tables
+        it touches.
+        """
+        best = (None, 0, None)
+        for step in migration.steps:
+            operations = set(_operations(step))
+            if not operations:
+                continue
+            touched = [s for table, s in self.stats.items()
+                       if step.references(self.patterns[table])]
+            rows = sum(s.rows for s in touched)
+            bytes = None
+            if touched and all(s.bytes is not None for s in touched):
+                bytes = sum(s.bytes for s in touched)
+            for operation in operations:
+                if best[0] is None or rows > best[1]:
+                    best = (operation, rows, bytes)
+        return best
+
+    def _amount(self, operation, rows, bytes):
+        """
+        Return the measure of work that the duration of ``operation`` is
+        proportional to.
+        """
+        if operation in size_operations and bytes is not None:
+            return bytes
+        return rows
+
+    def fit(self, history):
+        """
+        Learn the time taken per row for each kind of operation from
+        ``history``, a sequence of ``(migration, duration)`` pairs.
+        """
+        durations = {}
+        rows = {}
+        counts = {}
+        total = 0.0
+        for migration, duration in history:
+            operation, n, bytes = self.profile(migration)
+            durations[operation] = durations.get(operation, 0.0) + duration
+            rows[operation] = rows.get(operation, 0) + \
+                self._amount(operation, n, bytes)
+            counts[operation] = counts.get(operation, 0) + 1
+            total += duration
+        for operation in durations:
+            self.means[operation] = durations[operation] / counts[operation]
+            if rows[operation]:
+                self.rates[operation] = durations[operation] / rows[operation]
+        if counts:
+            self.mean = total / sum(counts.values())
+
+    def estimate(self, migration):
+        operation, rows, bytes = self.profile(migration)
+        amount = self._amount(operation, rows, bytes)
+        if amount and operation in self.rates:
+            seconds = amount * self.rates[operation]
+        else:
+            seconds = self.means.get(operation, self.mean)
+        return Estimate(migration, seconds, operation, rows, bytes)
+
+
+def estimate(migrations, history=()):
+    """
+    Return an ``Estimate`` for each migration in the ``MigrationList``
+    ``migrations``, based on the recorded durations of the applied
+    migrations in ``history``.
+    """
+    conn = migrations.conn
+    estimator = Estimator(table_statistics(conn))
+    durations = recorded_durations(conn, migrations.migration_table)
+    estimator.fit((m, durations[m.id]) for m in history if m.id in durations)
+    return [estimator.estimate(m) for m in migrations]
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%ds' % seconds
+
+
+class Progress(object):
+    """
+    Display the progress of ``MigrationList.apply`` with the time remaining
+    and the estimated time of completion.
+
+    ``estimates`` is a list of ``Estimate`` objects. When ``out`` is a
+    terminal the display is redrawn every ``interval`` seconds; otherwise a
+    line is written as each migration starts.
+    """
+
+    def __init__(self, estimates=(), out=sys.stderr, interval=1.0):
+        self.estimates = dict((e.migration.id, e.seconds or 0.0)
+                              for e in estimates)
+        self.out = out
+        self.interval = interval
+        self.live = hasattr(out, 'isatty') and out.isatty()
+        self.migrations = []
+        self.current = None
+        self.done = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, migrations):
+        self.migrations = list(migrations)
+        self.done = 0
+        self.started = time.time()
+        self.stopped.clear()
+        if self.live:
+            self.thread = threading.Thread(target=self._redraw)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def begin(self, migration):
+        with self.lock:
+            self.current = migration
+            self.current_started = time.time()
+        self._draw()
+
+    def end(self, migration):
+        with self.lock:
+            self.current = None
+            self.done += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.live:
+            self.out.write('\n')
+            self.out.flush()
+
+    def remaining(self):
+        """
+        Return the estimated number of seconds until all migrations are
+        applied.
+        """
+        pending = self.migrations[self.done:]
+        remaining = sum(self.estimates.get(m.id, 0.0) for m in pending)
+        if self.current is not None:
+            elapsed = time.time() - self.current_started
+            current = self.estimates.get(self.current.id, 0.0)
+            remaining -= min(elapsed, current)
+        return remaining
+
+    def status(self):
+        with self.lock:
+            current = self.current
+            remaining = self.remaining()
+        line = '[%d/%d]' % (self.done + (current is not None),
+                            len(self.migrations))
+        if current is not None:
+            line += ' %s %s' % (current.id, format_duration(
+                time.time() - self.current_started))
+        line += ', elapsed %s' % format_duration(time.time() - self.started)
+        if self.estimates:
+            finish = datetime.now() + timedelta(seconds=remaining)
+            line += ', about %s remaining (ETA %s)' % (
+                format_duration(remaining), finish.strftime('%H:%M:%S'))
+        return line
+
+    def _draw(self):
+        if self.live:
+            self.out.write('\r\033[K' + self.status())
+        else:
+            self.out.write(self.status() + '\n')
+        self.out.flush()
+
+    def _redraw(self):
+        while not self.stopped.wait(self.interval):
+            self._draw()
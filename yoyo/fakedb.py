@@ -0,0 +1,130 @@
+"""
+A fake DB-API driver for measuring the database round trips made by yoyo.
+
+Connections are backed by SQLite, so SQL executes normally, but each query,
+commit and rollback can be delayed to simulate the latency of a remote
+database server. Every round trip is recorded in the connection's ``trace``.
+
+The driver is registered with ``yoyo.connections`` under the ``fake``
+scheme. Latencies (in seconds) are given as connection parameters::
+
+    conn, paramstyle = connect('fake:///:memory:?query_latency=0.005'
+                               '&commit_latency=0.02')
+
+Tests can assert that an operation stays within a round trip budget::
+
+    with conn.budget(queries=2, commits=0):
+        migrations.to_apply()
+"""
+from contextlib import contextmanager
+import sqlite3
+import time
+
+# Exported for ``yoyo.migrations.initialize_connection``
+from sqlite3 import DatabaseError  # noqa
+
+paramstyle = 'qmark'
+
+#: Trace entry kinds that count as queries
+query_kinds = ('execute', 'executemany')
+
+
+class RoundTripBudgetExceeded(AssertionError):
+    """
+    More round trips were made than allowed by ``Connection.budget``
+    """
+
+
+class Connection(object):
+
+    yoyo_backend = 'sqlite'
+
+    def __init__(self, conn, query_latency=0, commit_latency=0):
+        self._conn = conn
+        self.query_latency = query_latency
+        self.commit_latency = commit_latency
+
+        #: A list of ``(kind, statement)`` tuples, one for each round trip.
+        #: ``kind`` is one of 'execute', 'executemany', 'commit' or
+        #: 'rollback'.
+        self.trace = []
+
+    def cursor(self):
+        return Cursor(self, self._conn.cursor())
+
+    def commit(self):
+        self.roundtrip('commit', None, self.commit_latency)
+        self._conn.commit()
+
+    def rollback(self):
+        self.roundtrip('rollback', None, self.commit_latency)
+        self._conn.rollback()
+
+    def roundtrip(self, kind, statement, latency):
+        self.trace.append((kind, statement))
+        if latency:
+            time.sleep(latency)
+
+    def counts(self, since=0):
+        """
+        Return a dict counting the queries, commits, rollbacks and total
+        round trips recorded in the trace after position ``since``.
+        """
+        entries = self.trace[since:]
+        kinds = [kind for kind, statement in entries]
+        return {
+            'queries': sum(1 for kind in kinds if kind in query_kinds),
+            'commits': kinds.count('commit'),
+            'rollbacks': kinds.count('rollback'),
+            'roundtrips': len(kinds),
+        }
+
+    @contextmanager
+    def budget(self, **limits):
+        """
+        Raise ``RoundTripBudgetExceeded`` if the code run in the ``with``
+        block makes more round trips than allowed by ``limits``, which may
+        give maximum numbers of ``queries``, ``commits``, ``rollbacks`` or
+        ``roundtrips``.
+        """
+        since = len(self.trace)
+        yield
+        counts = self.counts(since)
+        exceeded = ['%s: %d > %d' % (k, counts[k], limit)
+                    for k, limit in sorted(limits.items())
+                    if counts[k] > limit]
+        if exceeded:
+            raise RoundTripBudgetExceeded(
+                "Round trip budget exceeded (%s). Trace:\n%s" % (
+                    ', '.join(exceeded),
+                    '\n'.join('  %s %s' % (kind, statement or '')
+                              for kind, statement in self.trace[since:])))
+
+    def __getattr__(self, attr):
+        return getattr(self._conn, attr)
+
+
+class Cursor(object):
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self._cursor = cursor
+
+    def execute(self, stmt, params=()):
+        self.connection.roundtrip('execute', stmt,
+                                  self.connection.query_latency)
+        self._cursor.execute(stmt, params)
+        return self
+
+    def executemany(self, stmt, seq_of_params):
+        self.connection.roundtrip('executemany', stmt,
+                                  self.connection.query_latency)
+        self._cursor.executemany(stmt, seq_of_params)
+        return self
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+
+def connect(database=':memory:', query_latency=0, commit_latency=0):
+    return Connection(sqlite3.connect(database), query_latency, commit_latency)
@@ -0,0 +1,254 @@
+"""
+Helpers for python migration steps.
+"""
+from datetime import datetime
+from itertools import count
+from logging import getLogger
+import hashlib
+import sys
+import threading
+
+from yoyo.compat import reraise
+from yoyo.connections import connection_uri, get_backend
+from yoyo.migrations import current_migration
+from yoyo.utils import query, run_in_threads
+
+logger = getLogger(__name__)
+
+_cursor_names = count(1)
+
+#: Placeholders used in place of ``?`` for each backend
+placeholders = {
+    'postgresql': '%s',
+    'mysql': '%s',
+}
+
+default_checkpoint_table = '_yoyo_backfill'
+
+
+def _fetch_chunks(cursor, sql, params, chunk):
+    try:
+        if params is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+def _stream_postgresql(conn, sql, params, chunk):
+    # A named cursor is held open on the server, which sends ``chunk`` rows
+    # at a time. It is closed when the transaction ends.
+    cursor = conn.cursor(name='yoyo_stream_%d' % next(_cursor_names))
+    cursor.itersize = chunk
+    return _fetch_chunks(cursor, sql, params, chunk)
+
+
+def _stream_mysql(conn, sql, params, chunk):
+    from MySQLdb.cursors import SSCursor
+    return _fetch_chunks(conn.cursor(SSCursor), sql, params, chunk)
+
+
+def _stream_default(conn, sql, params, chunk):
+    # sqlite3 (and most other drivers) step through results as rows are
+    # fetched
+    return _fetch_chunks(conn.cursor(), sql, params, chunk)
+
+
+#: Functions returning a streaming iterator over query results for each
+#: backend
+_streamers = {
+    'postgresql': _stream_postgresql,
+    'mysql': _stream_mysql,
+}
+
+
+def stream_rows(conn, sql, params=None, chunk=1000):
+    """
+    Execute ``sql`` and return an iterator over the rows of the result,
+    fetching ``chunk`` rows at a time so that memory use stays constant
+    however many rows are returned. As in steps, ``?`` is used as the
+    placeholder for ``params`` on every backend.
+
+    On PostgreSQL this uses a named server side cursor, which does not
+    survive the end of the transaction. On MySQL this uses an unbuffered
+    ``SSCursor``: no other queries may be run on ``conn`` until all rows have
+    been read.
+    """
+    streamer = _streamers.get(get_backend(conn), _stream_default)
+    if params is not None:
+        sql = _with_placeholders(conn, sql)
+    return streamer(conn, sql, params, chunk)
+
+
+def _with_placeholders(conn, sql):
+    return sql.replace('?', placeholders.get(get_backend(conn), '?'))
+
+
+def _execute(conn, sql, params=()):
+    return query(conn, _with_placeholders(conn, sql), params)
+
+
+def _backfill_name(table, key, fn_or_sql, name=None):
+    """
+    Return the name identifying a backfill in the checkpoint table: ``name``
+    if given, else one derived from ``table``, ``key`` and ``fn_or_sql``,
+    prefixed by the id of the migration being run.
+    """
+    if name is None:
+        if callable(fn_or_sql):
+            label = getattr(fn_or_sql, '__name__', '<lambda>')
+            if label == '<lambda>':
+                # Every lambda (or partial) would share its checkpoints
+                raise ValueError("parallel_backfill requires a name for "
+                                 "anonymous functions")
+        else:
+            label = hashlib.sha1(fn_or_sql.encode('utf-8')).hexdigest()[:12]
+        name = '%s.%s:%s' % (table, key, label)
+    migration = current_migration()
+    if migration is not None:
+        name = '%s:%s' % (migration.id, name)
+    return name
+
+
+def _create_checkpoint_table(conn, checkpoint_table):
+    _execute(conn, "CREATE TABLE IF NOT EXISTS %s ("
+                   "name VARCHAR(255) NOT NULL, lo BIGINT NOT NULL, "
+                   "hi BIGINT NOT NULL, ctime TIMESTAMP, "
+                   "PRIMARY KEY (name, lo))" % checkpoint_table)
+    conn.commit()
+
+
+def _backfill_range(conn, fn_or_sql, lo, hi, checkpoint_table, name):
+    """
+    Backfill the key range ``[lo, hi)`` and record it as completed, in one
+    transaction.
+    """
+    try:
+        if callable(fn_or_sql):
+            fn_or_sql(conn, lo, hi)
+        else:
+            _execute(conn, fn_or_sql, (lo, hi))
+        _execute(conn, "INSERT INTO %s (name, lo, hi, ctime) "
+                       "VALUES (?, ?, ?, ?)" % checkpoint_table,
+                 (name, lo, hi, datetime.utcnow()))
+        conn.commit()
+    except Exception:
+        exc_info = sys.exc_info()
+        conn.rollback()
+        reraise(exc_info[0], exc_info[1], exc_info[2])
+
+
+def parallel_backfill(conn, table, key, fn_or_sql, workers=4, chunk=10000,
+                      name=None, progress=None,
+                      checkpoint_table=default_checkpoint_table):
+    """
+    Backfill ``table`` in chunks of ``chunk`` values of the integer column
+    ``key``, running ``workers`` chunks at a time on separate connections.
+
+    ``fn_or_sql`` is either an SQL statement with two ``?`` placeholders
+    for the lower (inclusive) and upper (exclusive) bounds of a key range,
+    eg ``"UPDATE t SET b = a * 2 WHERE id >= ? AND id < ?"``, or a function
+    called as ``fn(conn, lo, hi)``.
+
+    Each chunk is committed together with a checkpoint recording it in
+    ``checkpoint_table``, so an interrupted backfill resumes where it left
+    off when run again. The checkpoints are deleted once every chunk is
+    complete. Backfills are identified by ``name`` and the id of the
+    migration. ``name`` defaults to a name derived from ``table``, ``key``
+    and ``fn_or_sql``, and must be given if ``fn_or_sql`` is a lambda.
+    Because chunks are committed separately, ``conn`` is committed before
+    the backfill starts and the backfill is not undone if the migration
+    later fails.
+
+    Worker connections are opened with the URI ``conn`` was connected with.
+    If it is not known (or the database is an SQLite ``:memory:``
+    database), chunks are run one at a time on ``conn``. They are also run
+    one at a time when all migrations are applied in a single transaction
+    (``--to`` or ``--bootstrap``): commits are deferred until the end, so
+    other connections would not see the migration's changes and chunks
+    could not be checkpointed separately.
+
+    ``progress``, if given, is called as ``progress(completed, total)`` as
+    each chunk completes. Return the number of chunks backfilled.
+    """
+    name = _backfill_name(table, key, fn_or_sql, name)
+    _create_checkpoint_table(conn, checkpoint_table)
+
+    (lo, hi), = _execute(conn, "SELECT MIN(%s), MAX(%s) FROM %s" %
+                         (key, key, table))
+    if lo is None:
+        return 0
+    done = set(row[0] for row in _execute(
+        conn, "SELECT lo FROM %s WHERE name = ?" % checkpoint_table, (name,)))
+    ranges = [(n, min(n + chunk, hi + 1))
+              for n in range(int(lo), int(hi) + 1, chunk)
+              if n not in done]
+    total = len(ranges)
+    if done:
+        logger.info("Resuming backfill %s: %d of %d chunks remaining",
+                    name, total, total + len(done))
+
+    uri = connection_uri(conn)
+    if uri is not None and ':memory:' in uri:
+        uri = None
+    if getattr(conn, 'batch_commit', False):
+        logger.warning("Backfill %s is part of a single transaction: "
+                       "running chunks serially", name)
+        uri = None
+    workers = min(workers, total) if uri is not None else 1
+
+    state = {'completed': 0}
+    lock = threading.Lock()
+
+    def work(conn, bounds):
+        lo, hi = bounds
+        _backfill_range(conn, fn_or_sql, lo, hi, checkpoint_table, name)
+        with lock:
+            state['completed'] += 1
+            logger.debug("Backfill %s: %d of %d chunks complete",
+                         name, state['completed'], total)
+            if progress is not None:
+                progress(state['completed'], total)
+
+    if workers <= 1:
+        for bounds in ranges:
+            work(conn, bounds)
+    else:
+        run_in_threads(uri, ranges, work, workers)
+    _delete_checkpoints(conn, checkpoint_table, name)
+    logger.info("Backfill %s: %d chunks complete", name, state['completed'])
+    return state['completed']
+
+
+def _delete_checkpoints(conn, checkpoint_table, name):
+    _execute(conn, "DELETE FROM %s WHERE name = ?" % checkpoint_table,
+             (name,))
+    conn.commit()
+
+
+def clear_backfill(conn, name=None,
+                   checkpoint_table=default_checkpoint_table):
+    """
+    Delete the checkpoints of the backfill ``name`` run by the current
+    migration, or of every backfill it has run if ``name`` is not given, so
+    that the backfill starts again from the beginning when the migration is
+    next applied. Use it as the rollback of a ``parallel_backfill`` step::
+
+        step(backfill, clear_backfill)
+    """
+    migration = current_migration()
+    prefix = '%s:' % migration.id if migration is not None else ''
+    _create_checkpoint_table(conn, checkpoint_table)
+    if name is not None:
+        _delete_checkpoints(conn, checkpoint_table, prefix + name)
+        return
+    _execute(conn, "DELETE FROM %s WHERE SUBSTR(name, 1, %d) = ?" %
+             (checkpoint_table, len(prefix)), (prefix,))
+    conn.commit()
@@ -1,18 +1,91 @@
 from datetime import datetime
-from itertools import count
+from itertools import count, islice
 from logging import getLogger
+import hashlib
 import os
+import re
+import socket
 import sys
 import inspect
+import threading
+import time
+import uuid
 
-from yoyo.compat import reraise, exec_, ustr
+from yoyo import catalog
+from yoyo.compat import reraise, exec_, ustr, scandir
+from yoyo.connections import get_backend
 from yoyo.exceptions import DatabaseError
-from yoyo.utils import plural
+from yoyo.resources import ResourceProfiles, SessionSettings
+from yoyo.timeouts import SessionTimeouts, is_lock_timeout
+from yoyo.utils import plural, query
 
 logger = getLogger(__name__)
 default_migration_table = '_yoyo_migration'
+
+#: Columns of the migrations table, in the order they were introduced
+migration_table_columns = [
+    ('id', 'VARCHAR(255) NOT NULL PRIMARY KEY'),
+    ('ctime', 'TIMESTAMP'),
+    ('hash', 'VARCHAR(64)'),
+    ('duration', 'FLOAT'),
+    ('hostname', 'VARCHAR(255)'),
+    ('batch_id', 'VARCHAR(32)'),
+]
+
+#: Indexes on the migrations table, as ``(name suffix, column)`` pairs
+migration_table_indexes = [
+    ('ctime_idx', 'ctime'),
+    ('batch_id_idx', 'batch_id'),
+]
+
+#: Incremented whenever the columns or indexes above change. Version 1 is the
+#: original ``(id, ctime)`` table; version 2 added ``hash``; version 3 added
+#: ``duration``, ``hostname`` and ``batch_id`` and the indexes; version 4
+#: added the ``<table>_hooks`` table recording when post-apply hooks last
+#: ran.
+migration_table_schema_version = 4
+
+#: Backends that can roll back schema changes made within a transaction
+transactional_ddl_backends = set(['sqlite', 'postgresql'])
+
+#: Statements required to open a transaction explicitly, for drivers that do
+#: not begin one before DDL statements
+begin_transaction_statements = {
+    'sqlite': 'BEGIN',
+}
+
 _step_collectors = {}
 
+#: Resource profiles used when none are configured
+default_resource_profiles = ResourceProfiles()
+
+#: The migration whose steps are being run, for each thread
+_running = threading.local()
+
+
+def current_migration():
+    """
+    Return the ``Migration`` whose steps are being run in this thread, or
+    ``None``.
+    """
+    return getattr(_running, 'migration', None)
+
+#: Sort keys for each order in which migrations may be applied, taking a
+#: migration id. ``natural`` compares runs of digits numerically, so that
+#: '2.foo' sorts before '10.foo'; ``numeric`` orders by the leading number of
+#: each id, placing ids without one last.
+sort_keys = {
+    'lexical': lambda id: id,
+    'natural': lambda id: [int(part) if ix % 2 else part
+                           for ix, part in enumerate(re.split(r'(\d+)', id))],
+    'numeric': lambda id: ((0, int(re.match(r'\d+', id).group()), id)
+                           if re.match(r'\d+', id) else (1, 0, id)),
+}
+
+#: Cached listings of migration directories, mapping ``(directory, order)``
+#: to the directory's modification time and the sorted script names
+_script_index = {}
+
 
 def with_placeholders(conn, paramstyle, sql):
     placeholder_gen = {
@@ -27,10 +100,40 @@ def with_placeholders(conn, paramstyle, sql):
 
 class Migration(object):
 
-    def __init__(self, id, steps, source):
+    #: Time taken in seconds to read the migration script and load its steps
+    load_time = 0.0
+
+    def __init__(self, id, steps, source, path=None):
         self.id = id
-        self.steps = steps
+        self._steps = steps
         self.source = source
+        self.path = path
+        self._hash = None
+
+    @property
+    def steps(self):
+        """
+        The list of steps in the migration. If the migration was read without
+        loading its steps, the migration script is executed on first access.
+        """
+        if self._steps is None:
+            started = time.time()
+            self._steps = load_migration_steps(self.path, self.source)
+            self.load_time += time.time() - started
+        return self._steps
+
+    @property
+    def hash(self):
+        """
+        Return a hash of the migration's source, used to detect migrations
+        that have been modified since they were applied.
+        """
+        if self._hash is None:
+            source = self.source
+            if isinstance(source, ustr):
+                source = source.encode('utf-8')
+            self._hash = hashlib.sha256(source).hexdigest()
+        return self._hash
 
     def isapplied(self, conn, paramstyle, migration_table):
         cursor = conn.cursor()
@@ -44,23 +147,44 @@ class Migration(object):
         finally:
             cursor.close()
 
-    def apply(self, conn, paramstyle, migration_table, force=False):
+    def apply(self, conn, paramstyle, migration_table, force=False,
+              batch_id=None, timeouts=None, merge_alters=False,
+              profiles=None):
         logger.info("Applying %s", self.id)
-        Migration._process_steps(self.steps, conn, paramstyle, 'apply',
-                                 force=force)
+        started = time.time()
+        steps = self.steps
+        if merge_alters:
+            steps = merge_alter_steps(steps, get_backend(conn))
+        _running.migration = self
+        try:
+            self._process_steps(steps, conn, paramstyle, 'apply', force,
+                                timeouts, profiles)
+        finally:
+            _running.migration = None
         cursor = conn.cursor()
         cursor.execute(
-            with_placeholders(conn, paramstyle, "INSERT INTO " +
-                              migration_table + " (id, ctime) VALUES (?, ?)"),
-            (self.id, datetime.utcnow())
+            with_placeholders(conn, paramstyle,
+                              "INSERT INTO " + migration_table +
+                              " (id, ctime, hash, duration, hostname,"
+                              " batch_id) VALUES (?, ?, ?, ?, ?, ?)"),
+            (self.id, datetime.utcnow(), self.hash, time.time() - started,
+             socket.gethostname(), batch_id)
         )
         conn.commit()
         cursor.close()
 
-    def rollback(self, conn, paramstyle, migration_table, force=False):
+    def rollback(self, conn, paramstyle, migration_table, force=False,
+                 timeouts=None, merge_alters=False, profiles=None):
         logger.info("Rolling back %s", self.id)
-        Migration._process_steps(reversed(self.steps), conn, paramstyle,
-                                 'rollback', force=force)
+        steps = self.steps
+        if merge_alters:
+            steps = merge_alter_steps(steps, get_backend(conn))
+        _running.migration = self
+        try:
+            self._process_steps(list(reversed(steps)), conn, paramstyle,
+                                'rollback', force, timeouts, profiles)
+        finally:
+            _running.migration = None
         cursor = conn.cursor()
         cursor.execute(
             with_placeholders(conn, paramstyle, "DELETE FROM " +
@@ -71,38 +195,118 @@ class Migration(object):
         cursor.close()
 
     @staticmethod
-    def _process_steps(steps, conn, paramstyle, direction, force=False):
+    def _run_step(step, conn, paramstyle, direction, force, timeouts,
+                  session, settings, step_settings):
+        """
+        Run ``step``, retrying with exponential backoff if it cannot acquire
+        a lock within the lock timeout. The failed attempt has been rolled
+        back, so only ``step`` is run again.
+        """
+        attempt = 0
+        while True:
+            if session is not None:
+                session.set(timeouts.for_step(step))
+            settings.set(step_settings)
+            try:
+                return getattr(step, direction)(conn, paramstyle, force)
+            except DatabaseError:
+                exc_info = sys.exc_info()
+                if timeouts is None or attempt >= timeouts.retries or \
+                        getattr(conn, 'batch_commit', False) or \
+                        not is_lock_timeout(conn, exc_info[1]):
+                    reraise(exc_info[0], exc_info[1], exc_info[2])
+            conn.rollback()
+            # Settings changed in the rolled back transaction may have been
+            # undone: set them again
+            session.reset()
+            settings.reset()
+            delay = timeouts.delay(attempt)
+            attempt += 1
+            logger.warning("Lock timeout, retrying step in %.1fs "
+                           "(attempt %d of %d)", delay, attempt,
+                           timeouts.retries)
+            time.sleep(delay)
+
+    @staticmethod
+    def _process_steps(steps, conn, paramstyle, direction, force=False,
+                       timeouts=None, profiles=None):
 
         reverse = {
             'rollback': 'apply',
             'apply': 'rollback',
         }[direction]
 
+        session = SessionTimeouts(conn) if timeouts is not None else None
+        profiles = profiles or default_resource_profiles
+        settings = SessionSettings(conn)
+        backend = get_backend(conn)
         executed_steps = []
-        for step in steps:
-            try:
-                getattr(step, direction)(conn, paramstyle, force)
-                executed_steps.append(step)
-            except DatabaseError:
-                conn.rollback()
-                exc_info = sys.exc_info()
+        try:
+            for step in steps:
                 try:
-                    for step in reversed(executed_steps):
-                        getattr(step, reverse)(conn, paramstyle)
+                    Migration._run_step(step, conn, paramstyle, direction,
+                                        force, timeouts, session, settings,
+                                        profiles.for_step(step, backend))
+                    executed_steps.append(step)
                 except DatabaseError:
-                    logger.exception(
-                        'Database error when reversing %s of step', direction)
-                reraise(exc_info[0], exc_info[1], exc_info[2])
+                    conn.rollback()
+                    exc_info = sys.exc_info()
+                    if getattr(conn, 'batch_commit', False):
+                        # Rolling back the batch has discarded every step
+                        reraise(exc_info[0], exc_info[1], exc_info[2])
+                    try:
+                        for step in reversed(executed_steps):
+                            getattr(step, reverse)(conn, paramstyle)
+                    except DatabaseError:
+                        logger.exception(
+                            'Database error when reversing %s of step',
+                            direction)
+                    reraise(exc_info[0], exc_info[1], exc_info[2])
+        finally:
+            if session is not None:
+                session.reset()
+            settings.reset()
 
 
 class PostApplyHookMigration(Migration):
     """
     A special migration that is run after successfully applying a set of
     migrations. Unlike a normal migration this will be run every time
-    migrations are applied script is called.
+    migrations are applied script is called, unless it declares its
+    dependencies with ``depends_on``.
     """
 
-    def apply(self, conn, paramstyle, migration_table, force=False):
+    @property
+    def dependencies(self):
+        """
+        The ``(tables, migration_patterns)`` declared by the hook's call to
+        ``depends_on``, or ``None`` if the hook does not declare any.
+        """
+        self.steps  # Ensure the hook script has been loaded
+        collector = _step_collectors.get(self.path)
+        return collector.dependencies if collector else None
+
+    def is_relevant(self, migrations):
+        """
+        Return true if any of ``migrations`` matches the hook's declared
+        dependencies, or if the hook declares none.
+        """
+        if self.dependencies is None:
+            return True
+        tables, patterns = self.dependencies
+        table_pattern = re.compile(
+            r'\b(%s)\b' % '|'.join(re.escape(t) for t in tables),
+            re.I) if tables else None
+        for m in migrations:
+            if any(re.search(p, m.id) for p in patterns):
+                return True
+            if table_pattern and \
+                    any(step.references(table_pattern) for step in m.steps):
+                return True
+        return False
+
+    def apply(self, conn, paramstyle, migration_table, force=False,
+              batch_id=None):
         logger.info("Applying %s", self.id)
         self.__class__._process_steps(
             self.steps,
@@ -125,12 +329,28 @@ class PostApplyHookMigration(Migration):
 
 class StepBase(object):
 
+    #: Lock and statement timeouts for the step in seconds, overriding any
+    #: global timeouts
+    lock_timeout = None
+    statement_timeout = None
+
+    #: The name of the resource profile applied while the step runs
+    resource_profile = None
+
     def apply(self, conn, paramstyle, force=False):
         raise NotImplementedError()
 
     def rollback(self, conn, paramstyle, force=False):
         raise NotImplementedError()
 
+    def references(self, pattern):
+        """
+        Return true if the step may touch a database object whose name
+        matches the compiled regular expression ``pattern``. Steps that
+        cannot be inspected are assumed to touch everything.
+        """
+        return True
+
 
 class Transaction(StepBase):
     """
@@ -138,35 +358,307 @@ class Transaction(StepBase):
     single database transaction.
     """
 
-    def __init__(self, steps, ignore_errors=None):
+    def __init__(self, steps, ignore_errors=None, lock_timeout=None,
+                 statement_timeout=None, resource_profile=None):
         assert ignore_errors in (None, 'all', 'apply', 'rollback')
         self.steps = steps
         self.ignore_errors = ignore_errors
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.resource_profile = resource_profile
 
     def apply(self, conn, paramstyle, force=False):
+        self._run(conn, paramstyle, 'apply', self.steps, force)
 
-        for step in self.steps:
+    def references(self, pattern):
+        return any(step.references(pattern) for step in self.steps)
+
+    def rollback(self, conn, paramstyle, force=False):
+        self._run(conn, paramstyle, 'rollback', list(reversed(self.steps)),
+                  force)
+
+    def _run(self, conn, paramstyle, direction, steps, force):
+        """
+        Run ``steps`` in ``direction``. Where the backend supports it,
+        consecutive plain SQL steps are sent to the database in a single
+        round trip.
+        """
+        backend = get_backend(conn)
+        execute_batch = batch_executors.get(backend)
+        if execute_batch is None:
+            batches = [[step] for step in steps]
+        else:
+            batches = _coalesce(steps, direction)
+        ignore_errors = force or self.ignore_errors in (direction, 'all')
+        # Outside a batch transaction the work of earlier transactions is
+        # already committed, and steps may commit (destroying any savepoint),
+        # so rolling back is enough
+        savepoint = ignore_errors and backend in savepoint_backends and \
+            getattr(conn, 'batch_commit', False)
+        if savepoint:
+            query(conn, 'SAVEPOINT yoyo_ignore_errors')
+        for batch in batches:
+            step = batch[0]
             try:
-                step.apply(conn, paramstyle, force)
+                if len(batch) == 1:
+                    getattr(step, direction)(conn, paramstyle, force)
+                    continue
+                logger.info(" - %s steps %s in one batch",
+                            'applying' if direction == 'apply'
+                            else 'rolling back',
+                            ', '.join(str(s.id) for s in batch))
+                statements = [s.batch_sql(direction) for s in batch]
+                if any(catalog.changes_schema(sql) for sql in statements):
+                    catalog.invalidate(conn)
+                try:
+                    execute_batch(conn, statements)
+                except _BatchFailed as e:
+                    step = batch[e.index]
+                    reraise(*e.exc_info)
             except DatabaseError:
-                conn.rollback()
-                if force or self.ignore_errors in ('apply', 'all'):
-                    logger.exception("Ignored error in step %d", step.id)
-                    return
-                raise
+                if not ignore_errors:
+                    conn.rollback()
+                    raise
+                logger.exception("Ignored error in step %d", step.id)
+                if savepoint:
+                    # Discard only the work done by this transaction
+                    query(conn, 'ROLLBACK TO SAVEPOINT yoyo_ignore_errors')
+                    query(conn, 'RELEASE SAVEPOINT yoyo_ignore_errors')
+                    conn.commit()
+                else:
+                    conn.rollback()
+                return
+        if savepoint:
+            query(conn, 'RELEASE SAVEPOINT yoyo_ignore_errors')
         conn.commit()
 
-    def rollback(self, conn, paramstyle, force=False):
-        for step in reversed(self.steps):
+
+def _coalesce(steps, direction):
+    """
+    Group ``steps`` into lists of consecutive steps that can be sent to the
+    database in a single batch.
+    """
+    batches = []
+    for step in steps:
+        if batches and step.batch_sql(direction) is not None and \
+                batches[-1][-1].batch_sql(direction) is not None:
+            batches[-1].append(step)
+        else:
+            batches.append([step])
+    return batches
+
+
+class _BatchFailed(Exception):
+    """
+    Raised by batch executors when the statement at ``index`` in a batch
+    fails, carrying the original exception info.
+    """
+
+    def __init__(self, index, exc_info):
+        super(_BatchFailed, self).__init__(index)
+        self.index = index
+        self.exc_info = exc_info
+
+
+def _execute_batch_postgresql(conn, statements):
+    """
+    Execute ``statements`` as a single multi-statement query. If the batch
+    fails, roll back to a savepoint taken at the start of the batch and
+    replay the statements one at a time to find the failing statement.
+    """
+    cursor = conn.cursor()
+    try:
+        try:
+            cursor.execute('SAVEPOINT yoyo_batch;\n' +
+                           ';\n'.join(statements))
+            cursor.execute('RELEASE SAVEPOINT yoyo_batch')
+            return
+        except DatabaseError:
+            cursor.execute('ROLLBACK TO SAVEPOINT yoyo_batch')
+        for ix, statement in enumerate(statements):
             try:
-                step.rollback(conn, paramstyle, force)
+                cursor.execute(statement)
             except DatabaseError:
-                conn.rollback()
-                if force or self.ignore_errors in ('rollback', 'all'):
-                    logger.exception("Ignored error in step %d", step.id)
-                    return
-                raise
-        conn.commit()
+                raise _BatchFailed(ix, sys.exc_info())
+        cursor.execute('RELEASE SAVEPOINT yoyo_batch')
+    finally:
+        cursor.close()
+
+
+def _execute_batch_mysql(conn, statements):
+    """
+    Execute ``statements`` as a single multi-statement query. The error for
+    a failing statement is raised when its result set is reached.
+
+    If the first statement fails the statements are replayed one at a time,
+    as the connection may not have been opened with the
+    ``CLIENT.MULTI_STATEMENTS`` flag, in which case the server rejects the
+    whole query without running any of it.
+    """
+    cursor = conn.cursor()
+    ix = 0
+    try:
+        try:
+            cursor.execute(';\n'.join(statements))
+            while True:
+                ix += 1
+                if not cursor.nextset():
+                    break
+            return
+        except DatabaseError:
+            if ix > 0:
+                raise _BatchFailed(ix, sys.exc_info())
+        for ix, statement in enumerate(statements):
+            try:
+                cursor.execute(statement)
+            except DatabaseError:
+                raise _BatchFailed(ix, sys.exc_info())
+    finally:
+        cursor.close()
+
+
+#: Backends supporting ALTER TABLE statements with multiple clauses
+alter_merge_backends = set(['mysql', 'postgresql'])
+
+_alter_table = re.compile(r'^\s*ALTER\s+TABLE\s+(IF\s+EXISTS\s+)?(ONLY\s+)?'
+                          r'([\w.`"]+)\s+(.*?)\s*;?\s*$', re.I | re.S)
+
+#: Text that may hide clauses from a simple parse (comments, string
+#: literals and quoted identifiers) or start a second statement. ALTER
+#: TABLE statements containing any of these are never merged.
+_unmergeable_alter = re.compile(r"--|/\*|#|'|\$|;|\"|`")
+
+#: ALTER TABLE clauses that must be the only clause in their statement:
+#: renames, moving a table to another schema, PostgreSQL ATTACH/DETACH
+#: PARTITION and the MySQL partitioning clauses (PARTITION BY, ADD/DROP/
+#: REORGANIZE/COALESCE/TRUNCATE/EXCHANGE/REBUILD ... PARTITION, REMOVE
+#: PARTITIONING and so on). Any mention of a partition is excluded.
+_standalone_alter = re.compile(r'^\s*(RENAME|SET\s+SCHEMA)\b|'
+                               r'\bPARTITION(S|ING)?\b', re.I)
+
+
+def _split_alter(sql):
+    """
+    Return a tuple of ``(table, clauses)`` if ``sql`` is a single ALTER TABLE
+    statement that may be merged with others, or ``None``.
+    """
+    if not isinstance(sql, (ustr, str)):
+        return None
+    match = _alter_table.match(sql)
+    if match is None:
+        return None
+    if_exists, only, name, clauses = match.groups()
+    if _unmergeable_alter.search(clauses) or \
+            _standalone_alter.search(clauses):
+        return None
+    # Modifiers are kept as part of the table, so that only statements with
+    # the same modifiers are merged
+    table = ''.join(['IF EXISTS ' if if_exists else '',
+                     'ONLY ' if only else '', name])
+    return table, clauses
+
+
+def _mergeable_alter(step):
+    """
+    Return ``(table, apply clauses, rollback clauses)`` if ``step`` is a
+    top level step running a single ALTER TABLE statement that may be merged
+    with others, or ``None``. Rollback clauses are ``None`` if the step has
+    no rollback.
+    """
+    if not isinstance(step, Transaction) or len(step.steps) != 1 or \
+            step.ignore_errors is not None or \
+            step.lock_timeout is not None or \
+            step.statement_timeout is not None:
+        return None
+    (inner,) = step.steps
+    if inner._params is not None or inner._rollback_params is not None or \
+            any(inner.preconditions.values()):
+        return None
+    apply = _split_alter(inner._apply)
+    if apply is None:
+        return None
+    if inner._rollback is None:
+        return apply[0], apply[1], None
+    rollback = _split_alter(inner._rollback)
+    if rollback is None or rollback[0] != apply[0]:
+        return None
+    return apply[0], apply[1], rollback[1]
+
+
+def merge_alter_steps(steps, backend):
+    """
+    Return ``steps`` with runs of consecutive ALTER TABLE steps on the same
+    table merged into a single step, so that the table is only rebuilt once.
+    The merged rollback runs the rollback clauses in reverse order. Steps
+    are only merged if all or none of them have rollbacks.
+    """
+    if backend not in alter_merge_backends:
+        return steps
+    merged = []
+    run = []
+
+    def flush():
+        if len(run) == 1:
+            merged.append(run[0][0])
+        elif run:
+            table = run[0][1][0]
+            apply = 'ALTER TABLE %s %s' % (
+                table, ', '.join(alter[1] for step, alter in run))
+            rollback = None
+            if run[0][1][2] is not None:
+                rollback = 'ALTER TABLE %s %s' % (
+                    table, ', '.join(alter[2] for step, alter in
+                                     reversed(run)))
+            first = run[0][0].steps[0]
+            logger.info(" - merged steps %s: %s",
+                        ', '.join(str(step.steps[0].id) for step, _ in run),
+                        apply)
+            merged.append(Transaction(
+                [MigrationStep(first.id, apply, rollback)],
+                resource_profile=run[0][0].resource_profile))
+        del run[:]
+
+    for step in steps:
+        alter = _mergeable_alter(step)
+        if alter is not None and run and \
+                run[0][1][0] == alter[0] and \
+                (run[0][1][2] is None) == (alter[2] is None) and \
+                run[0][0].resource_profile == step.resource_profile:
+            run.append((step, alter))
+            continue
+        flush()
+        if alter is not None:
+            run.append((step, alter))
+        else:
+            merged.append(step)
+    flush()
+    return merged
+
+
+#: Backends supporting savepoints, used to roll back only the failed
+#: transaction when errors are ignored. MySQL is excluded as DDL statements
+#: commit implicitly, releasing any savepoint.
+savepoint_backends = set(['postgresql', 'sqlite'])
+
+#: Functions executing a list of SQL statements in one round trip for each
+#: backend. SQLite is not included: it runs in process, so gains nothing from
+#: batching, and ``executescript`` commits any open transaction.
+batch_executors = {
+    'postgresql': _execute_batch_postgresql,
+    'mysql': _execute_batch_mysql,
+}
+
+
+def _reusable_params(params):
+    """
+    Return ``params`` in a form that can be executed more than once.
+    Iterators and generators of parameter sets are read into a list, as a
+    step may be run again (eg when reapplied, or retried after a lock
+    timeout).
+    """
+    if params is None or isinstance(params, (tuple, dict, list)):
+        return params
+    return list(params)
 
 
 class MigrationStep(StepBase):
@@ -179,22 +671,65 @@ class MigrationStep(StepBase):
 
     transaction = None
 
-    def __init__(self, id, apply, rollback):
+    #: Maximum number of parameter sets sent in a single ``executemany`` call
+    executemany_chunk_size = 1000
+
+    #: Statements that may return rows, which are never batched so that
+    #: their results can be output
+    returns_rows = re.compile(r'\s*(SELECT|WITH|SHOW|EXPLAIN|PRAGMA|VALUES|'
+                              r'DESCRIBE|DESC)\b', re.I)
+
+    def __init__(self, id, apply, rollback, params=None, rollback_params=None,
+                 precondition=None, rollback_precondition=None, touches=None):
 
         self.id = id
+        #: Tables whose contents the step changes, in addition to those
+        #: found in its SQL
+        self.touches = list(touches or [])
         self._rollback = rollback
         self._apply = apply
+        self._params = _reusable_params(params)
+        self._rollback_params = _reusable_params(rollback_params)
+        self.preconditions = {'apply': precondition,
+                              'rollback': rollback_precondition}
 
-    def _execute(self, cursor, stmt, out=sys.stdout):
+    def should_run(self, conn, direction):
+        """
+        Return true unless the step has a precondition for ``direction``
+        that is not met.
+        """
+        precondition = self.preconditions[direction]
+        if precondition is None or precondition(conn):
+            return True
+        logger.info(" - skipping step %d: precondition %s not met",
+                    self.id, precondition.description)
+        return False
+
+    def _execute(self, cursor, stmt, out=sys.stdout, params=None,
+                 paramstyle=None):
         """
         Execute the given statement. If rows are returned, output these in a
         tabulated format.
+
+        If ``params`` is a tuple or dict, it is passed to the driver as the
+        statement's parameters. Any other iterable is treated as a sequence
+        of parameter sets and executed in batches with ``executemany``.
+        '?' placeholders in ``stmt`` are translated to ``paramstyle``.
         """
         if isinstance(stmt, ustr):
             logger.debug(" - executing %r", stmt.encode('ascii', 'replace'))
         else:
             logger.debug(" - executing %r", stmt)
-        cursor.execute(stmt)
+        if params is None:
+            cursor.execute(stmt)
+        else:
+            stmt = with_placeholders(getattr(cursor, 'connection', None),
+                                     paramstyle, stmt)
+            if isinstance(params, (tuple, dict)):
+                cursor.execute(stmt, params)
+            else:
+                self._executemany(cursor, stmt, params)
+                return
         if cursor.description:
             result = [[ustr(value) for value in row]
                       for row in cursor.fetchall()]
@@ -213,6 +748,51 @@ class MigrationStep(StepBase):
                 out.write((format % tuple(row)).encode('utf8') + "\n")
             out.write(plural(len(result), '(%d row)', '(%d rows)') + "\n")
 
+    def references(self, pattern):
+        for action in self._apply, self._rollback:
+            if not action:
+                continue
+            if not isinstance(action, (ustr, str)):
+                # Python callables could touch anything
+                return True
+            if pattern.search(action):
+                return True
+        return False
+
+    def batch_sql(self, direction):
+        """
+        Return the SQL statement run by the step in ``direction`` if it can
+        be sent to the database in a batch with other statements, or
+        ``None``. Only single SQL statements without parameters that don't
+        return rows can be batched.
+        """
+        if direction == 'apply':
+            sql, params = self._apply, self._params
+        else:
+            sql, params = self._rollback, self._rollback_params
+        if params is not None or not isinstance(sql, (ustr, str)) or \
+                self.preconditions[direction] is not None:
+            return None
+        sql = sql.strip().rstrip(';').rstrip()
+        if not sql or ';' in sql or self.returns_rows.match(sql):
+            return None
+        return sql
+
+    def _executemany(self, cursor, stmt, seq_of_params):
+        """
+        Execute ``stmt`` once for each parameter set in ``seq_of_params``,
+        sending at most ``executemany_chunk_size`` sets per call.
+        """
+        seq_of_params = iter(seq_of_params)
+        count = 0
+        while True:
+            chunk = list(islice(seq_of_params, self.executemany_chunk_size))
+            if not chunk:
+                break
+            cursor.executemany(stmt, chunk)
+            count += len(chunk)
+        logger.debug(" - executed with %d parameter sets", count)
+
     def apply(self, conn, paramstyle, force=False):
         """
         Apply the step.
@@ -220,12 +800,15 @@ class MigrationStep(StepBase):
         :param force: If true, errors will be logged but not be re-raised
         """
         logger.info(" - applying step %d", self.id)
-        if not self._apply:
+        if not self._apply or not self.should_run(conn, 'apply'):
             return
+        if catalog.changes_schema(self._apply):
+            catalog.invalidate(conn)
         cursor = conn.cursor()
         try:
             if isinstance(self._apply, (ustr, str)):
-                self._execute(cursor, self._apply)
+                self._execute(cursor, self._apply, params=self._params,
+                              paramstyle=paramstyle)
             else:
                 self._apply(conn)
         finally:
@@ -236,59 +819,233 @@ class MigrationStep(StepBase):
         Rollback the step.
         """
         logger.info(" - rolling back step %d", self.id)
-        if self._rollback is None:
+        if self._rollback is None or not self.should_run(conn, 'rollback'):
             return
+        if catalog.changes_schema(self._rollback):
+            catalog.invalidate(conn)
         cursor = conn.cursor()
         try:
             if isinstance(self._rollback, (ustr, str)):
-                self._execute(cursor, self._rollback)
+                self._execute(cursor, self._rollback,
+                              params=self._rollback_params,
+                              paramstyle=paramstyle)
             else:
                 self._rollback(conn)
         finally:
             cursor.close()
 
 
-def read_migrations(conn, paramstyle, directory, names=None,
-                    migration_table=default_migration_table):
+class IndexStep(StepBase):
     """
-    Return a ``MigrationList`` containing all migrations from ``directory``.
-    If ``names`` is given, this only return migrations with names from the
-    given list (without file extensions).
+    Build an index using the backend's online index build, so that writes to
+    the table are not blocked while the index is built: ``CREATE INDEX
+    CONCURRENTLY`` on PostgreSQL and ``ALGORITHM=INPLACE, LOCK=NONE`` on
+    MySQL. Index steps run outside of any transaction.
+
+    If the index already exists it is not rebuilt, unless PostgreSQL reports
+    it as invalid following an earlier failed build, in which case it is
+    dropped and built again.
     """
-    migrations = MigrationList(conn, paramstyle, migration_table)
-    paths = [os.path.join(directory, path)
-             for path in os.listdir(directory) if path.endswith('.py')]
 
-    for path in sorted(paths):
+    ignore_errors = None
 
-        filename = os.path.splitext(os.path.basename(path))[0]
+    #: Index steps cannot run inside a transaction, so cannot be part of a
+    #: batch committed in a single transaction
+    transactional = False
 
-        if filename.startswith('post-apply'):
-            migration_class = PostApplyHookMigration
+    def __init__(self, id, name, table, columns, unique=False,
+                 lock_timeout=None, statement_timeout=None,
+                 resource_profile=None):
+        self.id = id
+        self.name = name
+        self.table = table
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.resource_profile = resource_profile
+        if not isinstance(columns, (ustr, str)):
+            columns = ', '.join(columns)
+        self.columns = columns
+        self.unique = unique
+
+    def references(self, pattern):
+        return bool(pattern.search(self.table) or pattern.search(self.name))
+
+    def _create_sql(self, options=''):
+        return "CREATE %sINDEX %s%s ON %s (%s)" % (
+            'UNIQUE ' if self.unique else '', options, self.name, self.table,
+            self.columns)
+
+    def _query(self, conn, paramstyle, sql, params):
+        return query(conn, with_placeholders(conn, paramstyle, sql), params)
+
+    def _execute(self, conn, sql, autocommit=False):
+        """
+        Execute ``sql``. If ``autocommit`` is true, ensure no transaction is
+        open while the statement runs.
+        """
+        logger.debug(" - executing %r", sql)
+        catalog.invalidate(conn)
+        conn.commit()
+        if autocommit:
+            conn.autocommit = True
+        try:
+            query(conn, sql)
+        finally:
+            if autocommit:
+                conn.autocommit = False
+        conn.commit()
+
+    def apply(self, conn, paramstyle, force=False):
+        logger.info(" - applying step %d (building index %s)",
+                    self.id, self.name)
+        backend = get_backend(conn)
+        started = time.time()
+        if backend == 'postgresql':
+            built = self._apply_postgresql(conn, paramstyle)
+        elif backend == 'mysql':
+            built = self._apply_mysql(conn, paramstyle)
+        elif backend == 'sqlite':
+            self._execute(conn, self._create_sql('IF NOT EXISTS '))
+            built = True
         else:
-            migration_class = Migration
+            self._execute(conn, self._create_sql())
+            built = True
+        if built:
+            logger.info(" - built index %s on %s in %.2fs",
+                        self.name, self.table, time.time() - started)
+
+    def _apply_postgresql(self, conn, paramstyle):
+        rows = self._query(conn, paramstyle,
+                           "SELECT i.indisvalid FROM pg_catalog.pg_class c "
+                           "JOIN pg_catalog.pg_index i "
+                           "ON i.indexrelid = c.oid "
+                           "WHERE c.relname = ? "
+                           "AND pg_catalog.pg_table_is_visible(c.oid)",
+                           (self.name,))
+        if rows and rows[0][0]:
+            logger.info(" - index %s already exists", self.name)
+            return False
+        if rows:
+            logger.warning(" - dropping invalid index %s left by an earlier "
+                           "build", self.name)
+            self._execute(conn, "DROP INDEX CONCURRENTLY %s" % (self.name,),
+                          autocommit=True)
+        self._execute(conn, self._create_sql('CONCURRENTLY '),
+                      autocommit=True)
+        return True
+
+    def _apply_mysql(self, conn, paramstyle):
+        rows = self._query(conn, paramstyle,
+                           "SELECT COUNT(1) "
+                           "FROM information_schema.statistics "
+                           "WHERE table_schema = DATABASE() "
+                           "AND table_name = ? AND index_name = ?",
+                           (self.table, self.name))
+        if rows[0][0]:
+            logger.info(" - index %s already exists", self.name)
+            return False
+        self._execute(conn,
+                      "ALTER TABLE %s ADD %sINDEX %s (%s), "
+                      "ALGORITHM=INPLACE, LOCK=NONE" % (
+                          self.table, 'UNIQUE ' if self.unique else '',
+                          self.name, self.columns))
+        return True
 
-        if migration_class is Migration and \
-                names is not None and filename not in names:
-            continue
+    def rollback(self, conn, paramstyle, force=False):
+        logger.info(" - rolling back step %d (dropping index %s)",
+                    self.id, self.name)
+        backend = get_backend(conn)
+        if backend == 'postgresql':
+            self._execute(conn, "DROP INDEX CONCURRENTLY IF EXISTS %s" %
+                          (self.name,), autocommit=True)
+        elif backend == 'mysql':
+            self._execute(conn, "ALTER TABLE %s DROP INDEX %s, "
+                          "ALGORITHM=INPLACE, LOCK=NONE" %
+                          (self.table, self.name))
+        elif backend == 'sqlite':
+            self._execute(conn, "DROP INDEX IF EXISTS %s" % (self.name,))
+        else:
+            self._execute(conn, "DROP INDEX %s" % (self.name,))
 
-        file = open(path, 'r')
-        try:
-            source = file.read()
-            migration_code = compile(source, file.name, 'exec')
-        finally:
-            file.close()
 
-        collector = _step_collectors[file.name] = StepCollector()
-        ns = {'step': collector.step, 'transaction': collector.transaction}
-        try:
-            exec_(migration_code, ns)
-        except Exception:
-            logger.exception("Could not import migration from %r", path)
+def step_statements(step):
+    """
+    Yield ``(step, statement)`` for each statement applied by ``step`` and
+    the steps it contains, where ``step`` is the innermost step. SQL is
+    split into statements on ``;``. Steps that cannot be inspected (index
+    steps and python steps) are yielded once with a statement of ``None``.
+    """
+    if isinstance(step, Transaction):
+        for inner in step.steps:
+            for item in step_statements(inner):
+                yield item
+    elif isinstance(step, MigrationStep) and \
+            isinstance(step._apply, (ustr, str)):
+        for sql in step._apply.split(';'):
+            if sql.strip():
+                yield step, sql.strip()
+    else:
+        yield step, None
+
+
+def migration_scripts(directory, order='lexical'):
+    """
+    Return the names (without file extensions) of the migration scripts in
+    ``directory``, sorted by ``order``, one of the keys of ``sort_keys``.
+
+    The listing is cached until the directory is next modified.
+    """
+    st = os.stat(directory)
+    mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+    cached = _script_index.get((directory, order))
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    if scandir is not None:
+        names = [entry.name[:-3] for entry in scandir(directory)
+                 if entry.name.endswith('.py') and entry.is_file()]
+    else:
+        names = [name[:-3] for name in os.listdir(directory)
+                 if name.endswith('.py')]
+    names.sort(key=sort_keys[order])
+    _script_index[(directory, order)] = (mtime, names)
+    return names
+
+
+def read_migrations(conn, paramstyle, directory, names=None,
+                    migration_table=default_migration_table,
+                    load_steps=True, match=None, order='lexical'):
+    """
+    Return a ``MigrationList`` containing all migrations from ``directory``.
+    If ``names`` is given, this only return migrations with names from the
+    given list (without file extensions). If ``match`` is given, only
+    migrations with names matching the regular expression are returned.
+    Scripts not selected are never opened.
+
+    ``order`` gives the order migrations are applied in: one of
+    ``'lexical'`` (the default), ``'natural'`` or ``'numeric'``.
+
+    If ``load_steps`` is false, migration scripts are not executed until
+    their steps are first required.
+    """
+    migrations = MigrationList(conn, paramstyle, migration_table)
+    if names is not None:
+        names = set(names)
+    if match is not None:
+        match = re.compile(match)
+
+    for filename in migration_scripts(directory, order):
+
+        if not filename.startswith('post-apply'):
+            if names is not None and filename not in names:
+                continue
+            if match is not None and not match.search(filename):
+                continue
+
+        migration = read_migration(os.path.join(directory, filename + '.py'),
+                                   load_steps)
+        if migration is None:
             continue
-        migration = migration_class(os.path.basename(filename),
-                                    collector.steps, source)
-        if migration_class is PostApplyHookMigration:
+        if isinstance(migration, PostApplyHookMigration):
             migrations.post_apply.append(migration)
         else:
             migrations.append(migration)
@@ -296,6 +1053,56 @@ def read_migrations(conn, paramstyle, directory, names=None,
     return migrations
 
 
+def read_migration(path, load_steps=True):
+    """
+    Read the migration script at ``path``, returning a ``Migration``, or a
+    ``PostApplyHookMigration`` for post-apply hook scripts. Return ``None``
+    if the script could not be imported.
+    """
+    filename = os.path.splitext(os.path.basename(path))[0]
+    if filename.startswith('post-apply'):
+        migration_class = PostApplyHookMigration
+    else:
+        migration_class = Migration
+
+    started = time.time()
+    file = open(path, 'r')
+    try:
+        source = file.read()
+    finally:
+        file.close()
+
+    steps = None
+    if load_steps:
+        try:
+            steps = load_migration_steps(path, source)
+        except Exception:
+            logger.exception("Could not import migration from %r", path)
+            return None
+    migration = migration_class(filename, steps, source, path)
+    migration.load_time = time.time() - started
+    return migration
+
+
+def load_migration_steps(path, source):
+    """
+    Execute the migration script ``source``, read from ``path``, and return
+    the list of steps it declares.
+    """
+    migration_code = compile(source, path, 'exec')
+    collector = _step_collectors[path] = StepCollector()
+    ns = {'step': collector.step, 'transaction': collector.transaction,
+          'index_step': collector.index_step,
+          'depends_on': collector.depends_on,
+          'resource_profile': collector.resource_profile}
+    exec_(migration_code, ns)
+    if collector.default_profile is not None:
+        for step in collector.steps:
+            if step.resource_profile is None:
+                step.resource_profile = collector.default_profile
+    return collector.steps
+
+
 class MigrationList(list):
     """
     A list of database migrations.
@@ -304,6 +1111,28 @@ class MigrationList(list):
     that can be applied/rolled back.
     """
 
+    #: A ``yoyo.timeouts.Timeouts`` object giving the lock and statement
+    #: timeouts applied to each step, and how lock timeouts are retried
+    timeouts = None
+
+    #: If true, consecutive ALTER TABLE steps on the same table are merged
+    #: into a single statement (see ``merge_alter_steps``)
+    merge_alters = False
+
+    #: A ``yoyo.estimate.Progress`` object displaying the progress of
+    #: ``apply`` and ``rollback``
+    progress = None
+
+    #: A ``yoyo.resources.ResourceProfiles`` object giving the settings for
+    #: the resource profile named by each step
+    resource_profiles = None
+
+    #: If true, ``apply`` refreshes the planner statistics of the tables
+    #: touched by the migrations applied, using ``stats_workers``
+    #: connections (see ``yoyo.stats``)
+    refresh_stats = False
+    stats_workers = 1
+
     def __init__(self, conn, paramstyle, migration_table, items=None,
                  post_apply=None):
         super(MigrationList, self).__init__(items if items else [])
@@ -313,72 +1142,283 @@ class MigrationList(list):
         self.post_apply = post_apply if post_apply else []
         initialize_connection(self.conn, migration_table)
 
-    def to_apply(self):
+    def applied_ids(self):
+        """
+        Return the set of ids of all applied migrations, read in a single
+        query.
+        """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("SELECT id FROM " + self.migration_table)
+            return set(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def to_apply(self, target=None):
         """
         Return a list of the subset of migrations not already applied.
+
+        If ``target`` is given, only migrations up to and including the
+        migration with id ``target`` are returned.
         """
-        return self.__class__(
-            self.conn,
-            self.paramstyle,
-            self.migration_table,
-            [m
-             for m in self
-             if not m.isapplied(self.conn, self.paramstyle,
-                                self.migration_table)],
-            self.post_apply
-        )
+        migrations = self._up_to(target) if target is not None else self
+        applied = self.applied_ids()
+        return self.replace(m for m in migrations if m.id not in applied)
 
-    def to_rollback(self):
+    def to_rollback(self, target=None):
         """
         Return a list of the subset of migrations already applied, which may be
         rolled back.
 
+        If ``target`` is given, only migrations after the migration with id
+        ``target`` are returned, so that rolling them back leaves ``target``
+        as the most recent applied migration.
+
         The order of migrations will be reversed.
         """
-        return self.__class__(
-            self.conn,
-            self.paramstyle,
-            self.migration_table,
-            list(reversed([m
-                           for m in self
-                           if m.isapplied(self.conn, self.paramstyle,
-                                          self.migration_table)])),
-            self.post_apply
-        )
+        if target is not None:
+            keep = set(m.id for m in self._up_to(target))
+        else:
+            keep = set()
+        applied = self.applied_ids()
+        return self.replace(reversed([m for m in self
+                                      if m.id in applied and
+                                      m.id not in keep]))
+
+    def _up_to(self, target):
+        """
+        Return the migrations up to and including the migration with id
+        ``target``.
+        """
+        for ix, m in enumerate(self):
+            if m.id == target:
+                return list(self)[:ix + 1]
+        raise ValueError("Migration %r not found" % (target,))
 
     def filter(self, predicate):
-        return self.__class__(
-            self.conn,
-            self.paramstyle,
-            self.migration_table,
-            [m for m in self if predicate(m)],
-            self.post_apply
-        )
+        return self.replace(m for m in self if predicate(m))
 
     def replace(self, newmigrations):
-        return self.__class__(self.conn, self.paramstyle, self.migration_table,
-                              newmigrations, self.post_apply)
+        migrations = self.__class__(self.conn, self.paramstyle,
+                                    self.migration_table, list(newmigrations),
+                                    self.post_apply)
+        migrations.timeouts = self.timeouts
+        migrations.merge_alters = self.merge_alters
+        migrations.progress = self.progress
+        migrations.resource_profiles = self.resource_profiles
+        migrations.refresh_stats = self.refresh_stats
+        migrations.stats_workers = self.stats_workers
+        return migrations
+
+    def apply(self, force=False, batch_commit=False, hooks=True):
+        """
+        Apply all migrations in the list, followed by any post-apply hooks
+        unless ``hooks`` is false.
+
+        If ``batch_commit`` is true and the database supports transactional
+        DDL, all migrations are applied in a single transaction, committed
+        once at the end. Otherwise each step is committed as it is applied.
 
-    def apply(self, force=False):
+        If ``refresh_stats`` is set, the statistics of the tables touched
+        are refreshed before the hooks are run.
+        """
         if not self:
             return
-        for m in self + self.post_apply:
-            m.apply(self.conn, self.paramstyle, self.migration_table, force)
-
-    def rollback(self, force=False):
+        batch_id = uuid.uuid4().hex
+        self._run('apply', force, batch_commit, batch_id=batch_id)
+        if self.refresh_stats:
+            # Imported here as yoyo.stats depends on this module
+            from yoyo.stats import migration_tables, refresh_statistics
+            refresh_statistics(self.conn, migration_tables(self),
+                               self.stats_workers)
+        if hooks:
+            self.run_post_apply('apply', force, batch_id=batch_id)
+
+    def rollback(self, force=False, batch_commit=False, hooks=True):
+        """
+        Roll back all migrations in the list, followed by any post-apply
+        hooks unless ``hooks`` is false. ``batch_commit`` is as for
+        ``apply``.
+        """
         if not self:
             return
-        for m in self + self.post_apply:
-            m.rollback(self.conn, self.paramstyle, self.migration_table, force)
+        self._run('rollback', force, batch_commit)
+        if hooks:
+            self.run_post_apply('rollback', force)
+
+    def run_post_apply(self, direction, force=False, **kwargs):
+        """
+        Run the post-apply hooks after migrations have been applied or rolled
+        back. ``direction`` is one of 'apply' or 'rollback'.
+
+        Hooks that declare dependencies are skipped unless one of the
+        migrations in the list matches them, or the hook has changed since
+        it was last run.
+        """
+        if not self.post_apply:
+            return
+        last_run = self.hook_hashes()
+        for m in self.post_apply:
+            if last_run.get(m.id) == m.hash and not m.is_relevant(self):
+                logger.info("Skipping %s: no relevant migrations", m.id)
+                continue
+            getattr(m, direction)(self.conn, self.paramstyle,
+                                  self.migration_table, force, **kwargs)
+            self._record_hook(m)
+
+    def hook_hashes(self):
+        """
+        Return a dict mapping the id of each post-apply hook to the hash of
+        its source when it was last run.
+        """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("SELECT id, hash FROM %s_hooks" %
+                           (self.migration_table,))
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def _record_hook(self, hook):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(
+                with_placeholders(self.conn, self.paramstyle,
+                                  "DELETE FROM %s_hooks WHERE id=?" %
+                                  (self.migration_table,)),
+                (hook.id,))
+            cursor.execute(
+                with_placeholders(self.conn, self.paramstyle,
+                                  "INSERT INTO %s_hooks (id, hash, ctime) "
+                                  "VALUES (?, ?, ?)" %
+                                  (self.migration_table,)),
+                (hook.id, hook.hash, datetime.utcnow()))
+            self.conn.commit()
+        finally:
+            cursor.close()
+
+    def _run(self, direction, force, batch_commit, **kwargs):
+        # Fail on a misspelt profile before any migration has been run
+        (self.resource_profiles or default_resource_profiles).check(
+            step for m in self for step in m.steps)
+        # Load a fresh catalog snapshot for any preconditions checked
+        catalog.invalidate(self.conn)
+        conn = self.conn
+        if batch_commit and self._can_batch_commit(force):
+            conn = _BatchCommitConnection(self.conn)
+        progress = self.progress
+        if progress is not None:
+            progress.start(self)
+        try:
+            for m in self:
+                if progress is not None:
+                    progress.begin(m)
+                getattr(m, direction)(conn, self.paramstyle,
+                                      self.migration_table, force,
+                                      timeouts=self.timeouts,
+                                      merge_alters=self.merge_alters,
+                                      profiles=self.resource_profiles,
+                                      **kwargs)
+                if progress is not None:
+                    progress.end(m)
+        except Exception:
+            exc_info = sys.exc_info()
+            if conn is not self.conn:
+                self.conn.rollback()
+            reraise(exc_info[0], exc_info[1], exc_info[2])
+        finally:
+            if progress is not None:
+                progress.stop()
+        if conn is not self.conn:
+            self.conn.commit()
+
+    def _can_batch_commit(self, force):
+        """
+        Return true if the migrations can be run in a single transaction.
+        """
+        backend = get_backend(self.conn)
+        if backend not in transactional_ddl_backends:
+            logger.info("%s does not support transactional DDL, "
+                        "committing each migration separately", backend)
+            return False
+        steps = [step for m in self for step in m.steps]
+        if force:
+            logger.info("Forcing migrations, "
+                        "committing each migration separately")
+            return False
+        if backend not in savepoint_backends and \
+                any(getattr(step, 'ignore_errors', None) is not None
+                    for step in steps):
+            logger.info("Migrations ignore errors, "
+                        "committing each migration separately")
+            return False
+        if not all(getattr(step, 'transactional', True) for step in steps):
+            logger.info("Migrations contain steps that cannot run in a "
+                        "transaction, committing each migration separately")
+            return False
+        return True
+
+    def applied_hashes(self):
+        """
+        Return a dict mapping the id of each applied migration to the hash
+        recorded when it was applied, read in a single query.
+        """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("SELECT id, hash FROM " + self.migration_table)
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def verify(self):
+        """
+        Compare the recorded hashes of applied migrations with the current
+        migration sources. No migration scripts are executed.
+
+        Return a list of ``(id, stored_hash, current_hash)`` tuples for each
+        migration that has changed since it was applied. ``current_hash``
+        is ``None`` if the migration is no longer present. Migrations applied
+        before hashes were recorded are not reported.
+        """
+        current = dict((m.id, m.hash) for m in self)
+        drift = []
+        for id, stored_hash in sorted(self.applied_hashes().items()):
+            if stored_hash is None:
+                continue
+            current_hash = current.get(id)
+            if current_hash != stored_hash:
+                drift.append((id, stored_hash, current_hash))
+        return drift
 
     def __getslice__(self, i, j):
-        return self.__class__(
-            self.conn,
-            self.paramstyle,
-            self.migration_table,
-            super(MigrationList, self).__getslice__(i, j),
-            self.post_apply
-        )
+        return self.replace(super(MigrationList, self).__getslice__(i, j))
+
+
+class _BatchCommitConnection(object):
+    """
+    Wrap a DB-API connection so that all work is done in a single
+    transaction: calls to ``commit`` are ignored, leaving the caller to
+    commit or roll back the underlying connection once the batch is complete.
+    """
+
+    batch_commit = True
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.yoyo_backend = get_backend(conn)
+        begin = begin_transaction_statements.get(self.yoyo_backend)
+        if begin and not getattr(conn, 'in_transaction', False):
+            cursor = conn.cursor()
+            try:
+                cursor.execute(begin)
+            finally:
+                cursor.close()
+
+    def commit(self):
+        pass
+
+    def __getattr__(self, attr):
+        return getattr(self._conn, attr)
 
 
 def create_migrations_table(conn, tablename):
@@ -389,10 +1429,10 @@ def create_migrations_table(conn, tablename):
         cursor = conn.cursor()
         try:
             try:
-                cursor.execute("""
-                    CREATE TABLE %s (id VARCHAR(255) NOT NULL PRIMARY KEY,
-                                     ctime TIMESTAMP)
-                """ % (tablename,))
+                cursor.execute("CREATE TABLE %s (%s)" % (
+                    tablename,
+                    ', '.join('%s %s' % column
+                              for column in migration_table_columns)))
                 conn.commit()
             except DatabaseError:
                 pass
@@ -402,6 +1442,79 @@ def create_migrations_table(conn, tablename):
         conn.rollback()
 
 
+def get_migrations_table_version(conn, tablename):
+    """
+    Return the schema version of the migrations table ``tablename``, or 0 if
+    the schema has never been versioned.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT MAX(version) FROM %s_version" % (tablename,))
+        return cursor.fetchone()[0] or 0
+    except DatabaseError:
+        conn.rollback()
+        return 0
+    finally:
+        cursor.close()
+
+
+def upgrade_migrations_table(conn, tablename):
+    """
+    Bring a migrations table created by an earlier version of yoyo up to
+    the current schema version, adding any missing columns and indexes.
+    """
+    version = get_migrations_table_version(conn, tablename)
+    if version >= migration_table_schema_version:
+        return
+
+    logger.info("Upgrading migrations table %s to schema version %d",
+                tablename, migration_table_schema_version)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT * FROM %s WHERE 1=0" % (tablename,))
+        columns = set(desc[0].lower() for desc in cursor.description)
+        for column, definition in migration_table_columns:
+            if column not in columns:
+                cursor.execute("ALTER TABLE %s ADD COLUMN %s %s" %
+                               (tablename, column, definition))
+                conn.commit()
+
+        for suffix, column in migration_table_indexes:
+            try:
+                cursor.execute("CREATE INDEX %s_%s ON %s (%s)" %
+                               (tablename, suffix, tablename, column))
+                conn.commit()
+            except DatabaseError:
+                # The index already exists
+                conn.rollback()
+
+        try:
+            cursor.execute("CREATE TABLE %s_hooks "
+                           "(id VARCHAR(255) NOT NULL PRIMARY KEY, "
+                           "hash VARCHAR(64), ctime TIMESTAMP)" % (tablename,))
+            conn.commit()
+        except DatabaseError:
+            conn.rollback()
+
+        try:
+            cursor.execute("CREATE TABLE %s_version "
+                           "(version INT NOT NULL PRIMARY KEY, "
+                           "ctime TIMESTAMP)" % (tablename,))
+            conn.commit()
+        except DatabaseError:
+            conn.rollback()
+        try:
+            cursor.execute("INSERT INTO %s_version (version, ctime) "
+                           "VALUES (%d, CURRENT_TIMESTAMP)" %
+                           (tablename, migration_table_schema_version))
+            conn.commit()
+        except DatabaseError:
+            # Another process upgraded the table concurrently
+            conn.rollback()
+    finally:
+        cursor.close()
+
+
 def initialize_connection(conn, tablename):
     """
     Initialize the DBAPI connection for use.
@@ -409,13 +1522,17 @@ def initialize_connection(conn, tablename):
     - Installs ``yoyo.excpetions.DatabaseError`` as a base class for the
       connection's own DatabaseError
 
-    - Creates the migrations table if not already existing
+    - Creates the migrations table if not already existing, or upgrades it
+      to the current schema version
 
     """
     module = inspect.getmodule(type(conn))
     if DatabaseError not in module.DatabaseError.__bases__:
         module.DatabaseError.__bases__ += (DatabaseError,)
-    create_migrations_table(conn, tablename)
+    if get_migrations_table_version(conn, tablename) < \
+            migration_table_schema_version:
+        create_migrations_table(conn, tablename)
+        upgrade_migrations_table(conn, tablename)
 
 
 class StepCollector(object):
@@ -429,28 +1546,105 @@ class StepCollector(object):
     def __init__(self):
         self.steps = []
         self.step_id = count(0)
+        self.dependencies = None
+        self.default_profile = None
+
+    def depends_on(self, tables=None, migrations=None):
+        """
+        Declare the tables and migrations a post-apply hook depends on.
+        The hook will only be run if an applied or rolled back migration
+        touches one of ``tables``, or has an id matching one of the regular
+        expressions in ``migrations``.
+        """
+        self.dependencies = (list(tables or []), list(migrations or []))
 
-    def step(self, apply, rollback=None, ignore_errors=None):
+    def resource_profile(self, name):
+        """
+        Apply resource profile ``name`` to every step in the migration that
+        does not name its own profile.
+        """
+        self.default_profile = name
+
+    def step(self, apply, rollback=None, ignore_errors=None, params=None,
+             rollback_params=None, lock_timeout=None, statement_timeout=None,
+             precondition=None, rollback_precondition=None,
+             resource_profile=None, touches=None):
         """
         Wrap the given apply and rollback code in a transaction, and add it
         to the list of steps.
         Return the transaction-wrapped step.
+
+        ``params`` and ``rollback_params`` supply query parameters for SQL
+        apply and rollback statements, using '?' placeholders. Pass a tuple
+        for a single execution, or a list (or any other iterable) of tuples
+        to execute the statement once per tuple using ``executemany``.
+
+        ``lock_timeout`` and ``statement_timeout`` give timeouts in seconds
+        for the step, overriding any global timeouts.
+
+        ``precondition`` and ``rollback_precondition`` are checks from
+        ``yoyo.catalog`` (eg ``table_missing('foo')``): if the check fails
+        the step is skipped.
+
+        ``resource_profile`` names the resource profile (see
+        ``yoyo.resources``) whose session settings apply while the step runs.
+
+        ``touches`` lists tables the step changes that cannot be found by
+        parsing its SQL (eg tables changed by a python step), so that their
+        statistics are refreshed (see ``yoyo.stats``).
         """
-        t = Transaction([MigrationStep(next(self.step_id), apply, rollback)],
-                        ignore_errors)
+        t = Transaction([MigrationStep(next(self.step_id), apply, rollback,
+                                       params, rollback_params, precondition,
+                                       rollback_precondition, touches)],
+                        ignore_errors, lock_timeout, statement_timeout,
+                        resource_profile)
         self.steps.append(t)
         return t
 
+    def index_step(self, name, table, columns, unique=False,
+                   lock_timeout=None, statement_timeout=None,
+                   resource_profile=None):
+        """
+        Add a step building index ``name`` on ``columns`` of ``table``
+        without blocking writes to the table. ``columns`` may be a string or
+        a list of column names.
+        Return the step.
+        """
+        step = IndexStep(next(self.step_id), name, table, columns, unique,
+                         lock_timeout, statement_timeout, resource_profile)
+        self.steps.append(step)
+        return step
+
     def transaction(self, *steps, **kwargs):
         """
         Wrap the given list of steps in a single transaction, removing the
         default transactions around individual steps.
+
+        Unless ``lock_timeout`` or ``statement_timeout`` are given, the
+        transaction uses the shortest timeouts of the steps it contains.
+        Unless ``resource_profile`` is given, the transaction uses the first
+        resource profile named by the steps it contains.
         """
         ignore_errors = kwargs.pop('ignore_errors', None)
+        lock_timeout = kwargs.pop('lock_timeout', None)
+        statement_timeout = kwargs.pop('statement_timeout', None)
+        resource_profile = kwargs.pop('resource_profile', None)
         assert kwargs == {}
 
-        transaction = Transaction([], ignore_errors)
+        if lock_timeout is None:
+            lock_timeout = _shortest(s.lock_timeout for s in steps)
+        if statement_timeout is None:
+            statement_timeout = _shortest(s.statement_timeout for s in steps)
+        if resource_profile is None:
+            resource_profile = next((s.resource_profile for s in steps
+                                     if s.resource_profile is not None),
+                                    None)
+        transaction = Transaction([], ignore_errors, lock_timeout,
+                                  statement_timeout, resource_profile)
         for oldtransaction in steps:
+            if isinstance(oldtransaction, IndexStep):
+                raise AssertionError("index_step cannot be used within a "
+                                     "transaction")
             if oldtransaction.ignore_errors is not None:
                 raise AssertionError("ignore_errors cannot be specified "
                                         "within a transaction")
@@ -464,11 +1658,42 @@ class StepCollector(object):
         return transaction
 
 
+def _shortest(timeouts):
+    """
+    Return the shortest of ``timeouts`` that is set, or ``None``.
+    """
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if timeouts else None
+
+
+def _caller_filename():
+    """
+    Return the filename of the migration script calling ``step`` or
+    ``transaction``.
+
+    This reads the calling frame directly: ``inspect.stack`` loads source
+    context for every frame on the stack, which made loading migrations that
+    import ``step`` from yoyo very slow.
+    """
+    return inspect.currentframe().f_back.f_back.f_code.co_filename
+
+
 def step(*args, **kwargs):
-    fi = inspect.getframeinfo(inspect.stack()[1][0])
-    return _step_collectors[fi.filename].step(*args, **kwargs)
+    return _step_collectors[_caller_filename()].step(*args, **kwargs)
 
 
 def transaction(*args, **kwargs):
-    fi = inspect.getframeinfo(inspect.stack()[1][0])
-    return _step_collectors[fi.filename].transaction(*args, **kwargs)
+    return _step_collectors[_caller_filename()].transaction(*args, **kwargs)
+
+
+def index_step(*args, **kwargs):
+    return _step_collectors[_caller_filename()].index_step(*args, **kwargs)
+
+
+def depends_on(*args, **kwargs):
+    return _step_collectors[_caller_filename()].depends_on(*args, **kwargs)
+
+
+def resource_profile(*args, **kwargs):
+    return _step_collectors[_caller_filename()].resource_profile(*args,
+                                                                  **kwargs)
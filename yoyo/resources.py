@@ -0,0 +1,164 @@
+"""
+Session resource profiles for migration steps.
+
+Index builds and large backfills run faster with more memory for sorting
+and more parallel workers than is sensible for ordinary queries. A step (or
+every step in a migration) may name a resource profile, whose session
+settings are applied while the step runs and restored afterwards::
+
+    from yoyo import step, index_step, resource_profile
+
+    index_step('orders_created_idx', 'orders', ['created'],
+               resource_profile='maintenance')
+
+    # or, for every step in the migration:
+    resource_profile('bulk')
+
+Profiles are configured per backend in the ``.yoyo-migrate`` file, in a
+``[profile:NAME]`` section with ``backend.setting = value`` options::
+
+    [profile:maintenance]
+    postgresql.maintenance_work_mem = 4GB
+    postgresql.max_parallel_maintenance_workers = 8
+    mysql.sort_buffer_size = 268435456
+"""
+from logging import getLogger
+import re
+
+from yoyo.connections import get_backend
+from yoyo.utils import query
+
+logger = getLogger(__name__)
+
+#: Statements reading and changing a session setting for each backend
+setting_statements = {
+    'postgresql': ("SHOW %s", "SET %s = %s"),
+    'mysql': ("SELECT @@SESSION.%s", "SET SESSION %s = %s"),
+    'sqlite': ("PRAGMA %s", "PRAGMA %s = %s"),
+}
+
+#: Profiles available without configuration, mapping each profile name to
+#: the settings for each backend
+default_profiles = {
+    'maintenance': {
+        'postgresql': {'maintenance_work_mem': '1GB',
+                       'max_parallel_maintenance_workers': '4'},
+        'mysql': {'sort_buffer_size': '67108864'},
+        'sqlite': {'cache_size': '-262144', 'temp_store': 'MEMORY'},
+    },
+    'bulk': {
+        'postgresql': {'work_mem': '256MB'},
+        'mysql': {'sort_buffer_size': '67108864',
+                  'join_buffer_size': '67108864'},
+        'sqlite': {'cache_size': '-262144', 'temp_store': 'MEMORY'},
+    },
+}
+
+_setting_name = re.compile(r'^\w+$')
+_number = re.compile(r'^-?\d+(\.\d+)?$')
+
+
+def _literal(value):
+    value = str(value)
+    if _number.match(value):
+        return value
+    return "'%s'" % value.replace("'", "''")
+
+
+class ResourceProfiles(object):
+    """
+    Named resource profiles, as a dict mapping each profile name to the
+    settings for each backend. Profiles given override the default profiles
+    of the same name.
+    """
+
+    def __init__(self, profiles=None):
+        self.profiles = dict(default_profiles)
+        self.profiles.update(profiles or {})
+
+    def for_step(self, step, backend):
+        """
+        Return a dict of the session settings for ``step`` on ``backend``.
+        """
+        name = getattr(step, 'resource_profile', None)
+        if name is None:
+            return {}
+        try:
+            profile = self.profiles[name]
+        except KeyError:
+            raise ValueError("Unknown resource profile %r" % (name,))
+        return profile.get(backend, {})
+
+    def check(self, steps):
+        """
+        Raise ``ValueError`` if any of ``steps`` names an unknown profile.
+        """
+        for step in steps:
+            self.for_step(step, None)
+
+
+class SessionSettings(object):
+    """
+    Apply session settings to a connection, recording the original value of
+    each so that it can be restored.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = setting_statements.get(get_backend(conn))
+        self.original = {}
+        self.current = {}
+
+    def set(self, settings):
+        """
+        Apply the dict ``settings``. Settings applied previously that are
+        not in ``settings`` are restored.
+        """
+        if self.statements is None:
+            return
+        show, change = self.statements
+        for name in sorted(settings):
+            if not _setting_name.match(name):
+                raise ValueError("Invalid setting name %r" % (name,))
+            value = settings[name]
+            if self.current.get(name) == value:
+                continue
+            if name not in self.original:
+                self.original[name] = self._execute(show % name)[0][0]
+            self._execute(change % (name, _literal(value)))
+            self.current[name] = value
+        for name in sorted(self.current):
+            if name not in settings:
+                self._execute(change % (name,
+                                        _literal(self.original[name])))
+                del self.current[name]
+
+    def reset(self):
+        """
+        Restore every setting changed to its original value.
+        """
+        self.set({})
+
+    def _execute(self, statement):
+        logger.debug(" - executing %r", statement)
+        return query(self.conn, statement)
+
+
+def read_profiles(config):
+    """
+    Return a ``ResourceProfiles`` object with the profiles configured in the
+    ``[profile:NAME]`` sections of ``config``.
+    """
+    profiles = {}
+    defaults = config.defaults()
+    for section in config.sections():
+        if not section.startswith('profile:'):
+            continue
+        profile = profiles[section[len('profile:'):]] = {}
+        for option in config.options(section):
+            if option in defaults:
+                continue
+            backend, _, name = option.partition('.')
+            profile.setdefault(backend, {})[name] = config.get(section,
+                                                               option)
+    return ResourceProfiles(profiles)
@@ -0,0 +1,116 @@
+"""
+Staged rollout of migrations across many databases.
+
+Migrations are applied to a small canary set of databases first. If the
+canaries succeed within the time budget, the rollout widens to larger
+stages, migrating more databases in parallel, and stops as soon as the
+allowed error rate is breached::
+
+    rollout = Rollout('migrations', uris, stages=[1, 10, 100])
+    if not rollout.run():
+        print(rollout.stopped)
+"""
+from logging import getLogger
+import time
+
+from yoyo.migrations import default_migration_table
+from yoyo.shards import apply_to_shards, load_migrations
+
+logger = getLogger(__name__)
+
+
+class Rollout(object):
+    """
+    Apply migrations to the databases in ``uris`` in stages.
+
+    Each number in ``stages`` gives the number of databases migrated in
+    parallel in that stage; the last stage is repeated until every database
+    has been migrated. A stage fails if it does not complete within
+    ``stage_timeout`` seconds, or as soon as the proportion of databases
+    that failed so far exceeds ``max_error_rate``. No further databases are
+    then started, but those already being migrated are allowed to finish.
+
+    ``order`` and ``match`` select and sort the migrations as for
+    ``read_migrations``.
+    """
+
+    def __init__(self, directory, uris, stages=(1, 10, 100),
+                 stage_timeout=None, max_error_rate=0.0,
+                 migration_table=default_migration_table, timeouts=None,
+                 order='lexical', match=None):
+        assert stages and all(n > 0 for n in stages)
+        self.directory = directory
+        self.uris = list(uris)
+        self.stages = list(stages)
+        self.stage_timeout = stage_timeout
+        self.max_error_rate = max_error_rate
+        self.migration_table = migration_table
+        self.timeouts = timeouts
+        self.order = order
+        self.match = match
+
+        #: ``ShardResult`` objects for each database migrated
+        self.results = []
+
+        #: The reason the rollout was stopped early, if it was
+        self.stopped = None
+
+    def waves(self):
+        """
+        Return the list of databases to be migrated in each stage.
+        """
+        waves = []
+        remaining = self.uris
+        stage = 0
+        while remaining:
+            size = self.stages[min(stage, len(self.stages) - 1)]
+            waves.append(remaining[:size])
+            remaining = remaining[size:]
+            stage += 1
+        return waves
+
+    def error_rate(self):
+        if not self.results:
+            return 0.0
+        return (sum(1 for r in self.results if not r.ok) /
+                float(len(self.results)))
+
+    def error_rate_exceeded(self):
+        return self.error_rate() > self.max_error_rate
+
+    def run(self, report=None):
+        """
+        Run the rollout, calling ``report(stage, result)`` for each database
+        as it completes. Return true if every database was migrated.
+        """
+        migrations = load_migrations(self.directory, self.order, self.match)
+        for stage, wave in enumerate(self.waves(), 1):
+            logger.info("Stage %d: migrating %d databases", stage, len(wave))
+            started = time.time()
+            deadline = started + self.stage_timeout \
+                if self.stage_timeout else None
+            completed = 0
+            for result in apply_to_shards(self.directory, wave, len(wave),
+                                          self.migration_table,
+                                          self.timeouts, migrations,
+                                          deadline, order=self.order,
+                                          match=self.match,
+                                          stop=self.error_rate_exceeded):
+                completed += 1
+                self.results.append(result)
+                if report is not None:
+                    report(stage, result)
+
+            if self.error_rate_exceeded():
+                self.stopped = ("stage %d: error rate %.1f%% exceeds "
+                                "%.1f%%" % (stage, self.error_rate() * 100,
+                                            self.max_error_rate * 100))
+            elif completed < len(wave):
+                self.stopped = ("stage %d did not complete within %gs" %
+                                (stage, self.stage_timeout))
+            if self.stopped:
+                logger.error("Rollout stopped: %s", self.stopped)
+                return False
+            logger.info("Stage %d complete in %.2fs", stage,
+                        time.time() - started)
+        return True
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 from __future__ import print_function
+from contextlib import contextmanager
+import cProfile
 import logging
 import argparse
 import os
-import re
 import sys
+import time
 try:
     from configparser import ConfigParser, NoSectionError, NoOptionError
 except ImportError:
@@ -12,10 +14,17 @@ except ImportError:
 
 from getpass import getpass
 
-from yoyo.connections import connect, parse_uri, unparse_uri
+from yoyo.analyze import analyze, severities
+from yoyo.bootstrap import BootstrapError, bootstrap
+from yoyo.connections import connect, get_backend, parse_uri, unparse_uri
+from yoyo.estimate import Progress, estimate, format_duration
 from yoyo.utils import prompt, plural
 from yoyo import read_migrations, default_migration_table
 from yoyo import logger
+from yoyo.resources import read_profiles
+from yoyo.rollout import Rollout
+from yoyo.timeouts import Timeouts
+from yoyo.watch import Watcher
 
 verbosity_levels = {
     0: logging.ERROR,
@@ -56,6 +65,7 @@ def prompt_migrations(conn, paramstyle, migrations, direction):
     direction
         one of 'apply' or 'rollback'
     """
+    applied = migrations.applied_ids()
     migrations = migrations.replace(prompted_migration(m) for m in migrations)
 
     position = 0
@@ -64,8 +74,7 @@ def prompt_migrations(conn, paramstyle, migrations, direction):
 
         choice = mig.choice
         if choice is None:
-            isapplied = mig.migration.isapplied(conn, paramstyle,
-                                                migrations.migration_table)
+            isapplied = mig.migration.id in applied
             if direction == 'apply':
                 choice = 'n' if isapplied else 'y'
             else:
@@ -129,13 +138,198 @@ def prompt_migrations(conn, paramstyle, migrations, direction):
                               if m.choice == 'y')
 
 
+class Profile(object):
+    """
+    Record the time spent in each phase of a yoyo-migrate run, and optionally
+    profile the run with cProfile, saving the statistics to
+    ``cprofile_path``.
+    """
+
+    #: Number of migrations listed in the table of slowest loads
+    slowest_loads = 20
+
+    def __init__(self, cprofile_path=None):
+        self.phases = []
+        self.times = {}
+        self.migrations = []
+        self.cprofile_path = cprofile_path
+        self.profiler = None
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        self.started = time.time()
+        if self.cprofile_path:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        self.elapsed = time.time() - self.started
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.cprofile_path)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Add the time spent in the ``with`` block to phase ``name``
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            if name not in self.times:
+                self.phases.append(name)
+                self.times[name] = 0.0
+            self.times[name] += time.time() - started
+
+    def report(self, out):
+        total = self.elapsed or sum(self.times.values())
+        out.write("\n%-20s %10s %7s\n" % ('Phase', 'Time (s)', '%'))
+        for name in self.phases:
+            out.write("%-20s %10.3f %6.1f%%\n" % (
+                name, self.times[name],
+                100 * self.times[name] / total if total else 0))
+        out.write("%-20s %10.3f\n" % ('total', total))
+
+        loads = sorted(self.migrations, key=lambda m: m.load_time,
+                       reverse=True)[:self.slowest_loads]
+        if loads:
+            out.write("\nSlowest migrations to load (of %d):\n" %
+                      len(self.migrations))
+            out.write("%10s  %s\n" % ('Time (ms)', 'Migration'))
+            for m in loads:
+                out.write("%10.2f  %s\n" % (m.load_time * 1000, m.id))
+        if self.cprofile_path:
+            out.write("\ncProfile statistics saved to %s\n" %
+                      self.cprofile_path)
+
+
+def verify_migrations(migrations):
+    """
+    Report applied migrations whose source has changed since they were
+    applied. Return the exit status for the ``verify`` command.
+    """
+    drift = migrations.verify()
+    for id, stored_hash, current_hash in drift:
+        if current_hash is None:
+            print("%s: applied but no longer present" % (id,))
+        else:
+            print("%s: changed since applied (applied %s, now %s)" %
+                  (id, stored_hash[:12], current_hash[:12]))
+    if drift:
+        print(plural(len(drift), "%d migration has changed",
+                     "%d migrations have changed"))
+        return 1
+    return 0
+
+
+def analyze_migrations(migrations, backend, fail_on):
+    """
+    Report expensive or locking statements in ``migrations``. Return 1 if
+    any finding is at least as severe as ``fail_on``.
+    """
+    findings = analyze(migrations, backend)
+    for finding in findings:
+        print(finding)
+    failed = [f for f in findings
+              if severities.index(f.severity) >= severities.index(fail_on)]
+    print("Analyzed %s: %s" % (
+        plural(len(migrations), "%d migration", "%d migrations"),
+        plural(len(findings), "%d finding", "%d findings")))
+    return 1 if failed else 0
+
+
+def bootstrap_migrations(migrations, force):
+    """
+    Apply all migrations to a fresh database in bootstrap mode. Return 1 if
+    the database could not be bootstrapped.
+    """
+    try:
+        bootstrap(migrations, force)
+    except BootstrapError as e:
+        print("Bootstrap failed: %s" % (e,), file=sys.stderr)
+        return 1
+    print("Bootstrapped database with %s" %
+          plural(len(migrations), "%d migration", "%d migrations"))
+    return 0
+
+
+def estimate_migrations(migrations, history):
+    """
+    Print the estimated duration of each migration in ``migrations``, based
+    on the recorded durations of applied migrations in ``history``.
+    """
+    estimates = estimate(migrations, history)
+    for e in estimates:
+        print(e)
+    known = [e.seconds for e in estimates if e.seconds is not None]
+    print("Estimated total for %s: %s%s" % (
+        plural(len(estimates), "%d migration", "%d migrations"),
+        format_duration(sum(known)) if known else 'unknown',
+        '' if len(known) == len(estimates) else
+        ' (%d without estimates)' % (len(estimates) - len(known))))
+    return 0
+
+
+def watch_migrations(migrations, migrations_dir, interval, order='lexical'):
+    """
+    Apply any pending migrations, then re-apply migrations as they are
+    changed until interrupted.
+    """
+    watcher = Watcher(migrations, migrations_dir, order)
+    migrations.to_apply().apply()
+    print("Watching %s for changes, press Ctrl-C to stop" % migrations_dir)
+    try:
+        watcher.watch(interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def rollout_migrations(args, migrations_dir, migration_table, timeouts):
+    """
+    Apply migrations to each database listed in the ``--databases`` file in
+    stages, reporting each database as it completes. Return 1 if the rollout
+    stopped early.
+    """
+    with open(args.databases) as f:
+        uris = [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+    rollout = Rollout(migrations_dir, uris,
+                      stages=[int(n) for n in args.stages.split(',')],
+                      stage_timeout=args.stage_timeout,
+                      max_error_rate=args.max_error_rate,
+                      migration_table=migration_table,
+                      timeouts=timeouts,
+                      order=args.order,
+                      match=args.match)
+
+    def report(stage, result):
+        print("[stage %d] %s: %s" % (
+            stage, result.uri,
+            plural(len(result.applied), "%d migration applied",
+                   "%d migrations applied")
+            if result.ok else "FAILED (%s)" % result.error))
+
+    if rollout.run(report):
+        print("Migrated %s" % plural(len(uris), "%d database",
+                                    "%d databases"))
+        return 0
+    print("Rollout stopped: %s. %d of %d databases migrated" % (
+        rollout.stopped, sum(1 for r in rollout.results if r.ok), len(uris)))
+    return 1
+
+
 def make_argparser():
 
     min_verbosity = min(verbosity_levels)
     max_verbosity = max(verbosity_levels)
 
     argparser = argparse.ArgumentParser()
-    argparser.add_argument("command", choices=['apply', 'rollback', 'reapply'])
+    argparser.add_argument("command", choices=['apply', 'rollback', 'reapply',
+                                                'verify', 'watch',
+                                                'analyze', 'estimate'])
     argparser.add_argument("migrations_dir",
                            help="Directory containing migration scripts")
     argparser.add_argument("database", nargs="?", default=None,
@@ -146,9 +340,20 @@ def make_argparser():
                            help="Select migrations matching PATTERN "
                             "(perl-compatible regular expression)",
                            metavar='PATTERN')
+    argparser.add_argument("--order", dest="order",
+                           choices=['lexical', 'natural', 'numeric'],
+                           default='lexical',
+                           help="Order to apply migrations in: by name, "
+                                "by name comparing numbers numerically, or "
+                                "by each name's leading number "
+                                "(default: %(default)s)")
     argparser.add_argument("-a", "--all", dest="all", action="store_true",
                            help="Select all migrations, regardless of whether "
                                 "they have been previously applied")
+    argparser.add_argument("--to", dest="target", metavar="ID",
+                           help="Apply migrations up to and including ID, "
+                                "or roll back migrations applied after ID. "
+                                "Implies --batch")
     argparser.add_argument("-b", "--batch", dest="batch", action="store_true",
                            help="Run in batch mode (don't ask before "
                                 "applying/rolling back each migration)")
@@ -174,9 +379,120 @@ def make_argparser():
                            help="Name of table to use for storing "
                                 "migration metadata")
 
+    argparser.add_argument("--lock-timeout", dest="lock_timeout",
+                           type=float, metavar="SECONDS",
+                           help="Fail steps that wait longer than SECONDS "
+                                "to acquire a lock")
+    argparser.add_argument("--statement-timeout", dest="statement_timeout",
+                           type=float, metavar="SECONDS",
+                           help="Fail statements that run for longer than "
+                                "SECONDS")
+    argparser.add_argument("--lock-retries", dest="lock_retries", type=int,
+                           metavar="N",
+                           help="Retry steps up to N times after a "
+                                "lock timeout (default: 0)")
+    argparser.add_argument("--retry-backoff", dest="retry_backoff",
+                           type=float, metavar="SECONDS",
+                           help="Wait SECONDS before the first retry after "
+                                "a lock timeout, doubling the wait for each "
+                                "subsequent retry (default: 1)")
+
+    argparser.add_argument("--fail-on", dest="fail_on",
+                           choices=['info', 'warning', 'error'],
+                           default='warning',
+                           help="Lowest severity of analyze findings that "
+                                "causes a non-zero exit status "
+                                "(default: %(default)s)")
+    argparser.add_argument("--bootstrap", dest="bootstrap",
+                           action="store_true",
+                           help="Create a fresh database quickly, applying "
+                                "all migrations in one transaction with "
+                                "durability relaxed and index builds "
+                                "deferred. Only allowed when no migrations "
+                                "have been applied")
+    argparser.add_argument("--progress", dest="progress",
+                           action="store_true",
+                           help="Show the progress of migrations with the "
+                                "estimated time remaining")
+    argparser.add_argument("--refresh-stats", dest="refresh_stats",
+                           action="store_true",
+                           help="After applying migrations, refresh the "
+                                "planner statistics (ANALYZE) of the tables "
+                                "they touched")
+    argparser.add_argument("--stats-workers", dest="stats_workers",
+                           type=int, default=1, metavar="N",
+                           help="Analyze up to N tables at once with "
+                                "--refresh-stats (default: %(default)s)")
+    argparser.add_argument("--merge-alters", dest="merge_alters",
+                           action="store_true",
+                           help="Merge consecutive ALTER TABLE steps on the "
+                                "same table into one statement, so that the "
+                                "table is rebuilt once (MySQL and "
+                                "PostgreSQL). Merged statements are shown "
+                                "with -vv")
+    argparser.add_argument("--interval", dest="interval", type=float,
+                           default=0.5, metavar="SECONDS",
+                           help="How often the watch command checks for "
+                                "changed migrations (default: %(default)s)")
+
+    argparser.add_argument("--databases", dest="databases", metavar="FILE",
+                           help="Apply migrations to each database "
+                                "connection string listed in FILE (one per "
+                                "line), in stages starting with a canary")
+    argparser.add_argument("--stages", dest="stages", default="1,10,100",
+                           help="Comma separated number of databases "
+                                "migrated in parallel in each stage of a "
+                                "--databases rollout (default: %(default)s)")
+    argparser.add_argument("--stage-timeout", dest="stage_timeout",
+                           type=float, metavar="SECONDS",
+                           help="Stop the rollout if a stage takes longer "
+                                "than SECONDS")
+    argparser.add_argument("--max-error-rate", dest="max_error_rate",
+                           type=float, default=0.0, metavar="RATE",
+                           help="Stop the rollout as soon as the "
+                                "proportion of databases failing exceeds "
+                                "RATE (default: %(default)s)")
+
+    argparser.add_argument("--profile", dest="profile", action="store_true",
+                           help="Report the time spent connecting, loading "
+                                "migrations, querying the database, "
+                                "prompting and applying migrations, and list "
+                                "the slowest migrations to load")
+    argparser.add_argument("--profile-output", dest="profile_output",
+                           metavar="FILE",
+                           help="Profile the run with cProfile and save the "
+                                "statistics to FILE for analysis with "
+                                "pstats. Implies --profile")
+
     return argparser
 
 
+def read_timeouts(args, config):
+    """
+    Return a ``Timeouts`` object from the command line options, falling back
+    to any defaults set in the config file, or ``None`` if no timeouts are
+    configured.
+    """
+    options = {}
+    for name, type in [('lock_timeout', float),
+                       ('statement_timeout', float),
+                       ('lock_retries', int),
+                       ('retry_backoff', float)]:
+        value = getattr(args, name)
+        if value is None:
+            try:
+                value = type(config.get('DEFAULT', name))
+            except (ValueError, NoSectionError, NoOptionError):
+                continue
+        options[name] = value
+    if not options:
+        return None
+    return Timeouts(lock_timeout=options.get('lock_timeout'),
+                    statement_timeout=options.get('statement_timeout'),
+                    retries=options.get('lock_retries', 0),
+                    backoff=options.get('retry_backoff', 1.0))
+
+
 def configure_logging(level):
     """
     Configure the python logging module with the requested loglevel
@@ -188,6 +504,9 @@ def main(argv=None):
 
     argparser = make_argparser()
     args = argparser.parse_args(argv)
+    if args.target:
+        # --to runs without prompting, including for the connection string
+        args.batch = True
 
     if args.verbosity_level:
         verbosity_level = args.verbosity_level
@@ -197,7 +516,6 @@ def main(argv=None):
     verbosity_level = max(verbosity_level, min(verbosity_levels))
     configure_logging(verbosity_level)
 
-    command = args.command
     migrations_dir = os.path.normpath(os.path.abspath(args.migrations_dir))
     dburi = args.database
 
@@ -226,6 +544,14 @@ def main(argv=None):
 
     config.set('DEFAULT', 'migration_table', migration_table)
 
+    timeouts = read_timeouts(args, config)
+
+    if args.databases:
+        if args.command != 'apply':
+            argparser.error("--databases can only be used with apply")
+        return rollout_migrations(args, migrations_dir, migration_table,
+                                  timeouts)
+
     if dburi is None:
         argparser.error(
             "Please specify command, migrations directory and "
@@ -263,40 +589,126 @@ def main(argv=None):
         config.set('DEFAULT', 'migration_table', migration_table)
         saveconfig(config, config_path)
 
-    conn, paramstyle = connect(dburi)
-
-    migrations = read_migrations(conn, paramstyle, migrations_dir,
-                                 migration_table=migration_table)
-
-    if args.match:
-        migrations = migrations.filter(
-            lambda m: re.search(args.match, m.id) is not None)
-
-    if not args.all:
-        if command in ['apply']:
-            migrations = migrations.to_apply()
+    profile = Profile(args.profile_output)
+    profile.start()
+    try:
+        return run_command(argparser, args, dburi, migrations_dir,
+                           migration_table, profile, timeouts,
+                           read_profiles(config))
+    finally:
+        profile.stop()
+        if args.profile or args.profile_output:
+            profile.report(sys.stderr)
 
-        elif command in ['reapply', 'rollback']:
-            migrations = migrations.to_rollback()
 
-    if not args.batch:
-        migrations = prompt_migrations(conn, paramstyle, migrations, command)
+def run_command(argparser, args, dburi, migrations_dir, migration_table,
+                profile, timeouts=None, resource_profiles=None):
+    """
+    Connect to the database and run the command given by ``args``,
+    recording the time taken by each phase in ``profile``. ``timeouts`` are
+    applied to each migration step run, and ``resource_profiles`` give the
+    settings for the resource profiles steps name.
+    """
+    command = args.command
 
-    if not args.batch and migrations:
-        if prompt(command.title() +
-                  plural(len(migrations), " %d migration", " %d migrations") +
-                  " to %s?" % dburi, "Yn") != 'y':
-            return 0
+    with profile.phase('connect'):
+        conn, paramstyle = connect(dburi)
+
+    if command == 'verify':
+        with profile.phase('load'):
+            migrations = read_migrations(conn, paramstyle, migrations_dir,
+                                         migration_table=migration_table,
+                                         load_steps=False, order=args.order)
+        profile.migrations = migrations
+        with profile.phase('state query'):
+            return verify_migrations(migrations)
+
+    with profile.phase('load'):
+        migrations = read_migrations(conn, paramstyle, migrations_dir,
+                                     migration_table=migration_table,
+                                     match=args.match, order=args.order)
+    history = migrations
+    migrations.timeouts = timeouts
+    migrations.merge_alters = args.merge_alters
+    migrations.resource_profiles = resource_profiles
+    migrations.refresh_stats = args.refresh_stats
+    migrations.stats_workers = args.stats_workers
+    profile.migrations = migrations
+
+    if command == 'watch':
+        return watch_migrations(migrations, migrations_dir, args.interval,
+                                args.order)
+
+    if args.bootstrap:
+        if command != 'apply':
+            argparser.error("--bootstrap can only be used with apply")
+        with profile.phase('apply'):
+            return bootstrap_migrations(migrations, args.force)
+
+    batch = args.batch
+    with profile.phase('state query'):
+        if args.target:
+            # Select the exact set of migrations from the target and run them
+            # without prompting
+            batch = True
+            try:
+                if command == 'apply':
+                    migrations = migrations.to_apply(args.target)
+                else:
+                    migrations = migrations.to_rollback(args.target)
+            except ValueError as e:
+                argparser.error(str(e))
+
+        elif not args.all:
+            if command in ['apply', 'analyze', 'estimate']:
+                migrations = migrations.to_apply()
+
+            elif command in ['reapply', 'rollback']:
+                migrations = migrations.to_rollback()
+
+    if command == 'analyze':
+        return analyze_migrations(migrations, get_backend(conn),
+                                  args.fail_on)
+
+    if command == 'estimate':
+        return estimate_migrations(migrations, history)
+
+    with profile.phase('prompt'):
+        if not batch:
+            migrations = prompt_migrations(conn, paramstyle, migrations,
+                                           command)
+
+        if not batch and migrations:
+            if prompt(command.title() +
+                      plural(len(migrations), " %d migration",
+                             " %d migrations") +
+                      " to %s?" % dburi, "Yn") != 'y':
+                return 0
+
+    batch_commit = bool(args.target)
+    if args.progress:
+        migrations.progress = Progress(
+            estimate(migrations, history) if command == 'apply' else [])
+
+    def run(direction):
+        with profile.phase(direction):
+            getattr(migrations, direction)(args.force,
+                                           batch_commit=batch_commit,
+                                           hooks=False)
+        if migrations:
+            with profile.phase('post-apply hooks'):
+                migrations.run_post_apply(direction, args.force)
 
     if command == 'reapply':
-        migrations.rollback(args.force)
-        migrations.apply(args.force)
+        run('rollback')
+        run('apply')
 
     elif command == 'apply':
-        migrations.apply(args.force)
+        run('apply')
 
     elif command == 'rollback':
-        migrations.rollback(args.force)
+        run('rollback')
+
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,268 @@
+"""
+Apply migrations to many database shards in parallel.
+
+Migration scripts are parsed once, in the parent process, and inherited by a
+pool of worker processes. Shards are grouped by database server: each worker
+takes a group, connects to the server once and, on MySQL, switches between
+the shard databases with ``USE``. The result for each shard is reported as
+soon as it completes::
+
+    from yoyo.shards import apply_to_shards
+
+    for result in apply_to_shards('migrations', shard_uris, processes=16):
+        print(result)
+"""
+from logging import getLogger
+import multiprocessing
+import os
+import re
+import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty  # noqa
+
+from yoyo.connections import connect, get_backend, parse_uri, unparse_uri
+from yoyo.migrations import (MigrationList, PostApplyHookMigration,
+                             default_migration_table, migration_scripts,
+                             read_migration)
+
+logger = getLogger(__name__)
+
+#: Statements switching a connection to another database on the same server
+switch_database_statements = {
+    'mysql': 'USE `%s`',
+}
+
+#: Connection schemes for which shards on the same server share a connection
+shared_connection_schemes = set(['mysql'])
+
+#: Migrations and post-apply hooks parsed by the parent process. Worker
+#: processes forked from the parent inherit these without parsing the
+#: migration scripts again.
+_migrations = None
+
+#: Queue used by worker processes to report the result for each shard
+_results = None
+
+#: Event set by the parent process when no further shards should be started
+_stop = None
+
+
+class ShardResult(object):
+    """
+    The outcome of applying migrations to one shard.
+    """
+
+    def __init__(self, uri, applied=None, error=None, duration=0):
+        #: The connection URI of the shard, without any password
+        self.uri = uri
+        #: The ids of the migrations applied
+        self.applied = applied or []
+        #: The error raised while migrating the shard, as a string
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<ShardResult %s %s>' % (
+            self.uri, 'ok' if self.ok else 'error: %s' % self.error)
+
+
+def load_migrations(directory, order='lexical', match=None):
+    """
+    Parse the migration scripts in ``directory``, returning a tuple of the
+    lists of migrations and post-apply hooks. ``order`` and ``match`` select
+    and sort the migrations as for ``read_migrations``.
+    """
+    migrations = []
+    hooks = []
+    if match is not None:
+        match = re.compile(match)
+    for name in migration_scripts(directory, order):
+        if match is not None and not name.startswith('post-apply') \
+                and not match.search(name):
+            continue
+        migration = read_migration(os.path.join(directory, name + '.py'))
+        if migration is None:
+            continue
+        if isinstance(migration, PostApplyHookMigration):
+            hooks.append(migration)
+        else:
+            migrations.append(migration)
+    return migrations, hooks
+
+
+def group_by_server(uris):
+    """
+    Group ``uris`` into lists of shards that can share a connection to the
+    same database server, preserving the order of ``uris``.
+    """
+    groups = []
+    by_server = {}
+    for uri in uris:
+        scheme, username, password, host, port, database, db_params = \
+            parse_uri(uri)
+        if scheme.lower() not in shared_connection_schemes:
+            groups.append([uri])
+            continue
+        key = (scheme.lower(), username, password, host, port,
+               tuple(sorted((db_params or {}).items())))
+        if key not in by_server:
+            by_server[key] = []
+            groups.append(by_server[key])
+        by_server[key].append(uri)
+    return groups
+
+
+def safe_uri(uri):
+    """
+    Return ``uri`` with any password removed.
+    """
+    parts = list(parse_uri(uri))
+    parts[2] = None
+    return unparse_uri(parts)
+
+
+def switch_database(conn, database):
+    """
+    Switch ``conn`` to ``database`` on the same server.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(switch_database_statements[get_backend(conn)] %
+                       (database,))
+    finally:
+        cursor.close()
+
+
+def apply_shard(conn, paramstyle, migration_table, timeouts=None):
+    """
+    Apply the pending migrations parsed by ``load_migrations`` to the
+    database ``conn`` is connected to. Return the list of migrations applied.
+    """
+    migrations, hooks = _migrations
+    migrations = MigrationList(conn, paramstyle, migration_table,
+                               list(migrations), list(hooks))
+    migrations.timeouts = timeouts
+    pending = migrations.to_apply()
+    pending.apply()
+    return pending
+
+
+def apply_group(uris, migration_table, timeouts=None):
+    """
+    Apply migrations to each shard in ``uris``, reusing one connection to
+    the server where possible, and report each result to the parent. Once
+    the parent sets ``_stop``, remaining shards are reported as ``None``
+    without being migrated.
+    """
+    conn = paramstyle = None
+    for uri in uris:
+        if _stop.is_set():
+            _results.put(None)
+            continue
+        started = time.time()
+        try:
+            if conn is None:
+                conn, paramstyle = connect(uri)
+            else:
+                switch_database(conn, parse_uri(uri)[5])
+            applied = apply_shard(conn, paramstyle, migration_table,
+                                  timeouts)
+            result = ShardResult(safe_uri(uri), [m.id for m in applied],
+                                 duration=time.time() - started)
+        except Exception as e:
+            logger.exception("Error migrating %s", safe_uri(uri))
+            result = ShardResult(safe_uri(uri), error='%s: %s' % (
+                type(e).__name__, e), duration=time.time() - started)
+            # The connection may be unusable after an error
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            conn = None
+        _results.put(result)
+    if conn is not None:
+        conn.close()
+
+
+def _init_worker(directory, results, stop, order='lexical', match=None):
+    global _migrations, _results, _stop
+    _results = results
+    _stop = stop
+    if _migrations is None:
+        # Worker processes not forked from the parent must parse the
+        # migrations themselves
+        _migrations = load_migrations(directory, order, match)
+
+
+def apply_to_shards(directory, uris, processes=None,
+                    migration_table=default_migration_table, timeouts=None,
+                    migrations=None, deadline=None, order='lexical',
+                    match=None, stop=None):
+    """
+    Apply the migrations in ``directory`` to each database in ``uris`` using
+    a pool of ``processes`` worker processes (by default, one per CPU).
+
+    Yield a ``ShardResult`` for each shard as it completes. Errors migrating
+    a shard are reported in its result and do not stop other shards being
+    migrated.
+
+    ``order`` and ``match`` select and sort the migrations as for
+    ``read_migrations``. ``migrations`` may give migrations already parsed
+    by ``load_migrations``.
+
+    No further shards are started once the time given by ``deadline`` has
+    passed, or once ``stop``, a function called after each result is
+    yielded, returns true. Shards already being migrated are allowed to
+    finish and their results are yielded.
+    """
+    global _migrations
+    _migrations = migrations or load_migrations(directory, order, match)
+    groups = group_by_server(uris)
+    if not groups:
+        return
+    processes = min(processes or multiprocessing.cpu_count(), len(groups))
+    results = multiprocessing.Queue()
+    stopping = multiprocessing.Event()
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (directory, results, stopping, order, match))
+    try:
+        tasks = [pool.apply_async(apply_group,
+                                  (group, migration_table, timeouts))
+                 for group in groups]
+        pool.close()
+        remaining = len(uris)
+        while remaining:
+            if not stopping.is_set() and deadline is not None \
+                    and time.time() > deadline:
+                logger.error("Time limit exceeded with %d shards remaining: "
+                             "waiting for shards in progress", remaining)
+                stopping.set()
+            try:
+                result = results.get(timeout=0.1)
+            except Empty:
+                for task in tasks:
+                    if task.ready() and not task.successful():
+                        # Re-raise errors from outside of migrating a shard
+                        task.get()
+                continue
+            remaining -= 1
+            if result is None:
+                # Skipped after stopping
+                continue
+            yield result
+            if not stopping.is_set() and stop is not None and stop():
+                stopping.set()
+    finally:
+        # Let workers finish the shard they are migrating rather than
+        # terminating them part way through
+        stopping.set()
+        pool.close()
+        pool.join()
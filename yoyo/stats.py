@@ -0,0 +1,117 @@
+"""
+Refresh planner statistics for the tables touched by applied migrations.
+
+After a large backfill or table rewrite the planner's statistics are stale
+until autovacuum or autoanalyze next runs. ``refresh_statistics`` runs
+``ANALYZE`` (``ANALYZE TABLE`` on MySQL) over just the tables the
+migrations touched, found by parsing the SQL of each step, or declared
+with the ``touches`` argument of ``step``::
+
+    step(copy_orders, touches=['orders'])
+"""
+from logging import getLogger
+import re
+
+from yoyo import catalog
+from yoyo.connections import connection_uri, get_backend
+from yoyo.migrations import IndexStep, MigrationStep, step_statements
+from yoyo.utils import query, run_in_threads
+
+logger = getLogger(__name__)
+
+#: Statements refreshing the statistics for a table, for each backend
+analyze_statements = {
+    'postgresql': 'ANALYZE %s',
+    'mysql': 'ANALYZE TABLE %s',
+    'sqlite': 'ANALYZE %s',
+}
+
+_name = r'([\w."`]+)'
+
+#: Patterns matching statements that change the contents of a table, with
+#: the table name as the first group
+touched_table_patterns = [re.compile(p, re.I | re.S) for p in [
+    r'^\s*UPDATE\s+(?:ONLY\s+)?' + _name,
+    r'^\s*INSERT\s+(?:IGNORE\s+)?INTO\s+' + _name,
+    r'^\s*(?:REPLACE|MERGE)\s+INTO\s+' + _name,
+    r'^\s*DELETE\s+FROM\s+(?:ONLY\s+)?' + _name,
+    r'^\s*ALTER\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?' + _name,
+    r'^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\b.*?\bON\s+(?:ONLY\s+)?' + _name,
+    r'^\s*CREATE\s+TABLE\s+' + _name + r'.*?\bAS\s+SELECT\b',
+    r'^\s*COPY\s+' + _name,
+    r'^\s*LOAD\s+DATA\b.*?\bINTO\s+TABLE\s+' + _name,
+]]
+
+
+def touched_tables(step):
+    """
+    Return the list of tables whose contents ``step`` may change, in the
+    order they are first touched.
+    """
+    tables = []
+    for inner, sql in step_statements(step):
+        if isinstance(inner, IndexStep):
+            tables.append(inner.table)
+            continue
+        if isinstance(inner, MigrationStep):
+            tables.extend(inner.touches or [])
+        if sql is None:
+            continue
+        for pattern in touched_table_patterns:
+            match = pattern.search(sql)
+            if match:
+                tables.append(match.group(1))
+                break
+    return _unique(tables)
+
+
+def _unique(tables):
+    seen = set()
+    return [t for t in tables if not (t in seen or seen.add(t))]
+
+
+def migration_tables(migrations):
+    """
+    Return the deduplicated list of tables touched by ``migrations``.
+    """
+    return _unique(table for m in migrations for step in m.steps
+                   for table in touched_tables(step))
+
+
+def _analyze(conn, table):
+    statement = analyze_statements[get_backend(conn)] % (table,)
+    logger.debug(" - executing %r", statement)
+    # MySQL returns a result set for ANALYZE TABLE, which is fetched
+    query(conn, statement)
+    conn.commit()
+
+
+def refresh_statistics(conn, tables, workers=1):
+    """
+    Refresh the statistics for each of ``tables`` that still exists.
+
+    If ``workers`` is more than one, tables are analyzed concurrently on
+    that many new connections, opened with the URI ``conn`` was connected
+    with. Return the list of tables analyzed.
+    """
+    backend = get_backend(conn)
+    if backend not in analyze_statements:
+        logger.info("Refreshing statistics is not supported for %s",
+                    backend)
+        return []
+    if backend in catalog.catalog_queries:
+        # Skip tables dropped or renamed by a later migration
+        snapshot = catalog.load_catalog(conn)
+        tables = [t for t in tables
+                  if snapshot.has_table(t.split('.')[-1].strip('"`'))]
+    if not tables:
+        return []
+    logger.info("Refreshing statistics for %s", ', '.join(tables))
+
+    uri = connection_uri(conn)
+    if workers <= 1 or uri is None or ':memory:' in uri:
+        for table in tables:
+            _analyze(conn, table)
+        return tables
+    run_in_threads(uri, tables, _analyze, workers)
+    return tables
@@ -0,0 +1,32 @@
+from yoyo.analyze import analyze
+from yoyo.connections import connect
+from yoyo import read_migrations
+
+from yoyo.tests import with_migrations
+
+
+@with_migrations(
+    '''
+    from yoyo import step, index_step
+
+    step("CREATE INDEX foo_bar_idx ON foo (bar)")
+    step("ALTER TABLE foo ALTER COLUMN bar TYPE BIGINT")
+    step("UPDATE foo SET bar = 1; UPDATE foo SET baz = 1 WHERE id = 2")
+    step("CREATE INDEX CONCURRENTLY foo_baz_idx ON foo (baz)")
+    index_step('foo_qux_idx', 'foo', ['qux'])
+    '''
+)
+def test_analyze_flags_locking_statements(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    findings = analyze(migrations, 'postgresql')
+    assert [(f.rule.name, f.severity) for f in findings] == [
+        ('index-not-concurrent', 'warning'),
+        ('alter-column-type', 'error'),
+        ('unbatched-update', 'warning'),
+    ]
+    assert findings[2].sql == 'UPDATE foo SET bar = 1'
+
+    # Rules are specific to the backend
+    assert [f.rule.name for f in analyze(migrations, 'sqlite')] == \
+        ['unbatched-update']
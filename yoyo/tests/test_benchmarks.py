@@ -0,0 +1,40 @@
+import json
+import os.path
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from yoyo.benchmarks import compare, main, phases, run_benchmarks
+
+
+def test_benchmarks_report_each_phase():
+    results = run_benchmarks([5], ['sqlite', 'fake'], repeat=1,
+                             trace_memory=False)
+    assert sorted(results) == sorted('%s:5:%s' % (driver, phase)
+                                     for driver in ['sqlite', 'fake']
+                                     for phase in phases)
+    assert results['fake:5:to_apply']['queries'] == 2
+    assert results['fake:5:apply']['commits'] > 5
+    assert results['sqlite:5:apply']['queries'] is None
+
+
+def test_compare_reports_regressions():
+    baseline = {'fake:5:apply': {'time': 1.0, 'queries': 10, 'commits': 5}}
+    results = {'fake:5:apply': {'time': 1.5, 'queries': 10, 'commits': 6}}
+    assert compare(baseline, results) == [
+        ('fake:5:apply', 'time 1000.0ms -> 1500.0ms'),
+        ('fake:5:apply', 'commits 5 -> 6'),
+    ]
+    assert compare(results, baseline) == []
+
+
+def test_main_saves_and_compares_results():
+    tmpdir = mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'results.json')
+        args = ['--sizes', '3', '--repeat', '1', '--no-memory']
+        assert main(args + ['--save', path]) == 0
+        with open(path) as f:
+            assert 'fake:3:read' in json.load(f)['results']
+        assert main(args + ['--compare', path, '--threshold', '1000']) == 0
+    finally:
+        rmtree(tmpdir)
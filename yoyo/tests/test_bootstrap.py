@@ -0,0 +1,72 @@
+from yoyo.bootstrap import BootstrapError, bootstrap
+from yoyo.connections import connect
+from yoyo import read_migrations
+
+from yoyo.tests import with_migrations
+
+
+@with_migrations(
+    '''
+    from yoyo import step, index_step
+    step("CREATE TABLE foo (id INT, bar INT)")
+    index_step('foo_bar_idx', 'foo', ['bar'])
+    index_step('foo_id_idx', 'foo', ['id'], unique=True)
+    ''',
+    '''
+    from yoyo import step
+    step("INSERT INTO foo VALUES (?, ?)",
+         params=[(n, n % 10) for n in range(100)])
+    ''',
+)
+def test_bootstrap(tmpdir):
+    conn, paramstyle = connect('fake:///%s/db.sqlite' % tmpdir)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    since = len(conn.trace)
+    bootstrap(migrations)
+
+    statements = [stmt for kind, stmt in conn.trace[since:]
+                  if kind in ('execute', 'executemany')]
+    assert 'PRAGMA synchronous = OFF' in statements
+    # The non-unique index is built after the table is populated
+    assert statements.index('CREATE UNIQUE INDEX foo_id_idx ON foo (id)') < \
+        statements.index('INSERT INTO foo VALUES (?, ?)') < \
+        statements.index('CREATE INDEX foo_bar_idx ON foo (bar)')
+    # Settings are restored afterwards
+    assert statements.index('PRAGMA synchronous = 2') > \
+        statements.index('CREATE INDEX foo_bar_idx ON foo (bar)')
+    assert not migrations.to_apply()
+
+    try:
+        bootstrap(migrations)
+    except BootstrapError:
+        pass
+    else:
+        raise AssertionError("Expected BootstrapError")
+
+
+@with_migrations(
+    '''
+    from yoyo import step, index_step
+    step("CREATE TABLE foo (id INT, bar INT)")
+    step("CREATE TABLE other (id INT)")
+    index_step('foo_bar_idx', 'foo', ['bar'])
+    index_step('other_id_idx', 'other', ['id'])
+    ''',
+    'step("INSERT INTO foo VALUES (1, 2)")',
+    'step("ALTER TABLE foo RENAME TO foo2")',
+    'step("INSERT INTO other VALUES (1)")',
+)
+def test_bootstrap_builds_deferred_index_before_table_is_altered(tmpdir):
+    conn, paramstyle = connect('fake:///%s/db.sqlite' % tmpdir)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    since = len(conn.trace)
+    bootstrap(migrations)
+
+    statements = [stmt for kind, stmt in conn.trace[since:]
+                  if kind in ('execute', 'executemany')]
+    assert statements.index('INSERT INTO foo VALUES (1, 2)') < \
+        statements.index('CREATE INDEX foo_bar_idx ON foo (bar)') < \
+        statements.index('ALTER TABLE foo RENAME TO foo2')
+    # Indexes on tables no later step alters are still built last
+    assert statements.index('INSERT INTO other VALUES (1)') < \
+        statements.index('CREATE INDEX other_id_idx ON other (id)')
@@ -0,0 +1,69 @@
+from yoyo.connections import connect
+from yoyo import read_migrations
+
+from yoyo.tests import with_migrations
+
+
+@with_migrations(
+    '''
+    from yoyo import step, table_missing, column_missing, index_missing
+
+    step("CREATE TABLE foo (id INT)", "DROP TABLE foo",
+         precondition=table_missing('foo'))
+    step("ALTER TABLE foo ADD COLUMN bar INT",
+         precondition=column_missing('foo', 'bar'))
+    step("ALTER TABLE foo ADD COLUMN baz INT",
+         precondition=column_missing('foo', 'baz'))
+    step("CREATE INDEX foo_bar_idx ON foo (bar)",
+         precondition=index_missing('foo_bar_idx'))
+    step("CREATE INDEX foo_baz_idx ON foo (baz)",
+         precondition=index_missing('FOO_BAZ_IDX'))
+    '''
+)
+def test_steps_are_skipped_when_preconditions_fail(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE foo (id INT, bar INT)")
+    cursor.execute("CREATE INDEX foo_bar_idx ON foo (bar)")
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+
+    since = len(conn.trace)
+    migrations.apply()
+    statements = [stmt for kind, stmt in conn.trace[since:]
+                  if kind == 'execute']
+    assert 'CREATE TABLE foo (id INT)' not in statements
+    assert 'ALTER TABLE foo ADD COLUMN bar INT' not in statements
+    assert 'CREATE INDEX foo_bar_idx ON foo (bar)' not in statements
+    assert 'ALTER TABLE foo ADD COLUMN baz INT' in statements
+    assert 'CREATE INDEX foo_baz_idx ON foo (baz)' in statements
+    assert conn.counts(since)['rollbacks'] == 0
+    # The snapshot is loaded once, then again after the schema changes
+    assert len([s for s in statements if 'sqlite_master' in s]) == 4
+
+    cursor.execute("PRAGMA index_list(foo)")
+    assert sorted(row[1] for row in cursor.fetchall()) == \
+        ['foo_bar_idx', 'foo_baz_idx']
+
+
+@with_migrations(
+    '''
+    from yoyo import step, table_exists
+
+    step("CREATE TABLE foo (id INT)")
+    for n in range(5):
+        step("INSERT INTO foo VALUES (%d)" % n,
+             precondition=table_exists('foo'))
+    '''
+)
+def test_row_changes_keep_the_snapshot(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    since = len(conn.trace)
+    migrations.apply()
+    statements = [stmt for kind, stmt in conn.trace[since:]
+                  if kind == 'execute']
+    # Loaded once after the table is created, and not after each insert
+    assert len([s for s in statements if 'sqlite_master' in s]) == 2
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(1) FROM foo")
+    assert cursor.fetchall() == [(5,)]
@@ -1,8 +1,12 @@
 import os.path
+import pstats
 
 from mock import patch, call
 
+from yoyo.compat import StringIO
+
 from yoyo.tests import with_migrations, dburi
+from yoyo.connections import connect
 from yoyo.scripts.migrate import main
 
 
@@ -69,3 +73,38 @@ class TestYoyoScript(object):
             migrations = read_migrations().to_rollback()
             assert migrations.rollback.call_count == 1
             assert migrations.apply.call_count == 1
+
+    @with_migrations('step("CREATE TABLE test (id INT)")')
+    def test_it_verifies_migrations(self, tmpdir):
+        dbpath = os.path.join(tmpdir, 'db.sqlite')
+        uri = 'sqlite:///' + dbpath
+        main(['-b', 'apply', tmpdir, uri])
+        assert main(['verify', tmpdir, uri]) == 0
+        with open(os.path.join(tmpdir, '0.py'), 'a') as f:
+            f.write('\nstep("CREATE TABLE test2 (id INT)")')
+        assert main(['verify', tmpdir, uri]) == 1
+
+    @with_migrations('step("CREATE TABLE a (id INT)", "DROP TABLE a")',
+                     'step("CREATE TABLE b (id INT)", "DROP TABLE b")')
+    def test_it_rolls_back_to_target(self, tmpdir):
+        uri = 'sqlite:///' + os.path.join(tmpdir, 'db.sqlite')
+        main(['apply', '--to', '0', tmpdir, uri])
+        assert self.prompt.call_count == 0
+        main(['-b', 'apply', tmpdir, uri])
+        main(['rollback', '--to', '0', tmpdir, uri])
+        conn, paramstyle = connect(uri)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM _yoyo_migration")
+        assert cursor.fetchall() == [('0',)]
+
+    @with_migrations('step("CREATE TABLE a (id INT)")')
+    def test_it_profiles_the_run(self, tmpdir):
+        statsfile = os.path.join(tmpdir, 'stats')
+        with patch('sys.stderr', new_callable=StringIO) as stderr:
+            main(['-b', '--profile-output', statsfile, 'apply', tmpdir,
+                  dburi])
+        report = stderr.getvalue()
+        for phase in ['connect', 'load', 'state query', 'apply', 'total']:
+            assert phase in report
+        assert 'Slowest migrations to load (of 1)' in report
+        assert pstats.Stats(statsfile).total_calls > 0
@@ -0,0 +1,90 @@
+from yoyo.compat import StringIO
+from yoyo.connections import connect
+from yoyo.estimate import Estimator, Progress, TableStats, estimate
+from yoyo.estimate import table_statistics
+from yoyo import read_migrations
+
+from yoyo.tests import with_migrations
+
+
+@with_migrations(
+    '''
+    from yoyo import step
+    step("UPDATE foo SET bar = 1")
+    ''',
+    '''
+    from yoyo import step
+    step("CREATE INDEX foo_bar_idx ON foo (bar)")
+    ''',
+    '''
+    from yoyo import step
+    step("UPDATE foo SET bar = 2; UPDATE baz SET qux = 1")
+    ''',
+)
+def test_estimate_uses_recorded_durations(tmpdir):
+    conn, paramstyle = connect('sqlite:///:memory:')
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE foo (bar INT)")
+    cursor.execute("CREATE TABLE baz (qux INT)")
+    cursor.executemany("INSERT INTO foo VALUES (?)", [(i,) for i in range(10)])
+    cursor.executemany("INSERT INTO baz VALUES (?)", [(i,) for i in range(30)])
+    cursor.execute("ANALYZE")
+    conn.commit()
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.filter(lambda m: m.id == '0').apply()
+    cursor.execute("UPDATE _yoyo_migration SET duration = 5")
+    conn.commit()
+
+    pending = migrations.to_apply()
+    estimates = estimate(pending, history=migrations)
+    # No index has been built before: fall back to the mean duration
+    assert [(e.operation, e.rows, e.seconds) for e in estimates] == [
+        ('index', 10, 5.0),
+        ('update', 40, 20.0),
+    ]
+
+    # Without any history there is nothing to go on
+    assert [e.seconds for e in estimate(pending)] == [None, None]
+
+
+def test_sqlite_statistics_are_not_counted():
+    conn, paramstyle = connect('fake:///:memory:')
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE foo (bar INT)")
+    cursor.execute("INSERT INTO foo VALUES (1)")
+    assert table_statistics(conn) == {}
+    cursor.execute("ANALYZE")
+    assert dict((k, v.rows) for k, v in table_statistics(conn).items()) == \
+        {'foo': 1}
+    assert not [stmt for kind, stmt in conn.trace if 'COUNT(' in stmt]
+
+
+@with_migrations(
+    'step("CREATE INDEX a_idx ON a (id)")',
+    'step("CREATE INDEX b_idx ON b (id)")',
+)
+def test_index_estimates_use_table_sizes(tmpdir):
+    conn, paramstyle = connect('sqlite:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    estimator = Estimator({'a': TableStats(10, 1000),
+                           'b': TableStats(10, 3000)})
+    estimator.fit([(migrations[0], 2.0)])
+    e = estimator.estimate(migrations[1])
+    assert (e.operation, e.rows, e.bytes, e.seconds) == \
+        ('index', 10, 3000, 6.0)
+
+
+@with_migrations(
+    'step("CREATE TABLE a (id INT)")',
+    'step("CREATE TABLE b (id INT)")',
+)
+def test_progress_reports_time_remaining(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    out = StringIO()
+    migrations.progress = Progress(estimate(migrations), out=out)
+    migrations.apply()
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0].startswith('[1/2] 0 0s, elapsed 0s')
+    assert lines[1].startswith('[2/2] 1 0s, elapsed 0s')
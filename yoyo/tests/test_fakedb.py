@@ -0,0 +1,58 @@
+import time
+
+from yoyo.connections import connect
+from yoyo.fakedb import RoundTripBudgetExceeded
+from yoyo import read_migrations
+
+from yoyo.tests import with_migrations
+
+
+def test_it_injects_latency():
+    conn, paramstyle = connect('fake:///:memory:?query_latency=0.02'
+                               '&commit_latency=0.05')
+    started = time.time()
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1")
+    cursor.execute("SELECT 2")
+    conn.commit()
+    assert time.time() - started >= 0.09
+    assert conn.trace == [('execute', 'SELECT 1'), ('execute', 'SELECT 2'),
+                          ('commit', None)]
+
+
+def test_budget_raises_when_exceeded():
+    conn, paramstyle = connect('fake:///:memory:')
+    with conn.budget(queries=1, commits=0):
+        conn.cursor().execute("SELECT 1")
+    try:
+        with conn.budget(queries=1):
+            conn.cursor().execute("SELECT 1")
+            conn.cursor().execute("SELECT 2")
+    except RoundTripBudgetExceeded as e:
+        assert 'queries: 2 > 1' in str(e)
+        assert 'SELECT 2' in str(e)
+    else:
+        raise AssertionError("Expected RoundTripBudgetExceeded")
+
+
+@with_migrations(*[
+    'step("CREATE TABLE t%d (id INT)", "DROP TABLE t%d")' % (n, n)
+    for n in range(20)
+])
+def test_migration_round_trip_budgets(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+
+    with conn.budget(queries=2, commits=0):
+        pending = migrations.to_apply()
+    # One query and commit per step, plus one for each bookkeeping insert
+    with conn.budget(queries=41, commits=40):
+        pending.apply()
+    with conn.budget(queries=2, commits=0):
+        applied = migrations.to_rollback()
+    with conn.budget(queries=41, commits=40):
+        applied.rollback()
+    with conn.budget(queries=2, commits=0):
+        migrations.to_rollback('9')
+    with conn.budget(queries=1, commits=0):
+        read_migrations(conn, paramstyle, tmpdir)
@@ -0,0 +1,208 @@
+import os.path
+
+from mock import patch
+
+from yoyo.connections import connect
+from yoyo import (read_migrations, parallel_backfill, clear_backfill,
+                  stream_rows)
+from yoyo.migrations import _BatchCommitConnection
+
+from yoyo.tests import with_migrations
+
+
+@with_migrations(
+    '''
+    from yoyo import step, stream_rows
+
+    step("CREATE TABLE src (id INT)")
+    step("INSERT INTO src VALUES (?)", params=[(n,) for n in range(2500)])
+    step("CREATE TABLE dst (id INT)")
+
+    def copy(conn):
+        cursor = conn.cursor()
+        for (id,) in stream_rows(conn, "SELECT id FROM src WHERE id >= ?",
+                                 (500,), chunk=100):
+            cursor.execute("INSERT INTO dst VALUES (?)", (id * 2,))
+
+    step(copy)
+    '''
+)
+def test_stream_rows(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    read_migrations(conn, paramstyle, tmpdir).apply()
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(1), min(id), max(id) FROM dst")
+    assert cursor.fetchall() == [(2000, 1000, 4998)]
+
+
+@with_migrations(
+    '''
+    from yoyo import step, parallel_backfill
+
+    step("CREATE TABLE src (id INT, doubled INT)")
+    step("INSERT INTO src (id) VALUES (?)",
+         params=[(n,) for n in range(1, 1001)])
+    step(lambda conn: parallel_backfill(
+        conn, 'src', 'id',
+        "UPDATE src SET doubled = id * 2 WHERE id >= ? AND id < ?",
+        workers=4, chunk=100))
+    '''
+)
+def test_parallel_backfill(tmpdir):
+    conn, paramstyle = connect('fake:///%s/db.sqlite' % tmpdir)
+    read_migrations(conn, paramstyle, tmpdir).apply()
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(1) FROM src WHERE doubled = id * 2")
+    assert cursor.fetchall() == [(1000,)]
+    # Checkpoints are deleted once the backfill is complete
+    cursor.execute("SELECT lo, hi FROM _yoyo_backfill ORDER BY lo")
+    assert cursor.fetchall() == []
+    # Chunks ran on separate connections
+    assert not any('UPDATE src' in (stmt or '') for kind, stmt in conn.trace)
+
+
+def test_parallel_backfill_resumes_from_checkpoint():
+    conn, paramstyle = connect('sqlite:///:memory:')
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE src (id INT)")
+    cursor.executemany("INSERT INTO src VALUES (?)",
+                       [(n,) for n in range(50)])
+    ranges = []
+    interrupt = [True]
+
+    def backfill(conn, lo, hi):
+        if lo == 30 and interrupt.pop():
+            raise ValueError("interrupted")
+        ranges.append((lo, hi))
+
+    try:
+        parallel_backfill(conn, 'src', 'id', backfill, chunk=10)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
+    interrupt.append(False)
+    assert parallel_backfill(conn, 'src', 'id', backfill, chunk=10) == 2
+    assert ranges == [(0, 10), (10, 20), (20, 30), (30, 40), (40, 50)]
+
+
+def _backfill_source(path):
+    conn, paramstyle = connect('sqlite:///' + path)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE src (id INT, doubled INT)")
+    cursor.executemany("INSERT INTO src (id) VALUES (?)",
+                       [(n,) for n in range(100)])
+    conn.commit()
+    return conn
+
+
+@with_migrations()
+def test_parallel_backfill_sqlite(tmpdir):
+    conn = _backfill_source(os.path.join(tmpdir, 'db.sqlite'))
+    conns = set()
+
+    def backfill(worker_conn, lo, hi):
+        conns.add(id(worker_conn))
+        worker_conn.cursor().execute(
+            "UPDATE src SET doubled = id * 2 WHERE id >= ? AND id < ?",
+            (lo, hi))
+
+    assert parallel_backfill(conn, 'src', 'id', backfill, workers=2,
+                             chunk=10) == 10
+    # Chunks ran on separate connections opened from the sqlite URI
+    assert id(conn) not in conns
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(1) FROM src WHERE doubled = id * 2")
+    assert cursor.fetchall() == [(100,)]
+
+
+@with_migrations()
+def test_parallel_backfill_in_batch_transaction_is_serial(tmpdir):
+    conn = _BatchCommitConnection(
+        _backfill_source(os.path.join(tmpdir, 'db.sqlite')))
+    conns = set()
+
+    def backfill(worker_conn, lo, hi):
+        conns.add(worker_conn)
+
+    assert parallel_backfill(conn, 'src', 'id', backfill, workers=2,
+                             chunk=10) == 10
+    assert conns == set([conn])
+
+
+@with_migrations(
+    '''
+    from yoyo import step, parallel_backfill, clear_backfill
+
+    step("CREATE TABLE src (id INT, a INT, b INT)", "DROP TABLE src")
+    step("INSERT INTO src (id) VALUES (?)",
+         params=[(n,) for n in range(1, 101)])
+
+    def fill_a(conn, lo, hi):
+        conn.cursor().execute("UPDATE src SET a = id WHERE id >= ? AND id < ?",
+                              (lo, hi))
+
+    def fill_b(conn, lo, hi):
+        conn.cursor().execute("UPDATE src SET b = id WHERE id >= ? AND id < ?",
+                              (lo, hi))
+
+    step(lambda conn: parallel_backfill(conn, 'src', 'id', fill_a, chunk=10),
+         "UPDATE src SET a = NULL")
+    step(lambda conn: parallel_backfill(conn, 'src', 'id', fill_b, chunk=10),
+         "UPDATE src SET b = NULL")
+    '''
+)
+def test_parallel_backfills_on_the_same_key_can_be_reapplied(tmpdir):
+    conn, paramstyle = connect('sqlite:///%s/db.sqlite' % tmpdir)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    cursor = conn.cursor()
+    for n in range(2):
+        migrations.apply()
+        cursor.execute("SELECT count(1) FROM src WHERE a = id AND b = id")
+        assert cursor.fetchall() == [(100,)]
+        migrations.rollback()
+
+
+def test_parallel_backfill_requires_a_name_for_lambdas():
+    conn, paramstyle = connect('sqlite:///:memory:')
+    conn.cursor().execute("CREATE TABLE src (id INT)")
+    try:
+        parallel_backfill(conn, 'src', 'id', lambda conn, lo, hi: None)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
+    parallel_backfill(conn, 'src', 'id', lambda conn, lo, hi: None,
+                      name='noop')
+
+
+def test_clear_backfill():
+    conn, paramstyle = connect('sqlite:///:memory:')
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE src (id INT)")
+    cursor.executemany("INSERT INTO src VALUES (?)",
+                       [(n,) for n in range(50)])
+
+    def backfill(conn, lo, hi):
+        if lo == 30:
+            raise ValueError("interrupted")
+
+    try:
+        parallel_backfill(conn, 'src', 'id', backfill, chunk=10, name='b')
+    except ValueError:
+        pass
+    cursor.execute("SELECT count(1) FROM _yoyo_backfill")
+    assert cursor.fetchall() == [(3,)]
+    clear_backfill(conn, 'b')
+    cursor.execute("SELECT count(1) FROM _yoyo_backfill")
+    assert cursor.fetchall() == [(0,)]
+
+
+def test_stream_rows_translates_placeholders():
+    conn, paramstyle = connect('fake:///:memory:')
+    conn.yoyo_backend = 'postgresql'
+    with patch('yoyo.helpers._streamers', {}), \
+            patch('yoyo.helpers._stream_default') as stream:
+        stream_rows(conn, "SELECT id FROM t WHERE id >= ?", (1,), chunk=10)
+    stream.assert_called_once_with(conn, "SELECT id FROM t WHERE id >= %s",
+                                   (1,), 10)
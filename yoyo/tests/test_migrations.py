@@ -1,6 +1,16 @@
+import os.path
+import sys
+
+from mock import Mock, patch
+
 from yoyo.connections import connect
 from yoyo import read_migrations
 from yoyo import DatabaseError
+from yoyo import initialize_connection
+from yoyo.migrations import get_migrations_table_version, \
+    migration_table_schema_version, read_migration, merge_alter_steps, \
+    StepCollector, _BatchFailed, _execute_batch_mysql, \
+    _execute_batch_postgresql, step_statements
 
 from yoyo.tests import with_migrations, dburi
 
@@ -85,6 +95,26 @@ def test_execution_continues_with_ignore_errors_in_transaction(tmpdir):
     assert cursor.fetchall() == [(2,)]
 
 
+@with_migrations(
+    '''
+    step("CREATE TABLE test (id INT)")
+
+    def fill(conn):
+        conn.cursor().execute("INSERT INTO test VALUES (1)")
+        conn.commit()
+
+    step(fill, ignore_errors='apply')
+    '''
+)
+def test_ignore_errors_with_step_that_commits(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.apply()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM test")
+    assert cursor.fetchall() == [(1,)]
+
+
 @with_migrations(
     '''
     step("CREATE TABLE test (id INT)")
@@ -161,3 +191,459 @@ def test_migrations_can_import_step_and_transaction(tmpdir):
     cursor = conn.cursor()
     cursor.execute("SELECT id FROM test")
     assert cursor.fetchall() == [(1,)]
+
+
+@with_migrations(
+    'step("CREATE TABLE test (id INT)")',
+    'step("INSERT INTO test VALUES (1)")',
+)
+def test_verify_detects_changed_migrations(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.apply()
+    assert migrations.verify() == []
+
+    with open(os.path.join(tmpdir, '1.py'), 'w') as f:
+        f.write('step("INSERT INTO test VALUES (2)")')
+    os.unlink(os.path.join(tmpdir, '0.py'))
+
+    migrations = read_migrations(conn, paramstyle, tmpdir, load_steps=False)
+    drift = migrations.verify()
+    assert [(id, current is None) for id, stored, current in drift] == \
+        [('0', True), ('1', False)]
+    assert drift[1][2] == migrations[0].hash
+
+
+@with_migrations(
+    'step("CREATE TABLE test (id INT)")',
+    'step("INSERT INTO test VALUES (1)")',
+)
+def test_apply_records_duration_host_and_batch(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.apply()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, duration, hostname, batch_id "
+                   "FROM _yoyo_migration ORDER BY id")
+    rows = cursor.fetchall()
+    assert [row[0] for row in rows] == ['0', '1']
+    assert all(row[1] >= 0 for row in rows)
+    assert all(row[2] for row in rows)
+    assert rows[0][3] is not None and rows[0][3] == rows[1][3]
+
+
+def test_migrations_table_is_upgraded():
+    conn, paramstyle = connect(dburi)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE _yoyo_migration "
+                   "(id VARCHAR(255) NOT NULL PRIMARY KEY, ctime TIMESTAMP)")
+    cursor.execute("INSERT INTO _yoyo_migration VALUES ('0', NULL)")
+    conn.commit()
+
+    initialize_connection(conn, '_yoyo_migration')
+    assert get_migrations_table_version(conn, '_yoyo_migration') == \
+        migration_table_schema_version
+    cursor.execute("SELECT id, hash, duration, hostname, batch_id "
+                   "FROM _yoyo_migration")
+    assert cursor.fetchall() == [('0', None, None, None, None)]
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='index' "
+                   "AND tbl_name='_yoyo_migration' AND sql IS NOT NULL "
+                   "ORDER BY name")
+    assert cursor.fetchall() == [('_yoyo_migration_batch_id_idx',),
+                                 ('_yoyo_migration_ctime_idx',)]
+
+
+@with_migrations(
+    'step("CREATE TABLE a (id INT)", "DROP TABLE a")',
+    'step("CREATE TABLE b (id INT)", "DROP TABLE b")',
+    'step("CREATE TABLE c (id INT)", "DROP TABLE c")',
+)
+def test_apply_and_rollback_to_target(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    assert [m.id for m in migrations.to_apply('1')] == ['0', '1']
+    migrations.to_apply('1').apply(batch_commit=True)
+    assert migrations.applied_ids() == set(['0', '1'])
+
+    migrations.to_apply().apply()
+    assert [m.id for m in migrations.to_rollback('0')] == ['2', '1']
+    migrations.to_rollback('0').rollback(batch_commit=True)
+    assert migrations.applied_ids() == set(['0'])
+
+    try:
+        migrations.to_rollback('missing')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected a ValueError")
+
+
+@with_migrations(
+    'step("CREATE TABLE a (id INT)")',
+    'step("CREATE TABLE b (id INT)")',
+    'step("INSERT INTO b VALUES (1, 2)")',
+)
+def test_batch_commit_is_atomic(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    try:
+        migrations.apply(batch_commit=True)
+    except DatabaseError:
+        pass
+    else:
+        raise AssertionError("Expected a DatabaseError")
+    assert migrations.applied_ids() == set()
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('a', 'b')")
+    assert cursor.fetchall() == []
+
+
+@with_migrations(
+    '''
+    step("CREATE TABLE test (id INT, name VARCHAR(10))")
+    step("INSERT INTO test VALUES (?, ?)",
+         "DELETE FROM test WHERE id < ?",
+         params=((i, 'row %d' % i) for i in range(2500)),
+         rollback_params=(10,))
+    step("INSERT INTO test VALUES (?, ?)", params=(-1, 'single'))
+    '''
+)
+def test_steps_accept_parameters(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.apply()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(1), MIN(id), MAX(id) FROM test")
+    assert cursor.fetchall() == [(2501, -1, 2499)]
+    migrations[0].steps[1].steps[0].rollback(conn, paramstyle)
+    cursor.execute("SELECT COUNT(1) FROM test")
+    assert cursor.fetchall() == [(2490,)]
+
+
+@with_migrations(
+    '''
+    step("CREATE TABLE test (id INT)", "DROP TABLE test")
+    step("INSERT INTO test VALUES (?)", "DELETE FROM test",
+         params=((i,) for i in range(20)))
+    '''
+)
+def test_generator_params_can_be_reapplied(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    cursor = conn.cursor()
+    migrations.apply()
+    migrations.rollback()
+    migrations.apply()
+    cursor.execute("SELECT COUNT(1) FROM test")
+    assert cursor.fetchall() == [(20,)]
+
+
+@with_migrations(
+    'step("CREATE TABLE foo (id INT)", "DROP TABLE foo")',
+    'step("CREATE TABLE bar (id INT)", "DROP TABLE bar")',
+    'step("CREATE TABLE hook_log (id INT)", "DROP TABLE hook_log")',
+)
+def test_post_apply_hooks_run_only_when_relevant(tmpdir):
+    def write_hook(source):
+        with open(os.path.join(tmpdir, 'post-apply.py'), 'w') as f:
+            f.write(source)
+
+    def hook_runs():
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(1) FROM hook_log")
+        return cursor.fetchone()[0]
+
+    write_hook('depends_on(tables=["foo"])\n'
+               'step("INSERT INTO hook_log VALUES (1)")\n')
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.filter(lambda m: m.id == '2').apply()
+    # Never run before, so runs regardless of dependencies
+    assert hook_runs() == 1
+
+    migrations.filter(lambda m: m.id == '1').apply()
+    assert hook_runs() == 1
+
+    migrations.filter(lambda m: m.id == '0').apply()
+    assert hook_runs() == 2
+
+    write_hook('depends_on(migrations=["^1$"])\n'
+               'step("INSERT INTO hook_log VALUES (1)",\n'
+               '     "INSERT INTO hook_log VALUES (2)")\n')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.filter(lambda m: m.id == '0').rollback()
+    # Changed since last run
+    assert hook_runs() == 3
+    migrations.filter(lambda m: m.id == '0').apply()
+    assert hook_runs() == 3
+    migrations.filter(lambda m: m.id == '1').rollback()
+    assert hook_runs() == 4
+
+
+@with_migrations(
+    '''
+step("CREATE TABLE test (id INT, name VARCHAR(10))")
+index_step("test_name_idx", "test", ["name", "id"])
+    '''
+)
+def test_index_step(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    assert not migrations._can_batch_commit(force=False)
+    migrations.apply()
+    cursor = conn.cursor()
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name='test_name_idx'")
+    assert cursor.fetchall() == [
+        ('CREATE INDEX test_name_idx ON test (name, id)',)]
+    # Building an index which already exists is not an error
+    migrations[0].steps[1].apply(conn, paramstyle)
+    migrations.rollback()
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name='test_name_idx'")
+    assert cursor.fetchall() == []
+
+
+@with_migrations(*['step("SELECT 1")'] * 12)
+def test_migration_ordering(tmpdir):
+    conn, paramstyle = connect(dburi)
+    os.rename(os.path.join(tmpdir, '11.py'), os.path.join(tmpdir, 'a.py'))
+    os.rename(os.path.join(tmpdir, '10.py'), os.path.join(tmpdir, '2b.py'))
+    ids = lambda order: [m.id for m in read_migrations(conn, paramstyle,
+                                                       tmpdir, order=order)]
+    assert ids('lexical') == ['0', '1', '2', '2b', '3', '4', '5', '6', '7',
+                              '8', '9', 'a']
+    os.rename(os.path.join(tmpdir, '9.py'), os.path.join(tmpdir, '10.py'))
+    assert ids('lexical')[:4] == ['0', '1', '10', '2']
+    assert ids('natural') == ['0', '1', '2', '2b', '3', '4', '5', '6', '7',
+                              '8', '10', 'a']
+    assert ids('numeric') == ['0', '1', '2', '2b', '3', '4', '5', '6', '7',
+                              '8', '10', 'a']
+
+
+@with_migrations(
+    'step("CREATE TABLE a (id INT)")',
+    'step("CREATE TABLE b (id INT)")',
+    'step("CREATE TABLE c (id INT)")',
+)
+def test_unselected_migrations_are_not_loaded(tmpdir):
+    conn, paramstyle = connect(dburi)
+    with patch('yoyo.migrations.read_migration',
+               wraps=read_migration) as read:
+        migrations = read_migrations(conn, paramstyle, tmpdir,
+                                     names=['0', '2'])
+        assert [m.id for m in migrations] == ['0', '2']
+        migrations = read_migrations(conn, paramstyle, tmpdir,
+                                     match='^[02]$')
+        assert [m.id for m in migrations] == ['0', '2']
+    assert [os.path.basename(c[0][0]) for c in read.call_args_list] == \
+        ['0.py', '2.py'] * 2
+
+
+#: Batches of statements executed by ``execute_batch_individually``
+batches = []
+
+
+def execute_batch_individually(conn, statements):
+    batches.append(statements)
+    cursor = conn.cursor()
+    for ix, statement in enumerate(statements):
+        try:
+            cursor.execute(statement)
+        except DatabaseError:
+            raise _BatchFailed(ix, sys.exc_info())
+
+
+@with_migrations(
+    '''
+step("CREATE TABLE test (id INT)")
+transaction(
+    step("INSERT INTO test VALUES (1)"),
+    step("INSERT INTO test VALUES (2);"),
+    step("INSERT INTO test VALUES (?)", params=(9,)),
+    step("INSERT INTO test VALUES (3)"),
+    step("INSERT INTO test VALUES (4, 5)"),
+    ignore_errors='all',
+)
+    '''
+)
+def test_transaction_steps_are_batched(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    del batches[:]
+    with patch.dict('yoyo.migrations.batch_executors',
+                    {'sqlite': execute_batch_individually}), \
+            patch('yoyo.migrations.logger') as logger:
+        migrations.apply()
+    assert batches == [
+        ['INSERT INTO test VALUES (1)', 'INSERT INTO test VALUES (2)'],
+        ['INSERT INTO test VALUES (3)', 'INSERT INTO test VALUES (4, 5)'],
+    ]
+    # The error is attributed to the failing step
+    logger.exception.assert_called_once_with("Ignored error in step %d", 5)
+
+
+@with_migrations(
+    '''
+step("CREATE TABLE test (id INT)")
+step("INSERT INTO test VALUES (1)")
+transaction(
+    step("INSERT INTO test VALUES (2)"),
+    step("INSERT INTO test VALUES ('a', 'b')"),
+    ignore_errors='apply',
+)
+step("INSERT INTO test VALUES (3)")
+    ''',
+    'step("INSERT INTO test VALUES (4)")',
+)
+def test_ignored_errors_roll_back_to_savepoint(tmpdir):
+    conn, paramstyle = connect(dburi)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    assert migrations._can_batch_commit(force=False)
+    migrations.apply(batch_commit=True)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM test ORDER BY id")
+    assert cursor.fetchall() == [(1,), (3,), (4,)]
+    assert migrations.applied_ids() == set(['0', '1'])
+
+
+def test_postgresql_batch_releases_savepoint():
+    conn = Mock()
+    cursor = conn.cursor.return_value
+    _execute_batch_postgresql(conn, ['INSERT 1', 'INSERT 2'])
+    assert [c[0][0] for c in cursor.execute.call_args_list] == [
+        'SAVEPOINT yoyo_batch;\nINSERT 1;\nINSERT 2',
+        'RELEASE SAVEPOINT yoyo_batch',
+    ]
+
+
+def test_mysql_batch_falls_back_without_multi_statements():
+    conn = Mock()
+    cursor = conn.cursor.return_value
+    executed = []
+
+    def execute(sql):
+        if ';' in sql:
+            # The server rejects multi-statement queries without
+            # CLIENT.MULTI_STATEMENTS
+            raise DatabaseError("syntax error")
+        executed.append(sql)
+
+    cursor.execute.side_effect = execute
+    _execute_batch_mysql(conn, ['INSERT 1', 'INSERT 2'])
+    assert executed == ['INSERT 1', 'INSERT 2']
+
+    cursor.execute.side_effect = lambda sql: None
+    cursor.nextset.side_effect = DatabaseError("bad row")
+    try:
+        _execute_batch_mysql(conn, ['INSERT 1', 'INSERT 2'])
+    except _BatchFailed as e:
+        assert e.index == 1
+    else:
+        raise AssertionError("Expected _BatchFailed")
+
+
+
+def test_merge_alter_steps():
+    collector = StepCollector()
+    collector.step("ALTER TABLE big ADD COLUMN a INT",
+                   "ALTER TABLE big DROP COLUMN a")
+    collector.step("alter table big add column b INT;",
+                   "ALTER TABLE big DROP COLUMN b")
+    collector.step("ALTER TABLE big ADD COLUMN c INT")
+    collector.step("ALTER TABLE BIG ADD COLUMN c2 INT")
+    collector.step("ALTER TABLE other ADD COLUMN d INT")
+    collector.step("ALTER TABLE other ADD COLUMN e INT", ignore_errors='all')
+    collector.step("ALTER TABLE other ADD COLUMN f INT")
+    collector.step("ALTER TABLE other ADD COLUMN g INT")
+
+    assert merge_alter_steps(collector.steps, 'sqlite') == collector.steps
+    merged = merge_alter_steps(collector.steps, 'mysql')
+    assert [(t.steps[0]._apply, t.steps[0]._rollback) for t in merged] == [
+        ("ALTER TABLE big ADD COLUMN a INT, add column b INT",
+         "ALTER TABLE big DROP COLUMN b, DROP COLUMN a"),
+        ("ALTER TABLE big ADD COLUMN c INT", None),
+        ("ALTER TABLE BIG ADD COLUMN c2 INT", None),
+        ("ALTER TABLE other ADD COLUMN d INT", None),
+        ("ALTER TABLE other ADD COLUMN e INT", None),
+        ("ALTER TABLE other ADD COLUMN f INT, ADD COLUMN g INT", None),
+    ]
+
+
+def test_merge_alter_steps_modifiers():
+    collector = StepCollector()
+    collector.step("ALTER TABLE ONLY a ADD COLUMN x INT")
+    collector.step("ALTER TABLE ONLY b ADD COLUMN y INT")
+    collector.step("ALTER TABLE ONLY b ADD COLUMN z INT")
+    collector.step("ALTER TABLE IF EXISTS c ADD COLUMN x INT")
+    collector.step("ALTER TABLE IF EXISTS d ADD COLUMN x INT")
+    collector.step("ALTER TABLE d ADD COLUMN y INT")
+    merged = merge_alter_steps(collector.steps, 'postgresql')
+    assert [t.steps[0]._apply for t in merged] == [
+        "ALTER TABLE ONLY a ADD COLUMN x INT",
+        "ALTER TABLE ONLY b ADD COLUMN y INT, ADD COLUMN z INT",
+        "ALTER TABLE IF EXISTS c ADD COLUMN x INT",
+        "ALTER TABLE IF EXISTS d ADD COLUMN x INT",
+        "ALTER TABLE d ADD COLUMN y INT",
+    ]
+
+
+def test_merge_alter_steps_refuses_comments_and_literals():
+    statements = [
+        "ALTER TABLE t ADD COLUMN q INT -- comment",
+        "ALTER TABLE t ADD COLUMN r INT",
+        "ALTER TABLE t ADD COLUMN s INT /* comment */",
+        "ALTER TABLE t ADD COLUMN u TEXT DEFAULT 'a, ADD COLUMN v INT'",
+        "ALTER TABLE t ADD COLUMN w INT; DROP TABLE x",
+        "ALTER TABLE t ADD COLUMN y INT",
+    ]
+    collector = StepCollector()
+    for sql in statements:
+        collector.step(sql)
+    merged = merge_alter_steps(collector.steps, 'mysql')
+    assert [t.steps[0]._apply for t in merged] == statements
+
+
+def test_merge_alter_steps_refuses_partition_clauses():
+    statements = {
+        'postgresql': [
+            "ALTER TABLE t ADD COLUMN a INT",
+            "ALTER TABLE t ATTACH PARTITION t1 FOR VALUES IN (1)",
+            "ALTER TABLE t DETACH PARTITION t0",
+            "ALTER TABLE t ADD COLUMN b INT",
+        ],
+        'mysql': [
+            "ALTER TABLE t ADD COLUMN a INT",
+            "ALTER TABLE t PARTITION BY HASH(id) PARTITIONS 4",
+            "ALTER TABLE t ADD PARTITION (PARTITION p3 VALUES LESS THAN (30))",
+            "ALTER TABLE t DROP PARTITION p0",
+            "ALTER TABLE t REORGANIZE PARTITION p1 INTO (PARTITION p2)",
+            "ALTER TABLE t COALESCE PARTITION 2",
+            "ALTER TABLE t TRUNCATE PARTITION p1",
+            "ALTER TABLE t EXCHANGE PARTITION p1 WITH TABLE t2",
+            "ALTER TABLE t REBUILD PARTITION p1",
+            "ALTER TABLE t REMOVE PARTITIONING",
+            "ALTER TABLE t ADD COLUMN b INT",
+        ],
+    }
+    for backend, sqls in statements.items():
+        collector = StepCollector()
+        for sql in sqls:
+            collector.step(sql)
+        merged = merge_alter_steps(collector.steps, backend)
+        assert [t.steps[0]._apply for t in merged] == sqls
+
+
+def test_step_statements():
+    def fn(conn):
+        pass
+    collector = StepCollector()
+    sql = collector.step("UPDATE a SET x = 1; ; DELETE FROM b ")
+    python = collector.step(fn)
+    index = collector.index_step('a_idx', 'a', 'x')
+    t = collector.transaction(sql, python)
+    (inner_sql,), (inner_python,) = sql.steps, python.steps
+    assert list(step_statements(t)) == [
+        (inner_sql, "UPDATE a SET x = 1"),
+        (inner_sql, "DELETE FROM b"),
+        (inner_python, None),
+    ]
+    assert list(step_statements(index)) == [(index, None)]
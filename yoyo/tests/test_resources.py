@@ -0,0 +1,78 @@
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser  # noqa
+
+from yoyo.connections import connect
+from yoyo.resources import read_profiles
+from yoyo import read_migrations
+
+from yoyo.tests import with_migrations
+
+
+@with_migrations(
+    '''
+    from yoyo import step
+    step("CREATE TABLE foo (id INT)")
+    step("INSERT INTO foo VALUES (1)", resource_profile='big')
+    step("INSERT INTO foo VALUES (2)")
+    ''',
+    '''
+    from yoyo import step, resource_profile
+    resource_profile('big')
+    step("INSERT INTO foo VALUES (3)")
+    step("INSERT INTO foo VALUES (4)")
+    ''',
+)
+def test_resource_profiles(tmpdir):
+    config = ConfigParser()
+    config.add_section('profile:big')
+    config.set('profile:big', 'sqlite.cache_size', '-8192')
+    config.set('profile:big', 'postgresql.work_mem', '1GB')
+
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.resource_profiles = read_profiles(config)
+    since = len(conn.trace)
+    migrations.apply()
+    statements = [stmt for kind, stmt in conn.trace[since:]
+                  if kind == 'execute' and
+                  not stmt.startswith('INSERT INTO _')]
+    assert statements == [
+        'CREATE TABLE foo (id INT)',
+        'PRAGMA cache_size',
+        'PRAGMA cache_size = -8192',
+        'INSERT INTO foo VALUES (1)',
+        'PRAGMA cache_size = -2000',
+        'INSERT INTO foo VALUES (2)',
+        # The profile applies to the whole of the second migration
+        'PRAGMA cache_size',
+        'PRAGMA cache_size = -8192',
+        'INSERT INTO foo VALUES (3)',
+        'INSERT INTO foo VALUES (4)',
+        'PRAGMA cache_size = -2000',
+    ]
+
+
+@with_migrations(
+    'step("CREATE TABLE foo (id INT)")',
+    '''
+    from yoyo import step
+    step("CREATE TABLE bar (id INT)")
+    step("INSERT INTO bar VALUES (1)", resource_profile='missing')
+    '''
+)
+def test_unknown_resource_profile(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    since = len(conn.trace)
+    try:
+        migrations.apply()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
+    # Nothing was run, including the migration before the bad profile
+    assert [stmt for kind, stmt in conn.trace[since:]
+            if kind == 'execute'] == []
+    assert len(migrations.to_apply()) == 2
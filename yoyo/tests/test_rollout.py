@@ -0,0 +1,84 @@
+import multiprocessing
+import os.path
+import sqlite3
+
+from mock import patch
+
+from yoyo.rollout import Rollout
+
+from yoyo.tests import with_migrations
+
+
+def test_waves_repeat_the_last_stage():
+    rollout = Rollout('migrations', range(25), stages=[1, 4, 10])
+    assert [len(wave) for wave in rollout.waves()] == [1, 4, 10, 10]
+
+
+@with_migrations('step("CREATE TABLE a (id INT)")')
+def test_rollout_stops_on_error(tmpdir):
+    paths = [os.path.join(tmpdir, 'db%d.db' % n) for n in range(5)]
+    sqlite3.connect(paths[2]).execute("CREATE TABLE a (id INT)")
+    reported = []
+    rollout = Rollout(tmpdir, ['sqlite:///' + p for p in paths],
+                      stages=[1, 2])
+    assert not rollout.run(lambda stage, r: reported.append((stage, r.ok)))
+    # The other database in stage 2 is skipped if it was not yet started
+    # when the failure was reported
+    assert reported[0] == (1, True)
+    assert (2, False) in reported
+    assert set(reported[1:]) <= set([(2, False), (2, True)])
+    assert 'stage 2' in rollout.stopped
+    # The final stage was not started
+    for path in paths[3:]:
+        tables = sqlite3.connect(path).execute(
+            "SELECT name FROM sqlite_master WHERE name='a'").fetchall()
+        assert tables == []
+
+
+@with_migrations('step("CREATE TABLE a (id INT)")')
+def test_rollout_allows_errors_within_rate(tmpdir):
+    paths = [os.path.join(tmpdir, 'db%d.db' % n) for n in range(4)]
+    sqlite3.connect(paths[3]).execute("CREATE TABLE a (id INT)")
+    rollout = Rollout(tmpdir, ['sqlite:///' + p for p in paths],
+                      stages=[1, 3], max_error_rate=0.5)
+    assert rollout.run()
+    assert [r.ok for r in rollout.results].count(False) == 1
+
+
+def check_order_and_match(tmpdir):
+    # Applied lexically, 10 would run before 2 and fail
+    os.rename(os.path.join(tmpdir, '2.py'), os.path.join(tmpdir, 'x-3.py'))
+    os.rename(os.path.join(tmpdir, '0.py'), os.path.join(tmpdir, '2.py'))
+    os.rename(os.path.join(tmpdir, '1.py'), os.path.join(tmpdir, '10.py'))
+    paths = [os.path.join(tmpdir, 'db%d.db' % n) for n in range(2)]
+    rollout = Rollout(tmpdir, ['sqlite:///' + p for p in paths],
+                      stages=[1], order='numeric', match=r'^\d')
+    assert rollout.run()
+    assert [r.applied for r in rollout.results] == [['2', '10']] * 2
+    for path in paths:
+        conn = sqlite3.connect(path)
+        assert conn.execute("SELECT * FROM a").fetchall() == [(1,)]
+        assert conn.execute("SELECT name FROM sqlite_master "
+                            "WHERE name='skipped'").fetchall() == []
+
+
+@with_migrations(
+    'step("CREATE TABLE a (id INT)")',
+    'step("INSERT INTO a VALUES (1)")',
+    'step("CREATE TABLE skipped (id INT)")',
+)
+def test_rollout_uses_order_and_match(tmpdir):
+    check_order_and_match(tmpdir)
+
+
+@with_migrations(
+    'step("CREATE TABLE a (id INT)")',
+    'step("INSERT INTO a VALUES (1)")',
+    'step("CREATE TABLE skipped (id INT)")',
+)
+def test_rollout_uses_order_and_match_in_spawned_workers(tmpdir):
+    # Spawned workers parse the migrations again rather than inheriting
+    # those parsed by the parent
+    spawn = multiprocessing.get_context('spawn')
+    with patch('yoyo.shards.multiprocessing', spawn):
+        check_order_and_match(tmpdir)
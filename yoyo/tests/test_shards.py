@@ -0,0 +1,78 @@
+import os.path
+import sqlite3
+import time
+
+from yoyo.shards import apply_to_shards, group_by_server
+
+from yoyo.tests import with_migrations
+
+
+def test_shards_are_grouped_by_server():
+    uris = ['mysql://u:p@host1/shard1', 'mysql://u:p@host2/shard2',
+            'mysql://u:p@host1/shard3', 'sqlite:///a.db', 'sqlite:///b.db']
+    assert group_by_server(uris) == [
+        ['mysql://u:p@host1/shard1', 'mysql://u:p@host1/shard3'],
+        ['mysql://u:p@host2/shard2'],
+        ['sqlite:///a.db'],
+        ['sqlite:///b.db'],
+    ]
+
+
+@with_migrations(
+    'step("CREATE TABLE a (id INT)")',
+    'step("INSERT INTO a VALUES (1)")',
+)
+def test_apply_to_shards(tmpdir):
+    paths = [os.path.join(tmpdir, 'shard%d.db' % n) for n in range(4)]
+    # Creating the table fails on one shard
+    sqlite3.connect(paths[1]).execute("CREATE TABLE a (x INT, y INT)")
+    results = list(apply_to_shards(tmpdir, ['sqlite:///' + p for p in paths],
+                                   processes=2))
+    results = dict((r.uri, r) for r in results)
+    assert len(results) == 4
+    failed = results['sqlite:///' + paths[1]]
+    assert not failed.ok
+    assert 'OperationalError' in failed.error
+    for path in paths[0], paths[2], paths[3]:
+        assert results['sqlite:///' + path].applied == ['0', '1']
+        rows = sqlite3.connect(path).execute("SELECT * FROM a").fetchall()
+        assert rows == [(1,)]
+
+
+def _has_table(path):
+    return sqlite3.connect(path).execute(
+        "SELECT name FROM sqlite_master WHERE name='a'").fetchall() != []
+
+
+@with_migrations(
+    '''
+    import time
+    step("CREATE TABLE a (id INT)")
+    step(lambda conn: time.sleep(0.5))
+    '''
+)
+def test_stop_lets_shards_in_progress_finish(tmpdir):
+    paths = [os.path.join(tmpdir, 'shard%d.db' % n) for n in range(4)]
+    results = list(apply_to_shards(tmpdir, ['sqlite:///' + p for p in paths],
+                                   processes=1, stop=lambda: True))
+    # The second shard was already being migrated when the first reported
+    assert [r.uri for r in results] == ['sqlite:///' + p for p in paths[:2]]
+    assert all(r.ok for r in results)
+    assert [_has_table(p) for p in paths] == [True, True, False, False]
+
+
+@with_migrations(
+    '''
+    import time
+    step("CREATE TABLE a (id INT)")
+    step(lambda conn: time.sleep(0.5))
+    '''
+)
+def test_deadline_does_not_interrupt_shards(tmpdir):
+    paths = [os.path.join(tmpdir, 'shard%d.db' % n) for n in range(3)]
+    results = list(apply_to_shards(tmpdir, ['sqlite:///' + p for p in paths],
+                                   processes=1,
+                                   deadline=time.time() + 0.2))
+    assert [r.uri for r in results] == ['sqlite:///' + paths[0]]
+    assert results[0].applied == ['0']
+    assert [_has_table(p) for p in paths] == [True, False, False]
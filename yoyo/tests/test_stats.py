@@ -0,0 +1,34 @@
+from yoyo.connections import connect
+from yoyo.stats import migration_tables
+from yoyo import read_migrations
+
+from yoyo.tests import with_migrations
+
+
+@with_migrations(
+    '''
+    from yoyo import step, index_step
+    step("CREATE TABLE foo (id INT, bar INT)")
+    step("CREATE TABLE baz (id INT)")
+    step("CREATE TABLE tmp (id INT)")
+    step("INSERT INTO foo VALUES (1, 2)")
+    step("UPDATE baz SET id = 2")
+    index_step('foo_bar_idx', 'foo', ['bar'])
+    step("INSERT INTO tmp VALUES (1)")
+    step("DROP TABLE tmp")
+    step(lambda conn: None, touches=['qux'])
+    step("CREATE TABLE qux (id INT)")
+    '''
+)
+def test_refresh_stats(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    assert migration_tables(migrations) == ['foo', 'baz', 'tmp', 'qux']
+
+    migrations.refresh_stats = True
+    since = len(conn.trace)
+    migrations.apply()
+    analyzed = [stmt for kind, stmt in conn.trace[since:]
+                if stmt and stmt.startswith('ANALYZE')]
+    # Dropped tables are skipped
+    assert analyzed == ['ANALYZE foo', 'ANALYZE baz', 'ANALYZE qux']
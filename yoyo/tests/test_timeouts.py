@@ -0,0 +1,96 @@
+import os.path
+import sqlite3
+
+from mock import patch
+
+from yoyo.connections import connect
+from yoyo import read_migrations
+from yoyo import DatabaseError
+from yoyo.timeouts import Timeouts
+
+from yoyo.tests import with_migrations
+
+
+@with_migrations(
+    '''
+step("CREATE TABLE a (id INT)", lock_timeout=2)
+step("CREATE TABLE b (id INT)")
+step("CREATE TABLE c (id INT)")
+    '''
+)
+def test_timeouts_are_set_for_each_step(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.timeouts = Timeouts(lock_timeout=0.5)
+    migrations.to_apply().apply()
+    pragmas = [stmt for kind, stmt in conn.trace
+               if stmt and stmt.startswith('PRAGMA')]
+    assert pragmas == ['PRAGMA busy_timeout = 2000',
+                       'PRAGMA busy_timeout = 500',
+                       'PRAGMA busy_timeout = 5000']
+
+
+@with_migrations('step("CREATE TABLE a (id INT)")')
+def test_no_timeout_statements_by_default(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.apply()
+    assert not [stmt for kind, stmt in conn.trace
+                if stmt and stmt.startswith('PRAGMA')]
+
+
+@with_migrations('step("CREATE TABLE a (id INT)")')
+def test_lock_timeouts_are_retried(tmpdir):
+    path = os.path.join(tmpdir, 'test.db')
+    conn, paramstyle = connect('sqlite:///' + path)
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.timeouts = Timeouts(lock_timeout=0.01, retries=2, backoff=0.5)
+
+    blocker = sqlite3.connect(path)
+    blocker.execute("BEGIN EXCLUSIVE")
+    try:
+        with patch('yoyo.migrations.time.sleep') as sleep:
+            try:
+                migrations.apply()
+            except DatabaseError as e:
+                assert 'locked' in str(e)
+            else:
+                raise AssertionError("Expected a DatabaseError")
+        assert [c[0] for c in sleep.call_args_list] == [(0.5,), (1.0,)]
+    finally:
+        blocker.rollback()
+    migrations.apply()
+    assert migrations.to_apply() == []
+
+
+def test_backoff_is_capped():
+    timeouts = Timeouts(backoff=1, max_backoff=5)
+    assert [timeouts.delay(n) for n in range(5)] == [1, 2, 4, 5, 5]
+
+
+@with_migrations(
+    '''
+import sqlite3
+
+calls = []
+
+def locked(conn):
+    calls.append(1)
+    if len(calls) == 1:
+        raise sqlite3.OperationalError("database is locked")
+    conn.cursor().execute("INSERT INTO a VALUES (1)")
+
+step("CREATE TABLE a (id INT)")
+step(locked)
+    '''
+)
+def test_only_the_timed_out_step_is_retried(tmpdir):
+    conn, paramstyle = connect('sqlite:///' + os.path.join(tmpdir, 'test.db'))
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    migrations.timeouts = Timeouts(lock_timeout=1, retries=1)
+    with patch('yoyo.migrations.time.sleep') as sleep:
+        migrations.apply()
+    assert sleep.call_count == 1
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM a")
+    assert cursor.fetchall() == [(1,)]
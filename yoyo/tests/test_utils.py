@@ -0,0 +1,36 @@
+import threading
+
+from yoyo.connections import connect
+from yoyo.utils import query, run_in_threads
+
+from yoyo.tests import with_migrations
+
+
+def test_query_returns_rows_only_for_result_sets():
+    conn, paramstyle = connect('sqlite:///:memory:')
+    assert query(conn, "CREATE TABLE foo (bar INT)") is None
+    assert query(conn, "INSERT INTO foo VALUES (?)", (1,)) is None
+    assert query(conn, "SELECT bar FROM foo") == [(1,)]
+
+
+@with_migrations()
+def test_run_in_threads_reraises_first_error(tmpdir):
+    uri = 'sqlite:///%s/db.sqlite' % tmpdir
+    done = []
+    lock = threading.Lock()
+
+    def fn(conn, item):
+        if item == 3:
+            raise ValueError(item)
+        assert query(conn, "SELECT ?", (item,)) == [(item,)]
+        with lock:
+            done.append(item)
+
+    run_in_threads(uri, [1, 2], fn, 4)
+    assert sorted(done) == [1, 2]
+    try:
+        run_in_threads(uri, [3], fn, 2)
+    except ValueError as e:
+        assert e.args == (3,)
+    else:
+        raise AssertionError("Expected ValueError")
@@ -0,0 +1,53 @@
+import os.path
+
+from yoyo.connections import connect
+from yoyo import read_migrations
+from yoyo.watch import Watcher
+
+from yoyo.tests import with_migrations
+
+
+def write(tmpdir, name, source):
+    with open(os.path.join(tmpdir, name), 'w') as f:
+        f.write(source)
+
+
+def tables(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                   "AND name NOT LIKE '_yoyo%' ORDER BY name")
+    return [row[0] for row in cursor.fetchall()]
+
+
+@with_migrations(
+    'step("CREATE TABLE a (id INT)", "DROP TABLE a")',
+    'step("CREATE TABLE b (id INT)", "DROP TABLE b")',
+)
+def test_changed_migrations_are_reapplied(tmpdir):
+    conn, paramstyle = connect('fake:///:memory:')
+    migrations = read_migrations(conn, paramstyle, tmpdir)
+    watcher = Watcher(migrations, tmpdir)
+    migrations.apply()
+    assert tables(conn) == ['a', 'b']
+
+    assert watcher.changes() == ([], [])
+    write(tmpdir, '1.py', 'step("CREATE TABLE bb (id INT)", "DROP TABLE bb")')
+    write(tmpdir, '2.py', 'step("CREATE TABLE c (id INT)", "DROP TABLE c")')
+    changed, removed = watcher.changes()
+    assert changed == [os.path.join(tmpdir, '1.py'),
+                       os.path.join(tmpdir, '2.py')]
+
+    since = len(conn.trace)
+    applied = watcher.update(changed, removed)
+    assert [m.id for m in applied] == ['1', '2']
+    assert tables(conn) == ['a', 'bb', 'c']
+    # Unchanged migrations are not rolled back
+    assert not [stmt for kind, stmt in conn.trace[since:]
+                if stmt == 'DROP TABLE a']
+    assert [m.id for m in migrations] == ['0', '1', '2']
+    assert migrations.verify() == []
+
+    os.unlink(os.path.join(tmpdir, '2.py'))
+    watcher.update(*watcher.changes())
+    assert tables(conn) == ['a', 'bb']
+    assert [m.id for m in migrations] == ['0', '1']
@@ -0,0 +1,131 @@
+"""
+Lock and statement timeouts for migration steps.
+
+A step waiting for a lock behind a long running query blocks every other
+query that needs the same lock. Setting a lock timeout makes the step fail
+quickly instead, after which the step can be retried with exponential
+backoff.
+"""
+from logging import getLogger
+import math
+
+from yoyo.connections import get_backend
+from yoyo.utils import query
+
+logger = getLogger(__name__)
+
+#: Session settings used for each timeout by each backend, as
+#: ``(statement, reset statement, units per second)`` tuples
+timeout_statements = {
+    'postgresql': {
+        'lock_timeout': ("SET lock_timeout = %d",
+                         "SET lock_timeout = DEFAULT", 1000),
+        'statement_timeout': ("SET statement_timeout = %d",
+                              "SET statement_timeout = DEFAULT", 1000),
+    },
+    'mysql': {
+        'lock_timeout': ("SET SESSION lock_wait_timeout = %d",
+                         "SET SESSION lock_wait_timeout = DEFAULT", 1),
+        'statement_timeout': ("SET SESSION max_execution_time = %d",
+                              "SET SESSION max_execution_time = DEFAULT",
+                              1000),
+    },
+    'sqlite': {
+        # Python's sqlite3 module waits 5 seconds for locks by default
+        'lock_timeout': ("PRAGMA busy_timeout = %d",
+                         "PRAGMA busy_timeout = 5000", 1000),
+    },
+}
+
+#: Functions testing whether an exception was caused by a lock timeout
+lock_timeout_errors = {
+    'postgresql': lambda e: getattr(e, 'pgcode', None) == '55P03',
+    'mysql': lambda e: bool(e.args) and e.args[0] == 1205,
+    'sqlite': lambda e: 'database is locked' in str(e),
+}
+
+
+class Timeouts(object):
+    """
+    Timeouts applied while running migration steps, in seconds.
+
+    Steps failing because a lock could not be acquired within
+    ``lock_timeout`` are retried up to ``retries`` times, waiting ``backoff``
+    seconds before the first retry and doubling the wait for each following
+    retry, up to ``max_backoff``.
+    """
+
+    def __init__(self, lock_timeout=None, statement_timeout=None, retries=0,
+                 backoff=1.0, max_backoff=60.0):
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def for_step(self, step):
+        """
+        Return a dict of the timeouts for ``step``. Timeouts set on the step
+        take precedence over the global timeouts.
+        """
+        timeouts = {}
+        for setting in 'lock_timeout', 'statement_timeout':
+            value = getattr(step, setting, None)
+            if value is None:
+                value = getattr(self, setting)
+            timeouts[setting] = value
+        return timeouts
+
+    def delay(self, attempt):
+        """
+        Return the number of seconds to wait before retry number
+        ``attempt``, counting from zero.
+        """
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+
+class SessionTimeouts(object):
+    """
+    Track the timeouts set on a connection, so that statements are only
+    issued when a timeout changes.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = timeout_statements.get(get_backend(conn), {})
+        self.current = {}
+
+    def set(self, timeouts):
+        """
+        Set the session timeouts given in the dict ``timeouts``. Timeouts
+        that are ``None`` are reset to the database default.
+        """
+        for setting, value in sorted(timeouts.items()):
+            if setting not in self.statements or \
+                    self.current.get(setting) == value:
+                continue
+            statement, reset, scale = self.statements[setting]
+            if value is None:
+                self._execute(reset)
+            else:
+                self._execute(statement % int(math.ceil(value * scale)))
+            self.current[setting] = value
+
+    def reset(self):
+        """
+        Reset all timeouts that have been set to the database default.
+        """
+        self.set(dict((setting, None) for setting in self.current))
+
+    def _execute(self, statement):
+        logger.debug(" - executing %r", statement)
+        query(self.conn, statement)
+
+
+def is_lock_timeout(conn, exception):
+    """
+    Return true if ``exception`` was raised because a lock could not be
+    acquired in time.
+    """
+    test = lock_timeout_errors.get(get_backend(conn))
+    return test is not None and test(exception)
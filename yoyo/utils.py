@@ -1,5 +1,14 @@
 from __future__ import print_function
 import sys
+import threading
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty  # noqa
+
+from yoyo.compat import reraise
+from yoyo.connections import connect
 
 try:
     import termios
@@ -59,3 +68,56 @@ def plural(quantity, one, plural):
     if quantity == 1:
         return one.replace('%d', '%d' % quantity)
     return plural.replace('%d', '%d' % quantity)
+
+
+def query(conn, sql, params=None):
+    """
+    Execute ``sql`` on a new cursor of ``conn``, returning the rows fetched
+    if the statement returns any, or ``None``.
+    """
+    cursor = conn.cursor()
+    try:
+        if params is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, params)
+        return cursor.fetchall() if cursor.description else None
+    finally:
+        cursor.close()
+
+
+def run_in_threads(uri, items, fn, workers):
+    """
+    Call ``fn(conn, item)`` for each of ``items`` on ``workers`` threads,
+    each using its own connection opened with ``uri``. After the first
+    error no more items are started, and the error is reraised once every
+    thread has finished.
+    """
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+
+    def worker():
+        try:
+            conn = connect(uri)[0]
+            try:
+                while not errors:
+                    try:
+                        item = queue.get_nowait()
+                    except Empty:
+                        return
+                    fn(conn, item)
+            finally:
+                conn.close()
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for n in range(min(workers, queue.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        reraise(errors[0][0], errors[0][1], errors[0][2])
@@ -0,0 +1,125 @@
+"""
+Watch a migrations directory during development, re-applying migrations as
+they are edited.
+
+The database connection and parsed migrations are kept between changes.
+Only scripts whose modification time or size has changed are read again:
+if the old version of a changed migration was applied it is rolled back
+(using the old version's rollback steps) before the new version is applied.
+"""
+from logging import getLogger
+import os
+import sys
+import time
+
+from yoyo.migrations import read_migration, PostApplyHookMigration, sort_keys
+
+logger = getLogger(__name__)
+
+
+class Watcher(object):
+    """
+    Keep the migrations in ``migrations``, read from ``directory``, in sync
+    with the migration scripts on disk. ``order`` is the order the
+    migrations were read in (see ``yoyo.migrations.sort_keys``).
+    """
+
+    def __init__(self, migrations, directory, order='lexical'):
+        self.migrations = migrations
+        self.directory = directory
+        self.sort_key = sort_keys[order]
+        self.stats = self.stat_scripts()
+
+    def stat_scripts(self):
+        """
+        Return a dict mapping the path of each migration script to its
+        ``(mtime, size)``.
+        """
+        stats = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.py'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Removed since listing the directory
+                continue
+            stats[path] = (st.st_mtime, st.st_size)
+        return stats
+
+    def changes(self):
+        """
+        Return a tuple of the lists of paths changed (or added) and removed
+        since the last call.
+        """
+        stats = self.stat_scripts()
+        changed = sorted(path for path in stats
+                         if self.stats.get(path) != stats[path])
+        removed = sorted(path for path in self.stats if path not in stats)
+        self.stats = stats
+        return changed, removed
+
+    def update(self, changed, removed):
+        """
+        Roll back the applied migrations in ``changed`` and ``removed``,
+        then apply the new versions of ``changed``. Return the list of
+        migrations applied.
+        """
+        migrations = self.migrations
+        outdated = set(changed) | set(removed)
+        applied_ids = migrations.applied_ids()
+
+        rollback = [m for m in migrations
+                    if m.path in outdated and m.id in applied_ids]
+        migrations.replace(reversed(rollback)).rollback(hooks=False)
+
+        current = dict((m.path, m) for m in migrations
+                       if m.path not in outdated)
+        hooks = dict((m.path, m) for m in migrations.post_apply
+                     if m.path not in outdated)
+        for path in changed:
+            migration = read_migration(path)
+            if migration is None:
+                continue
+            if isinstance(migration, PostApplyHookMigration):
+                hooks[path] = migration
+            else:
+                current[path] = migration
+
+        def ordered(by_path):
+            return [by_path[path] for path in sorted(
+                by_path, key=lambda path: self.sort_key(by_path[path].id))]
+
+        migrations[:] = ordered(current)
+        migrations.post_apply[:] = ordered(hooks)
+
+        apply = migrations.replace(m for m in migrations
+                                   if m.path in outdated or
+                                   m.id not in applied_ids)
+        apply.apply(hooks=False)
+        migrations.replace(rollback + list(apply)).run_post_apply('apply')
+        return apply
+
+    def watch(self, interval=0.5, out=sys.stdout):
+        """
+        Poll the migrations directory every ``interval`` seconds, updating
+        the database as migration scripts change and reporting each update
+        to ``out``. Errors from migrations are logged and the watch
+        continues, so that the script can be fixed.
+        """
+        while True:
+            time.sleep(interval)
+            changed, removed = self.changes()
+            if not (changed or removed):
+                continue
+            started = time.time()
+            try:
+                applied = self.update(changed, removed)
+            except Exception:
+                logger.exception("Error updating migrations")
+                continue
+            out.write("Applied %s in %.2fs\n" % (
+                ', '.join(m.id for m in applied) or 'no migrations',
+                time.time() - started))
+            out.flush()